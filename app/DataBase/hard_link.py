@@ -5,8 +5,9 @@ import threading
 import traceback
 import xml.etree.ElementTree as ET
 
+from app.DataBase.pool import ConnectionPool
 from app.log import log, logger
-from app.util.protocbuf.msg_pb2 import MessageBytesExtra
+from app.util.protocbuf.bytes_extra import get_message2, file_storage_path
 
 image_db_lock = threading.Lock()
 video_db_lock = threading.Lock()
@@ -105,26 +106,31 @@ def singleton(cls):
 @singleton
 class HardLink:
     def __init__(self):
-        self.imageDB = None
-        self.videoDB = None
-        self.image_cursor = None
-        self.video_cursor = None
+        self.image_pool: ConnectionPool = None
+        self.video_pool: ConnectionPool = None
         self.open_flag = False
         self.init_database()
 
+    @property
+    def image_cursor(self) -> sqlite3.Cursor:
+        """
+        当前线程自己的游标，见 ConnectionPool
+        """
+        return self.image_pool.cursor()
+
+    @property
+    def video_cursor(self) -> sqlite3.Cursor:
+        return self.video_pool.cursor()
+
     def init_database(self):
         if not self.open_flag:
             if os.path.exists(image_db_path):
-                self.imageDB = sqlite3.connect(image_db_path, check_same_thread=False)
-                # '''创建游标'''
-                self.image_cursor = self.imageDB.cursor()
+                self.image_pool = ConnectionPool.readonly(image_db_path)
                 self.open_flag = True
                 if image_db_lock.locked():
                     image_db_lock.release()
             if os.path.exists(video_db_path):
-                self.videoDB = sqlite3.connect(video_db_path, check_same_thread=False)
-                # '''创建游标'''
-                self.video_cursor = self.videoDB.cursor()
+                self.video_pool = ConnectionPool.readonly(video_db_path)
                 self.open_flag = True
                 if video_db_lock.locked():
                     video_db_lock.release()
@@ -142,16 +148,12 @@ class HardLink:
             where MD5 = ?;
             """
         try:
-            image_db_lock.acquire(True)
-            try:
-                self.image_cursor.execute(sql, [md5])
-            except AttributeError:
-                self.init_database()
-                self.image_cursor.execute(sql, [md5])
-            result = self.image_cursor.fetchone()
-            return result
-        finally:
-            image_db_lock.release()
+            self.image_cursor.execute(sql, [md5])
+        except AttributeError:
+            self.init_database()
+            self.image_cursor.execute(sql, [md5])
+        result = self.image_cursor.fetchone()
+        return result
 
     def get_video_by_md5(self, md5: bytes):
         if not md5:
@@ -165,29 +167,20 @@ class HardLink:
             where MD5 = ?;
             """
         try:
-            video_db_lock.acquire(True)
-            try:
-                self.video_cursor.execute(sql, [md5])
-            except sqlite3.OperationalError:
-                return None
-            except AttributeError:
-                self.init_database()
-                self.video_cursor.execute(sql, [md5])
-            result = self.video_cursor.fetchone()
-            return result
-        finally:
-            video_db_lock.release()
+            self.video_cursor.execute(sql, [md5])
+        except sqlite3.OperationalError:
+            return None
+        except AttributeError:
+            self.init_database()
+            self.video_cursor.execute(sql, [md5])
+        result = self.video_cursor.fetchone()
+        return result
 
     def get_image_original(self, content, bytesExtra) -> str:
-        msg_bytes = MessageBytesExtra()
-        msg_bytes.ParseFromString(bytesExtra)
         result = ''
-        for tmp in msg_bytes.message2:
-            if tmp.field1 != 4:
-                continue
-            pathh = tmp.field2  # wxid\FileStorage\...
-            pathh = "\\".join(pathh.split("\\")[1:])
-            return pathh
+        pathh = get_message2(bytesExtra, 4, first=True, default=None)  # wxid\FileStorage\...
+        if pathh is not None:
+            return file_storage_path(pathh)
         md5 = get_md5_from_xml(content)
         if not md5:
             pass
@@ -203,15 +196,10 @@ class HardLink:
         return result
 
     def get_image_thumb(self, content, bytesExtra) -> str:
-        msg_bytes = MessageBytesExtra()
-        msg_bytes.ParseFromString(bytesExtra)
         result = ''
-        for tmp in msg_bytes.message2:
-            if tmp.field1 != 3:
-                continue
-            pathh = tmp.field2  # wxid\FileStorage\...
-            pathh = "\\".join(pathh.split("\\")[1:])
-            return pathh
+        pathh = get_message2(bytesExtra, 3, first=True, default=None)  # wxid\FileStorage\...
+        if pathh is not None:
+            return file_storage_path(pathh)
         md5 = get_md5_from_xml(content)
         if not md5:
             pass
@@ -227,8 +215,6 @@ class HardLink:
         return result
 
     def get_image(self, content, bytesExtra, up_dir="", thumb=False) -> str:
-        msg_bytes = MessageBytesExtra()
-        msg_bytes.ParseFromString(bytesExtra)
         if thumb:
             result = self.get_image_thumb(content, bytesExtra)
         else:
@@ -238,14 +224,9 @@ class HardLink:
         return result
 
     def get_video(self, content, bytesExtra, thumb=False):
-        msg_bytes = MessageBytesExtra()
-        msg_bytes.ParseFromString(bytesExtra)
-        for tmp in msg_bytes.message2:
-            if tmp.field1 != (3 if thumb else 4):
-                continue
-            pathh = tmp.field2  # wxid\FileStorage\...
-            pathh = "\\".join(pathh.split("\\")[1:])
-            return pathh
+        pathh = get_message2(bytesExtra, 3 if thumb else 4, first=True, default=None)  # wxid\FileStorage\...
+        if pathh is not None:
+            return file_storage_path(pathh)
         md5 = get_md5_from_xml(content, type_="video")
         if not md5:
             return ''
@@ -265,8 +246,10 @@ class HardLink:
                 image_db_lock.acquire(True)
                 video_db_lock.acquire(True)
                 self.open_flag = False
-                self.imageDB.close()
-                self.videoDB.close()
+                # 保留关闭后的连接池，之后的查询和原来一样报数据库已关闭
+                for pool in (self.image_pool, self.video_pool):
+                    if pool is not None:
+                        pool.close()
             finally:
                 image_db_lock.release()
                 video_db_lock.release()
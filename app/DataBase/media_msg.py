@@ -8,6 +8,7 @@ import threading
 import xml.etree.ElementTree as ET
 from pilk import decode
 
+from app.DataBase.pool import ConnectionPool
 from app.log import logger
 
 lock = threading.Lock()
@@ -38,17 +39,29 @@ def singleton(cls):
 @singleton
 class MediaMsg:
     def __init__(self):
-        self.DB = None
-        self.cursor: sqlite3.Cursor = None
+        self.pool: ConnectionPool = None
         self.open_flag = False
         self.init_database()
 
-    def init_database(self):
+    @property
+    def cursor(self) -> sqlite3.Cursor:
+        """
+        当前线程自己的游标，见 ConnectionPool
+        """
+        return self.pool.cursor()
+
+    def init_database(self, path=None):
+        """
+        @param path: 已打开的 sqlite3.Connection (如 decrypt_to_connection 得到的内存数据库)，默认打开 db_path
+        """
         if not self.open_flag:
-            if os.path.exists(db_path):
-                self.DB = sqlite3.connect(db_path, check_same_thread=False)
-                # '''创建游标'''
-                self.cursor = self.DB.cursor()
+            pool = None
+            if isinstance(path, sqlite3.Connection):
+                pool = ConnectionPool.shared(path)
+            elif os.path.exists(db_path):
+                pool = ConnectionPool.readonly(db_path)
+            if pool is not None:
+                self.pool = pool
                 self.open_flag = True
                 if lock.locked():
                     lock.release()
@@ -59,13 +72,9 @@ class MediaMsg:
             from Media
             where Reserved0 = ?
         '''
-        try:
-            lock.acquire(True)
-            self.cursor.execute(sql, [reserved0])
-            result = self.cursor.fetchone()
+        self.cursor.execute(sql, [reserved0])
+        result = self.cursor.fetchone()
 
-        finally:
-            lock.release()
         return result[0] if result else None
 
     def get_audio(self, reserved0, output_path):
@@ -129,7 +138,8 @@ class MediaMsg:
             try:
                 lock.acquire(True)
                 self.open_flag = False
-                self.DB.close()
+                # 保留关闭后的连接池，之后的查询和原来一样报数据库已关闭
+                self.pool.close()
             finally:
                 lock.release()
 
@@ -1,93 +1,625 @@
 import os
+import shutil
 import sqlite3
+import tempfile
+import time
 import traceback
 
 from app.log import logger
 
+# 从模板新建目标数据库时使用，中途崩溃可能损坏文件，因此新建的目标数据库先写到临时文件，完成后再替换
+BULK_LOAD_PRAGMAS = (
+    "PRAGMA synchronous = OFF;",
+    "PRAGMA journal_mode = MEMORY;",
+    "PRAGMA temp_store = MEMORY;",
+    "PRAGMA cache_size = -262144;",  # 256MB
+)
+# 增量追加到已有的目标数据库时使用，保留磁盘上的回滚日志，崩溃后可以恢复
+APPEND_PRAGMAS = (
+    "PRAGMA synchronous = NORMAL;",
+    "PRAGMA journal_mode = DELETE;",
+    "PRAGMA temp_store = MEMORY;",
+    "PRAGMA cache_size = -262144;",  # 256MB
+)
+BUILD_SUFFIX = '.tmp'  # 新建目标数据库时的临时文件后缀
+# 各表合并时复制的列
+MERGE_COLUMNS = {
+    'MSG': 'TalkerId,MsgsvrID,Type,SubType,IsSender,CreateTime,Sequence,StrTalker,StrContent,DisplayContent,'
+           'BytesExtra,CompressContent',
+    'Media': 'Key,Reserved0,Buf,Reserved1,Reserved2',
+}
+# 带唯一约束的列，合并时按 on_conflict 处理重复
+MERGE_UNIQUE = {
+    'Media': 'Key',
+}
+# 增量合并水位线中记录的 (最大Sequence, 最大CreateTime)
+CHUNK_STATS = {
+    'MSG': 'max(Sequence), max(CreateTime)',
+    'Media': 'NULL, NULL',
+}
+# 分片按 rowid 分块合并，每块单独提交
+MERGE_CHUNK_ROWS = 10000
+# 合并后为 msg.py 中的查询建立的索引：按联系人取消息、按类型取消息、日历/按天/按小时统计都是 StrTalker (+ Type) + CreateTime 的范围扫描，
+# 年度报告里只统计自己发送消息的查询走 IsSender + CreateTime，并且不需要回表，iter_messages 读取所有人的消息时按 CreateTime 分页。
+# 修改索引后需增加 MSG_INDEX_VERSION
+MSG_INDEX_VERSION = 2
+MSG_INDEX_SQLS = (
+    "CREATE INDEX IF NOT EXISTS MSG_CREATETIME ON MSG (CreateTime);",
+    "CREATE INDEX IF NOT EXISTS MSG_TALKER_CREATETIME ON MSG (StrTalker, CreateTime);",
+    "CREATE INDEX IF NOT EXISTS MSG_TALKER_TYPE_CREATETIME ON MSG (StrTalker, Type, CreateTime);",
+    "CREATE INDEX IF NOT EXISTS MSG_SENDER_CREATETIME_TYPE ON MSG (IsSender, CreateTime, Type, SubType);",
+)
+# 按 (联系人, 是否自己发送, 类型, 本地时间的小时) 预先汇总的消息条数和文本长度，日历、按天/按月/按小时统计直接读这张表，
+# HourStart 是该小时开始的时间戳，Day/Hour 是对应的本地日期和小时。
+# MsgTalkerSummary 是每个联系人的汇总，聊天列表排序和聊天最多的联系人直接读这张表。
+# MsgSender 是从 BytesExtra 中解析出的群聊消息发送人，读取群聊消息时不用再解析 BytesExtra。
+# 修改表结构后需增加 MSG_STATS_VERSION，旧的汇总表会被删除重建
+MSG_STATS_VERSION = 4
+MSG_STATS_TABLES = ('MsgStats', 'MsgTalkerSummary', 'MsgSender')
+# 最后一条消息预览的最大长度
+MSG_PREVIEW_LENGTH = 50
+MSG_STATS_SQLS = (
+    '''CREATE TABLE IF NOT EXISTS MsgStats (
+        StrTalker TEXT,
+        IsSender INTEGER,
+        Type INTEGER,
+        SubType INTEGER,
+        HourStart INTEGER,
+        Day TEXT,  -- 2024-01-01
+        Hour INTEGER,
+        MsgCount INTEGER,
+        TextLength INTEGER,  -- sum(length(StrContent))，只有文本消息(Type=1)有意义
+        PRIMARY KEY (StrTalker, HourStart, IsSender, Type, SubType)
+    ) WITHOUT ROWID;''',
+    '''CREATE TABLE IF NOT EXISTS MsgTalkerSummary (
+        StrTalker TEXT PRIMARY KEY,
+        MsgCount INTEGER,
+        SendCount INTEGER,
+        ReceiveCount INTEGER,
+        FirstTime INTEGER,
+        LastTime INTEGER,
+        LastLocalId INTEGER,  -- 最后一条消息
+        LastType INTEGER,
+        LastContent TEXT,  -- StrContent 的前 MSG_PREVIEW_LENGTH 个字符
+        TextLength INTEGER  -- 文本消息(Type=1)的总长度
+    );''',
+    '''CREATE TABLE IF NOT EXISTS MsgSender (
+        localId INTEGER PRIMARY KEY,  -- 群聊中别人发的消息
+        MsgSvrID INTEGER,
+        StrTalker TEXT,
+        Sender TEXT  -- 发送人 wxid，BytesExtra 为空时为 NULL
+    );''',
+    "CREATE INDEX IF NOT EXISTS MsgSender_TALKER_LOCALID ON MsgSender (StrTalker, localId);",
+)
+MSG_STATS_STATE_SQL = '''CREATE TABLE IF NOT EXISTS MsgStatsState (
+    Version INTEGER,
+    TimeZone INTEGER,  -- 汇总时的 time.timezone，时区变化后需重新按本地时间汇总
+    MaxRowId INTEGER,  -- 已汇总的 MSG 最大 rowid
+    RowCount INTEGER  -- rowid 不超过 MaxRowId 的行数，MSG 有行被删除(分片重建、REPLACE)时与实际行数不一致
+);'''
+# 把 MSG 中 rowid 大于 ? 的行汇总后累加到 MsgStats
+MSG_STATS_UPSERT = '''
+    INSERT INTO MsgStats
+    SELECT StrTalker, IsSender, Type, SubType,
+        CAST(strftime('%s', strftime('%Y-%m-%d %H:00:00', CreateTime, 'unixepoch', 'localtime'), 'utc') AS INTEGER) AS HourStart,
+        strftime('%Y-%m-%d', CreateTime, 'unixepoch', 'localtime') AS Day,
+        CAST(strftime('%H', CreateTime, 'unixepoch', 'localtime') AS INTEGER) AS Hour,
+        count(MsgSvrID), coalesce(sum(length(StrContent)), 0)
+    FROM MSG
+    WHERE rowid > ?
+    GROUP BY StrTalker, HourStart, IsSender, Type, SubType
+    ON CONFLICT (StrTalker, HourStart, IsSender, Type, SubType) DO UPDATE SET
+        MsgCount = MsgCount + excluded.MsgCount,
+        TextLength = TextLength + excluded.TextLength;
+'''
+# 把 MSG 中 rowid 大于 ? 的行按联系人汇总后累加到 MsgTalkerSummary，再更新有新消息的联系人的最后一条消息
+MSG_TALKER_SUMMARY_UPSERTS = (
+    '''
+    INSERT INTO MsgTalkerSummary (StrTalker, MsgCount, SendCount, ReceiveCount, FirstTime, LastTime, TextLength)
+    SELECT StrTalker, count(MsgSvrID), count(CASE WHEN IsSender = 1 THEN MsgSvrID END),
+        count(MsgSvrID) - count(CASE WHEN IsSender = 1 THEN MsgSvrID END),
+        min(CreateTime), max(CreateTime), coalesce(sum(CASE WHEN Type = 1 THEN length(StrContent) END), 0)
+    FROM MSG
+    WHERE rowid > ? AND StrTalker IS NOT NULL
+    GROUP BY StrTalker
+    ON CONFLICT (StrTalker) DO UPDATE SET
+        MsgCount = MsgCount + excluded.MsgCount,
+        SendCount = SendCount + excluded.SendCount,
+        ReceiveCount = ReceiveCount + excluded.ReceiveCount,
+        FirstTime = min(FirstTime, excluded.FirstTime),
+        LastTime = max(LastTime, excluded.LastTime),
+        TextLength = TextLength + excluded.TextLength;
+    ''',
+    f'''
+    UPDATE MsgTalkerSummary SET (LastLocalId, LastType, LastContent) = (
+        SELECT localId, Type, substr(StrContent, 1, {MSG_PREVIEW_LENGTH})
+        FROM MSG
+        WHERE MSG.StrTalker = MsgTalkerSummary.StrTalker
+        ORDER BY CreateTime DESC, localId DESC
+        LIMIT 1
+    )
+    WHERE StrTalker IN (SELECT DISTINCT StrTalker FROM MSG WHERE rowid > ?);
+    ''',
+)
+# 增量合并的元数据：每个分片已合并到的位置，以及每次追加的行在目标库中的 rowid 范围
+WATERMARK_SQLS = (
+    '''CREATE TABLE IF NOT EXISTS MergeWatermark (
+        Source TEXT PRIMARY KEY,  -- 分片文件名，如 MSG3.db
+        Identity TEXT,  -- 分片第一行的指纹，分片被微信重建后会变化
+        MaxRowId INTEGER,
+        MaxSequence INTEGER,
+        MaxCreateTime INTEGER,
+        RowCount INTEGER
+    );''',
+    '''CREATE TABLE IF NOT EXISTS MergeBatch (
+        Source TEXT,
+        TableName TEXT,
+        FirstRowId INTEGER,
+        LastRowId INTEGER
+    );''',
+)
+
+
+def _merge_tables(target_conn, schema='src'):
+    return [row[0] for row in target_conn.execute(f"SELECT name FROM {schema}.sqlite_master WHERE type='table';")
+            if row[0] in MERGE_COLUMNS]
+
+
+def _insert_rows(target_conn, table, after_rowid=0, on_conflict='IGNORE', on_chunk=None):
+    """
+    把 src.table 中 rowid 大于 after_rowid 的行按 rowid 分块追加到 main.table，每块单独提交，
+    回滚日志和语音等大字段占用的内存只与块大小有关，重复的行按 on_conflict 处理而不会中断整个分片
+    @param on_conflict: IGNORE 保留已有的行，REPLACE 用分片中的行覆盖
+    @param on_chunk: on_chunk(upper, batch, stats) 在每块所在的事务中调用，upper 为本块 src 的最大 rowid，
+                     batch 为新行在 main.table 中的 rowid 范围，stats 为 (本块行数, 最大Sequence, 最大CreateTime)
+    @return: (插入行数, 重复行数)
+    """
+    if on_conflict not in ('IGNORE', 'REPLACE'):
+        raise ValueError(f'unsupported on_conflict: {on_conflict}')
+    columns = MERGE_COLUMNS[table]
+    last_rowid = target_conn.execute(f"SELECT max(rowid) FROM src.{table};").fetchone()[0] or 0
+    inserted = duplicates = 0
+    while after_rowid < last_rowid:
+        upper = min(after_rowid + MERGE_CHUNK_ROWS, last_rowid)
+        with target_conn:
+            stats = target_conn.execute(
+                f"SELECT count(*), {CHUNK_STATS[table]} FROM src.{table} WHERE rowid > ? AND rowid <= ?;",
+                [after_rowid, upper]
+            ).fetchone()
+            if on_conflict == 'REPLACE' and table in MERGE_UNIQUE:
+                unique = MERGE_UNIQUE[table]
+                replaced = target_conn.execute(
+                    f"SELECT count(*) FROM src.{table} AS s WHERE s.rowid > ? AND s.rowid <= ? "
+                    f"AND EXISTS (SELECT 1 FROM main.{table} AS m WHERE m.{unique} = s.{unique});",
+                    [after_rowid, upper]
+                ).fetchone()[0]
+            else:
+                replaced = 0
+            before = target_conn.execute(f"SELECT max(rowid) FROM main.{table};").fetchone()[0] or 0
+            cursor = target_conn.execute(
+                f"INSERT OR {on_conflict} INTO main.{table} ({columns}) "
+                f"SELECT {columns} FROM src.{table} WHERE rowid > ? AND rowid <= ?;",
+                [after_rowid, upper]
+            )
+            after = target_conn.execute(f"SELECT max(rowid) FROM main.{table};").fetchone()[0] or 0
+            if on_chunk:
+                on_chunk(upper, (before + 1, after) if after > before else None, stats)
+        inserted += cursor.rowcount
+        duplicates += stats[0] - cursor.rowcount + replaced
+        after_rowid = upper
+    return inserted, duplicates
+
+
+def _report_duplicates(source_path, duplicates, on_conflict):
+    if duplicates:
+        logger.warning(f'{source_path}有{duplicates}条重复key，已{"跳过" if on_conflict == "IGNORE" else "覆盖"}')
+
+
+def _append_attached(target_conn, source_path, on_conflict='IGNORE'):
+    """
+    把挂载为 src 的分片中 MSG/Media 表的数据追加到目标数据库
+    @return: 重复的行数
+    """
+    duplicates = 0
+    try:
+        for table in _merge_tables(target_conn):
+            duplicates += _insert_rows(target_conn, table, on_conflict=on_conflict)[1]
+    except:
+        logger.error(f'{source_path}数据库合并错误:\n{traceback.format_exc()}')
+    _report_duplicates(source_path, duplicates, on_conflict)
+    return duplicates
+
+
+def _shard_identity(target_conn, schema, table):
+    """
+    分片第一行的指纹
+    """
+    first = target_conn.execute(
+        f"SELECT rowid, {'MsgSvrID, CreateTime' if table == 'MSG' else 'Key, Reserved0'} "
+        f"FROM {schema}.{table} ORDER BY rowid LIMIT 1;"
+    ).fetchone()
+    return repr(first)
+
+
+def _record_template(target_conn, source_path):
+    """
+    目标数据库由模板分片直接生成时，模板的全部行都视为已合并
+    """
+    source = os.path.basename(source_path)
+    with target_conn:
+        for sql in WATERMARK_SQLS:
+            target_conn.execute(sql)
+        target_conn.execute("DELETE FROM MergeBatch;")
+        target_conn.execute("DELETE FROM MergeWatermark;")
+        for table in _merge_tables(target_conn, 'main'):
+            first_rowid, last_rowid, count, max_sequence, max_create_time = target_conn.execute(
+                f"SELECT min(rowid), max(rowid), count(*), {CHUNK_STATS[table]} FROM main.{table};"
+            ).fetchone()
+            if count:
+                target_conn.execute("INSERT INTO MergeBatch VALUES (?,?,?,?);",
+                                    [source, table, first_rowid, last_rowid])
+            target_conn.execute(
+                "INSERT OR REPLACE INTO MergeWatermark VALUES (?,?,?,?,?,?);",
+                [source, _shard_identity(target_conn, 'main', table), last_rowid or 0, max_sequence,
+                 max_create_time, count]
+            )
+
+
+def _append_attached_incremental(target_conn, source_path, on_conflict='IGNORE'):
+    """
+    增量合并挂载为 src 的分片：只追加水位线之后的行，每提交一块就推进一次水位线，中途中断后下次从断点继续
+    分片指纹变化(被重建)或水位线之前的行数变化(有消息被删除)时，删除之前从该分片合并的行再整体重新合并
+    @return: 重复的行数
+    """
+    source = os.path.basename(source_path)
+    duplicates = 0
+
+    def advance(upper, batch, stats):
+        if batch:
+            target_conn.execute("INSERT INTO MergeBatch VALUES (?,?,?,?);", [source, table, *batch])
+        target_conn.execute(
+            "UPDATE MergeWatermark SET MaxRowId = ?, RowCount = RowCount + ?, "
+            "MaxSequence = max(ifnull(MaxSequence, ?), ?), MaxCreateTime = max(ifnull(MaxCreateTime, ?), ?) "
+            "WHERE Source = ?;",
+            [upper, stats[0], stats[1], stats[1], stats[2], stats[2], source]
+        )
 
-def merge_MediaMSG_databases(source_paths, target_path):
-    # 创建目标数据库连接
-    target_conn = sqlite3.connect(target_path)
-    target_cursor = target_conn.cursor()
     try:
-        # 开始事务
-        target_conn.execute("BEGIN;")
-        for i, source_path in enumerate(source_paths):
-            if not os.path.exists(source_path):
-                continue
-            db = sqlite3.connect(source_path)
-            db.text_factory = str
-            cursor = db.cursor()
-            # 附加源数据库
-            try:
-                sql = '''SELECT Key,Reserved0,Buf,Reserved1,Reserved2 FROM Media;'''
-                cursor.execute(sql)
-                result = cursor.fetchall()
-                target_cursor.executemany(
-                    "INSERT INTO Media (Key,Reserved0,Buf,Reserved1,Reserved2)"
-                    "VALUES(?,?,?,?,?)",
-                    result)
-            except sqlite3.IntegrityError:
-                print("有重复key", "跳过")
-            except sqlite3.OperationalError:
-                print("no such table: Media", "跳过")
-            cursor.close()
-            db.close()
-        # 提交事务
-        target_conn.execute("COMMIT;")
-
-    except Exception as e:
-        # 发生异常时回滚事务
-        target_conn.execute("ROLLBACK;")
-        raise e
+        for table in _merge_tables(target_conn):
+            identity = _shard_identity(target_conn, 'src', table)
+            watermark = target_conn.execute(
+                "SELECT Identity, MaxRowId, RowCount FROM MergeWatermark WHERE Source = ?;", [source]
+            ).fetchone()
+            if watermark and watermark[0] == identity and target_conn.execute(
+                    f"SELECT count(*) FROM src.{table} WHERE rowid <= ?;", [watermark[1]]
+            ).fetchone()[0] == watermark[2]:
+                after_rowid = watermark[1]
+            else:
+                after_rowid = 0
+                with target_conn:
+                    batches = target_conn.execute(
+                        "SELECT FirstRowId, LastRowId FROM MergeBatch WHERE Source = ? AND TableName = ?;",
+                        [source, table]
+                    ).fetchall()
+                    for first_rowid, last_rowid in batches:
+                        target_conn.execute(f"DELETE FROM main.{table} WHERE rowid BETWEEN ? AND ?;",
+                                            [first_rowid, last_rowid])
+                    target_conn.execute("DELETE FROM MergeBatch WHERE Source = ? AND TableName = ?;",
+                                        [source, table])
+                    target_conn.execute("INSERT OR REPLACE INTO MergeWatermark VALUES (?,?,0,NULL,NULL,0);",
+                                        [source, identity])
+            duplicates += _insert_rows(target_conn, table, after_rowid, on_conflict, advance)[1]
+    except:
+        logger.error(f'{source_path}数据库合并错误:\n{traceback.format_exc()}')
+    _report_duplicates(source_path, duplicates, on_conflict)
+    return duplicates
+
 
+def _has_watermark(target_conn):
+    return target_conn.execute(
+        "SELECT 1 FROM main.sqlite_master WHERE type='table' AND name='MergeWatermark';"
+    ).fetchone() is not None
+
+
+def _append_shard(target_conn, data, source_path, incremental=False, on_conflict='IGNORE'):
+    """
+    把内存中解密好的分片反序列化挂载为 src，并追加到目标数据库
+    sqlite3 没有 deserialize (Python 3.11 以下) 时把分片写到临时文件再 ATTACH，用完即删
+    @return: 重复的行数
+    """
+    tmp_path = None
+    if not hasattr(target_conn, 'deserialize'):
+        fd, tmp_path = tempfile.mkstemp(suffix='.db')
+        with open(fd, 'wb') as f:
+            f.write(data)
+    target_conn.execute("ATTACH DATABASE ? AS src;", [tmp_path or ':memory:'])
+    try:
+        if tmp_path is None:
+            target_conn.deserialize(data, name='src')
+        if incremental:
+            return _append_attached_incremental(target_conn, source_path, on_conflict)
+        return _append_attached(target_conn, source_path, on_conflict)
     finally:
-        # 关闭目标数据库连接
-        target_conn.close()
+        target_conn.execute("DETACH DATABASE src;")
+        if tmp_path:
+            os.remove(tmp_path)
+
 
+def _begin_bulk_load(target_conn, fresh=True):
+    """
+    批量导入前的准备：新建的目标数据库关闭同步、回滚日志放在内存中，并删除 MSG/Media 表上的非唯一索引，导入完成后再由 _end_bulk_load 重建
+    @param fresh: 目标数据库是否从模板新建；增量追加到已有的目标数据库时使用 APPEND_PRAGMAS 且不删除索引，
+                  新增的行只占很少一部分，重建全部索引比逐行维护索引慢得多
+    @return: 被删除的索引的建索引语句
+    """
+    for pragma in (BULK_LOAD_PRAGMAS if fresh else APPEND_PRAGMAS):
+        target_conn.execute(pragma)
+    if not fresh:
+        return []
+    indexes = target_conn.execute(
+        "SELECT name, sql FROM main.sqlite_master "
+        "WHERE type='index' AND tbl_name IN ('MSG', 'Media') AND sql IS NOT NULL AND sql NOT LIKE 'CREATE UNIQUE%';"
+    ).fetchall()
+    with target_conn:
+        for name, _ in indexes:
+            target_conn.execute(f'DROP INDEX main."{name}";')
+    return [sql for _, sql in indexes]
 
-def merge_databases(source_paths, target_path):
-    # 创建目标数据库连接
-    target_conn = sqlite3.connect(target_path)
-    target_cursor = target_conn.cursor()
+
+def _end_bulk_load(target_conn, index_sqls):
+    with target_conn:
+        for sql in index_sqls:
+            target_conn.execute(sql)
+
+
+def build_msg_indexes(target_conn):
+    """
+    合并完成后为 MSG 表建立查询用的索引并 ANALYZE，已建立的索引版本记录在 MsgIndexVersion 表中，
+    版本一致时只执行 PRAGMA optimize，由 SQLite 判断统计信息是否需要更新
+    @param target_conn: 合并后的数据库连接
+    @return: 是否重建了索引
+    """
+    if not target_conn.execute(
+            "SELECT 1 FROM main.sqlite_master WHERE type='table' AND name='MSG';"
+    ).fetchone():
+        return False
+    with target_conn:
+        target_conn.execute("CREATE TABLE IF NOT EXISTS MsgIndexVersion (Version INTEGER);")
+        version = target_conn.execute("SELECT max(Version) FROM MsgIndexVersion;").fetchone()[0]
+    if version == MSG_INDEX_VERSION:
+        target_conn.execute("PRAGMA optimize;")
+        return False
+    with target_conn:
+        for sql in MSG_INDEX_SQLS:
+            target_conn.execute(sql)
+        target_conn.execute("DELETE FROM MsgIndexVersion;")
+        target_conn.execute("INSERT INTO MsgIndexVersion VALUES (?);", [MSG_INDEX_VERSION])
+    target_conn.execute("ANALYZE;")
+    return True
+
+
+def _backfill_senders(target_conn, after_rowid=0):
+    """
+    按 rowid 分块读取 rowid 大于 after_rowid 的群聊中别人发的消息，解析 BytesExtra 中的发送人写入 MsgSender
+    只扫描 BytesExtra 中需要的字段，不创建 protobuf 消息对象
+    """
+    from app.util.protocbuf.bytes_extra import get_sender_batch
+    last_rowid = target_conn.execute("SELECT max(rowid) FROM MSG;").fetchone()[0] or 0
+    while after_rowid < last_rowid:
+        upper = min(after_rowid + MERGE_CHUNK_ROWS, last_rowid)
+        rows = target_conn.execute(
+            "SELECT localId, MsgSvrID, StrTalker, BytesExtra FROM MSG "
+            "WHERE rowid > ? AND rowid <= ? AND IsSender != 1 AND StrTalker LIKE '%@chatroom';",
+            [after_rowid, upper]
+        ).fetchall()
+        target_conn.executemany(
+            "INSERT OR REPLACE INTO MsgSender VALUES (?,?,?,?);",
+            [(*row[:3], sender) for row, sender in zip(rows, get_sender_batch([row[3] for row in rows]))]
+        )
+        after_rowid = upper
+
+
+def build_msg_stats(target_conn):
+    """
+    合并完成后更新 MsgStats、MsgTalkerSummary 汇总表和 MsgSender 发送人表，MsgStatsState 记录已汇总到的 MSG rowid，之后只汇总新追加的行；
+    MSG 的 localId 是 AUTOINCREMENT，rowid 不会重复使用，已汇总范围内的行数变化说明有行被删除，这时全部重新汇总
+    @param target_conn: 合并后的数据库连接
+    @return: 本次汇总的行数
+    """
+    if not target_conn.execute(
+            "SELECT 1 FROM main.sqlite_master WHERE type='table' AND name='MSG';"
+    ).fetchone():
+        return 0
+    with target_conn:
+        target_conn.execute(MSG_STATS_STATE_SQL)
+        state = target_conn.execute("SELECT Version, TimeZone, MaxRowId, RowCount FROM MsgStatsState;").fetchone()
+        max_rowid = target_conn.execute("SELECT max(rowid) FROM MSG;").fetchone()[0] or 0
+        after_rowid = 0
+        if state and state[:2] == (MSG_STATS_VERSION, time.timezone) and state[2] <= max_rowid:
+            row_count = target_conn.execute("SELECT count(*) FROM MSG WHERE rowid <= ?;", [state[2]]).fetchone()[0]
+            if row_count == state[3]:
+                after_rowid = state[2]
+        if after_rowid and after_rowid == max_rowid:
+            return 0
+        if not after_rowid:
+            for table in MSG_STATS_TABLES:
+                target_conn.execute(f"DROP TABLE IF EXISTS {table};")
+        for sql in MSG_STATS_SQLS:
+            target_conn.execute(sql)
+        target_conn.execute(MSG_STATS_UPSERT, [after_rowid])
+        for sql in MSG_TALKER_SUMMARY_UPSERTS:
+            target_conn.execute(sql, [after_rowid])
+        _backfill_senders(target_conn, after_rowid)
+        row_count = target_conn.execute("SELECT count(*) FROM MSG;").fetchone()[0]
+        target_conn.execute("DELETE FROM MsgStatsState;")
+        target_conn.execute("INSERT INTO MsgStatsState VALUES (?,?,?,?);",
+                            [MSG_STATS_VERSION, time.timezone, max_rowid, row_count])
+    return row_count - (state[3] if after_rowid else 0)
+
+
+def _merge_database_files(source_paths, target_path, incremental=False, on_conflict='IGNORE'):
+    """
+    把各分片依次 ATTACH 到目标数据库，用 INSERT INTO main.xxx SELECT ... FROM src.xxx 追加数据，
+    行数据和语音等二进制数据都不经过 Python，内存占用与分片大小无关
+    增量合并时 source_paths 需包含模板分片，目标数据库不存在或没有水位线时先把模板分片复制到临时文件，合并完成后再替换目标数据库
+    @return: 重复的行数
+    """
+    source_paths = [source_path for source_path in source_paths if os.path.exists(source_path)]
+    fresh = True  # 目标数据库是否从模板新建
+    build_path = None  # 新建目标数据库的临时文件
+    if incremental and source_paths:
+        target_conn = sqlite3.connect(target_path) if os.path.exists(target_path) else None
+        if target_conn is None or not _has_watermark(target_conn):
+            if target_conn is not None:
+                target_conn.close()
+            build_path = target_path + BUILD_SUFFIX
+            shutil.copy2(source_paths[0], build_path)  # 使用一个数据库文件作为模板
+            target_conn = sqlite3.connect(build_path)
+            _record_template(target_conn, source_paths[0])
+            source_paths = source_paths[1:]
+        else:
+            fresh = False
+    else:
+        target_conn = sqlite3.connect(target_path)
+    duplicates = 0
     try:
-        # 开始事务
-        target_conn.execute("BEGIN;")
-        for i, source_path in enumerate(source_paths):
-            if not os.path.exists(source_path):
-                continue
-            db = sqlite3.connect(source_path)
-            db.text_factory = str
-            cursor = db.cursor()
-            try:
-                sql = '''
-                    SELECT TalkerId,MsgsvrID,Type,SubType,IsSender,CreateTime,Sequence,StrTalker,StrContent,DisplayContent,BytesExtra,CompressContent
-                    FROM MSG;
-                '''
-                cursor.execute(sql)
-                result = cursor.fetchall()
-                # 附加源数据库
-                target_cursor.executemany(
-                    "INSERT INTO MSG "
-                    "(TalkerId,MsgsvrID,Type,SubType,IsSender,CreateTime,Sequence,StrTalker,StrContent,DisplayContent,"
-                    "BytesExtra,CompressContent)"
-                    "VALUES(?,?,?,?,?,?,?,?,?,?,?,?)",
-                    result)
-            except:
-                logger.error(f'{source_path}数据库合并错误:\n{traceback.format_exc()}')
-            cursor.close()
-            db.close()
-        # 提交事务
-        target_conn.execute("COMMIT;")
-
-    except Exception as e:
-        # 发生异常时回滚事务
-        target_conn.execute("ROLLBACK;")
-        raise e
+        index_sqls = _begin_bulk_load(target_conn, fresh)
+        try:
+            for source_path in source_paths:
+                target_conn.execute("ATTACH DATABASE ? AS src;", [source_path])
+                try:
+                    if incremental:
+                        duplicates += _append_attached_incremental(target_conn, source_path, on_conflict)
+                    else:
+                        duplicates += _append_attached(target_conn, source_path, on_conflict)
+                finally:
+                    target_conn.execute("DETACH DATABASE src;")
+        finally:
+            _end_bulk_load(target_conn, index_sqls)
+        build_msg_indexes(target_conn)
+        build_msg_stats(target_conn)
+    finally:
+        target_conn.close()
+    if build_path:
+        os.replace(build_path, target_path)
+    return duplicates
 
+
+def merge_MediaMSG_databases(source_paths, target_path, incremental=False, on_conflict='IGNORE'):
+    """
+    Media 表的 Key 有唯一约束，重复的 Key 按 on_conflict 处理：IGNORE 保留先合并的，REPLACE 用后面分片中的覆盖
+    @return: 重复的行数
+    """
+    return _merge_database_files(source_paths, target_path, incremental, on_conflict)
+
+
+def merge_databases(source_paths, target_path, incremental=False, on_conflict='IGNORE'):
+    """
+    @param source_paths: 源数据库文件列表
+    @param target_path: 目标数据库，非增量合并时需事先复制一个分片作为模板
+    @param incremental: 增量合并，在目标数据库中记录各分片的水位线，之后只追加新增的行，见 _append_attached_incremental
+    @param on_conflict: 重复行的处理方式 IGNORE 或 REPLACE
+    @return: 重复的行数
+    """
+    return _merge_database_files(source_paths, target_path, incremental, on_conflict)
+
+
+def merge_databases_in_memory(key, source_paths):
+    """
+    解密多个 MSG/MediaMSG 分片并合并成一个内存数据库，明文不落盘
+    第一个存在的分片作为模板，其余分片的 MSG/Media 表数据追加进来
+    @param key: 密钥 64位16进制字符串
+    @param source_paths: 加密的数据库分片路径列表
+    @return: sqlite3.Connection，没有可用的分片时返回 None
+    """
+    from app.decrypt.decrypt import decrypt_to_bytes, decrypt_to_connection
+    target_conn = None
+    for source_path in source_paths:
+        if not os.path.exists(source_path):
+            continue
+        if target_conn is None:
+            code, target_conn = decrypt_to_connection(key, source_path)
+            if not code:
+                logger.error(f'{source_path}数据库解密错误:{target_conn}')
+                target_conn = None
+            continue
+        code, data = decrypt_to_bytes(key, source_path)
+        if not code:
+            logger.error(f'{source_path}数据库解密错误:{data}')
+            continue
+        _append_shard(target_conn, data, source_path)
+    return target_conn
+
+
+def decrypt_merge(key, source_paths, target_path, callback=None, processes=None, incremental=False,
+                  on_conflict='IGNORE'):
+    """
+    解密与合并流水线：多进程把各分片解密到内存，当前线程按顺序把解密好的分片追加到目标数据库，
+    合并当前分片的同时后面的分片仍在解密。第一个分片直接写成目标数据库作为模板，其余分片的明文不落盘；
+    新建的目标数据库先写到临时文件，全部合并完成后再替换，中途失败时原有的目标数据库不受影响
+    @param key: 密钥 64位16进制字符串
+    @param source_paths: 加密的 MSG*.db 或 MediaMSG*.db 分片路径列表，按分片序号排列
+    @param target_path: 合并后的数据库路径，非增量合并时已存在的会被覆盖
+    @param callback: callback(index, result, speed) 每个分片处理完成后调用，见 decrypt_tasks
+    @param processes: 解密进程数，默认为CPU核数
+    @param incremental: 增量合并，目标数据库已有水位线时保留它，各分片只追加新增的行
+    @param on_conflict: 重复行的处理方式 IGNORE 或 REPLACE
+    @return: 是否生成了目标数据库
+    """
+    from app.decrypt.decrypt import iter_decrypt_to_bytes
+    source_paths = [source_path for source_path in source_paths if os.path.exists(source_path)]
+    target_conn = None
+    build_path = target_path + BUILD_SUFFIX
+    if incremental and os.path.exists(target_path):
+        target_conn = sqlite3.connect(target_path)
+        if _has_watermark(target_conn):
+            index_sqls = _begin_bulk_load(target_conn, fresh=False)
+            build_path = None
+        else:
+            target_conn.close()
+            target_conn = None
+    try:
+        for index, result, speed in iter_decrypt_to_bytes(key, source_paths, processes):
+            code, data = result
+            if not code:
+                logger.error(f'{source_paths[index]}数据库解密错误:{data}')
+                callback_result = result
+            else:
+                if target_conn is None:
+                    with open(build_path, 'wb') as f:
+                        f.write(data)
+                    target_conn = sqlite3.connect(build_path)
+                    if incremental:
+                        _record_template(target_conn, source_paths[index])
+                    index_sqls = _begin_bulk_load(target_conn)
+                else:
+                    _append_shard(target_conn, data, source_paths[index], incremental, on_conflict)
+                callback_result = True, [source_paths[index], target_path, key]
+            del data, result
+            if callback:
+                callback(index, callback_result, speed)
+    except BaseException:
+        # 合并失败时不重建索引和统计，新建的临时文件直接删除(增量追加时没有删除索引)；
+        # 清理中的错误只记录下来，不覆盖合并时的异常
+        try:
+            if target_conn is not None:
+                target_conn.close()
+            if build_path and os.path.exists(build_path):
+                os.remove(build_path)
+        except Exception:
+            logger.error(f'{target_path}合并失败后清理出错:\n{traceback.format_exc()}')
+        raise
+    if target_conn is None:
+        return False
+    try:
+        _end_bulk_load(target_conn, index_sqls)
+        build_msg_indexes(target_conn)
+        build_msg_stats(target_conn)
     finally:
-        # 关闭目标数据库连接
         target_conn.close()
+    if build_path:
+        os.replace(build_path, target_path)
+    return True
 
 
 if __name__ == "__main__":
@@ -96,8 +628,6 @@ if __name__ == "__main__":
 
     # 目标数据库文件
     target_database = "Msg/MSG.db"
-    import shutil
-
     shutil.copy('Msg/MSG0.db', target_database)  # 使用一个数据库文件作为模板
     # 合并数据库
     merge_databases(source_databases, target_database)
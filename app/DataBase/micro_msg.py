@@ -2,8 +2,12 @@ import os.path
 import sqlite3
 import threading
 
+from app.DataBase.pool import ConnectionPool
+
 lock = threading.Lock()
 db_path = "./app/Database/Msg/MicroMsg.db"
+# 批量查询联系人时每条 IN 查询的最大参数个数
+CONTACT_BATCH_SIZE = 500
 
 
 def singleton(cls):
@@ -23,17 +27,29 @@ def is_database_exist():
 
 class MicroMsg:
     def __init__(self):
-        self.DB = None
-        self.cursor = None
+        self.pool: ConnectionPool = None
         self.open_flag = False
         self.init_database()
 
-    def init_database(self):
+    @property
+    def cursor(self) -> sqlite3.Cursor:
+        """
+        当前线程自己的游标，见 ConnectionPool
+        """
+        return self.pool.cursor()
+
+    def init_database(self, path=None):
+        """
+        @param path: 已打开的 sqlite3.Connection (如 decrypt_to_connection 得到的内存数据库)，默认打开 db_path
+        """
         if not self.open_flag:
-            if os.path.exists(db_path):
-                self.DB = sqlite3.connect(db_path, check_same_thread=False)
-                # '''创建游标'''
-                self.cursor = self.DB.cursor()
+            pool = None
+            if isinstance(path, sqlite3.Connection):
+                pool = ConnectionPool.shared(path)
+            elif os.path.exists(db_path):
+                pool = ConnectionPool.readonly(db_path)
+            if pool is not None:
+                self.pool = pool
                 self.open_flag = True
                 if lock.locked():
                     lock.release()
@@ -42,7 +58,6 @@ class MicroMsg:
         if not self.open_flag:
             return []
         try:
-            lock.acquire(True)
             sql = '''SELECT UserName, Alias, Type, Remark, NickName, PYInitial, RemarkPYInitial, ContactHeadImgUrl.smallHeadImgUrl, ContactHeadImgUrl.bigHeadImgUrl,ExTraBuf,COALESCE(ContactLabel.LabelName, 'None') AS labelName
                     FROM Contact
                     INNER JOIN ContactHeadImgUrl ON Contact.UserName = ContactHeadImgUrl.usrName
@@ -73,8 +88,6 @@ class MicroMsg:
             '''
             self.cursor.execute(sql)
             result = self.cursor.fetchall()
-        finally:
-            lock.release()
         from app.DataBase import msg_db
         return msg_db.get_contact(result)
 
@@ -82,7 +95,6 @@ class MicroMsg:
         if not self.open_flag:
             return None
         try:
-            lock.acquire(True)
             sql = '''
                    SELECT UserName, Alias, Type, Remark, NickName, PYInitial, RemarkPYInitial, ContactHeadImgUrl.smallHeadImgUrl, ContactHeadImgUrl.bigHeadImgUrl,ExTraBuf,ContactLabel.LabelName
                    FROM Contact
@@ -103,24 +115,53 @@ class MicroMsg:
             '''
             self.cursor.execute(sql, [username])
             result = self.cursor.fetchone()
-        finally:
-            lock.release()
 
         return result
 
+    def get_contacts_by_usernames(self, usernames):
+        """
+        批量查询联系人，每 CONTACT_BATCH_SIZE 个一条 IN 查询
+        @param usernames: wxid 列表
+        @return: {wxid: 与 get_contact_by_username 相同的一行}，数据库里没有的 wxid 不在结果中
+        """
+        result = {}
+        if not self.open_flag:
+            return result
+        usernames = list(dict.fromkeys(usernames))
+        for i in range(0, len(usernames), CONTACT_BATCH_SIZE):
+            batch = usernames[i:i + CONTACT_BATCH_SIZE]
+            placeholders = ','.join('?' * len(batch))
+            try:
+                sql = f'''
+                       SELECT UserName, Alias, Type, Remark, NickName, PYInitial, RemarkPYInitial, ContactHeadImgUrl.smallHeadImgUrl, ContactHeadImgUrl.bigHeadImgUrl,ExTraBuf,ContactLabel.LabelName
+                       FROM Contact
+                       INNER JOIN ContactHeadImgUrl ON Contact.UserName = ContactHeadImgUrl.usrName
+                       LEFT JOIN ContactLabel ON Contact.LabelIDList = ContactLabel.LabelId
+                       WHERE UserName IN ({placeholders})
+                    '''
+                self.cursor.execute(sql, batch)
+            except sqlite3.OperationalError:
+                # 解决ContactLabel表不存在的问题
+                sql = f'''
+                       SELECT UserName, Alias, Type, Remark, NickName, PYInitial, RemarkPYInitial, ContactHeadImgUrl.smallHeadImgUrl, ContactHeadImgUrl.bigHeadImgUrl,ExTraBuf,"None"
+                       FROM Contact
+                       INNER JOIN ContactHeadImgUrl ON Contact.UserName = ContactHeadImgUrl.usrName
+                       WHERE UserName IN ({placeholders})
+                '''
+                self.cursor.execute(sql, batch)
+            for row in self.cursor.fetchall():
+                result.setdefault(row[0], row)
+        return result
+
     def get_chatroom_info(self, chatroomname):
         '''
         获取群聊信息
         '''
         if not self.open_flag:
             return None
-        try:
-            lock.acquire(True)
-            sql = '''SELECT ChatRoomName, RoomData FROM ChatRoom WHERE ChatRoomName = ?'''
-            self.cursor.execute(sql, [chatroomname])
-            result = self.cursor.fetchone()
-        finally:
-            lock.release()
+        sql = '''SELECT ChatRoomName, RoomData FROM ChatRoom WHERE ChatRoomName = ?'''
+        self.cursor.execute(sql, [chatroomname])
+        result = self.cursor.fetchone()
         return result
 
     def close(self):
@@ -128,7 +169,8 @@ class MicroMsg:
             try:
                 lock.acquire(True)
                 self.open_flag = False
-                self.DB.close()
+                # 保留关闭后的连接池，之后的查询和原来一样报数据库已关闭
+                self.pool.close()
             finally:
                 lock.release()
 
@@ -2,10 +2,12 @@ import os.path
 import sqlite3
 import threading
 
+from app.DataBase.pool import ConnectionPool
+
 lock = threading.Lock()
-DB = None
-cursor = None
 db_path = "./app/Database/Msg/Misc.db"
+# 批量查询头像时每条 IN 查询的最大参数个数
+AVATAR_BATCH_SIZE = 500
 
 
 # db_path = './Msg/Misc.db'
@@ -25,17 +27,21 @@ def singleton(cls):
 @singleton
 class Misc:
     def __init__(self):
-        self.DB = None
-        self.cursor = None
+        self.pool: ConnectionPool = None
         self.open_flag = False
         self.init_database()
 
+    @property
+    def cursor(self) -> sqlite3.Cursor:
+        """
+        当前线程自己的游标，见 ConnectionPool
+        """
+        return self.pool.cursor()
+
     def init_database(self):
         if not self.open_flag:
             if os.path.exists(db_path):
-                self.DB = sqlite3.connect(db_path, check_same_thread=False)
-                # '''创建游标'''
-                self.cursor = self.DB.cursor()
+                self.pool = ConnectionPool.readonly(db_path)
                 self.open_flag = True
                 if lock.locked():
                     lock.release()
@@ -50,22 +56,41 @@ class Misc:
         '''
         if not self.open_flag:
             self.init_database()
-        try:
-            lock.acquire(True)
-            self.cursor.execute(sql, [userName])
-            result = self.cursor.fetchall()
-            if result:
-                return result[0][0]
-        finally:
-            lock.release()
+        self.cursor.execute(sql, [userName])
+        result = self.cursor.fetchall()
+        if result:
+            return result[0][0]
         return None
 
+    def get_avatar_buffers(self, userNames):
+        """
+        批量查询头像，每 AVATAR_BATCH_SIZE 个一条 IN 查询
+        @param userNames: wxid 列表
+        @return: {wxid: smallHeadBuf}，没有头像的 wxid 不在结果中
+        """
+        result = {}
+        if not self.open_flag:
+            return result
+        userNames = list(dict.fromkeys(userNames))
+        for i in range(0, len(userNames), AVATAR_BATCH_SIZE):
+            batch = userNames[i:i + AVATAR_BATCH_SIZE]
+            sql = f'''
+                select usrName, smallHeadBuf
+                from ContactHeadImg1
+                where usrName in ({','.join('?' * len(batch))});
+            '''
+            self.cursor.execute(sql, batch)
+            for usrName, smallHeadBuf in self.cursor.fetchall():
+                result.setdefault(usrName, smallHeadBuf)
+        return result
+
     def close(self):
         if self.open_flag:
             try:
                 lock.acquire(True)
                 self.open_flag = False
-                self.DB.close()
+                # 保留关闭后的连接池，之后的查询和原来一样报数据库已关闭
+                self.pool.close()
             finally:
                 lock.release()
 
@@ -1,21 +1,92 @@
+import functools
+import heapq
+import inspect
 import os.path
 import random
+import re
 import sqlite3
 import threading
+import time
 import traceback
-from datetime import datetime, date
-from typing import Tuple
+from collections import Counter, OrderedDict
+from datetime import datetime, date, timedelta
+from itertools import chain, islice
+from typing import List, Tuple
 
+from app.DataBase.merge import MSG_STATS_VERSION
+from app.DataBase.pool import ConnectionPool, tune_readonly
 from app.log import logger
-from app.util.compress_content import parser_reply
-from app.util.protocbuf.msg_pb2 import MessageBytesExtra
+from app.util.compress_content import parser_reply, decompress_CompressContent
+from app.util.protocbuf.bytes_extra import get_sender_batch
 
 db_path = "./app/Database/Msg/MSG.db"
 lock = threading.Lock()
+# 用到 BytesExtra/CompressContent/DisplayContent 的消息类型：图片、视频、appmsg(引用、文件、链接、转账等)、通话
+BLOB_MESSAGE_TYPES = {3, 43, 49, 50}
+# 单个联系人的消息(见 Msg.get_messages)中的大字段及其下标
+TALKER_BLOB_COLUMNS = ['BytesExtra', 'CompressContent', 'DisplayContent']
+TALKER_BLOB_INDEXES = [10, 11, 12]
+# 按 localId 补读大字段时每条 SQL 的最大参数个数
+BLOB_FETCH_SIZE = 500
+# 缓存的群聊发送人个数，见 SenderCache
+SENDER_CACHE_SIZE = 4096
+# 联合查询时各分片的 localId 加上 分片序号 << SHARD_LOCAL_ID_SHIFT，保证不重复且和合并后的顺序一致
+SHARD_LOCAL_ID_SHIFT = 32
+
+
+def find_shards(db_dir):
+    """
+    @param db_dir: 数据库目录
+    @return: 目录下解密后未合并的 MSG0.db..MSGn.db，按分片序号排列
+    """
+    if not os.path.isdir(db_dir):
+        return []
+    shards = []
+    for file in os.listdir(db_dir):
+        match = re.match(r'^MSG(\d+)\.db$', file)
+        if match:
+            shards.append((int(match.group(1)), os.path.join(db_dir, file)))
+    return [path for _, path in sorted(shards)]
 
 
 def is_database_exist():
-    return os.path.exists(db_path)
+    return os.path.exists(db_path) or bool(find_shards(os.path.dirname(db_path)))
+
+
+def group_shards(shard_paths):
+    """
+    一个连接最多挂载 SQLITE_LIMIT_ATTACHED 个数据库，分片更多时分成若干组，每组用一个连接联合查询
+    @param shard_paths: 解密后的 MSG0.db..MSGn.db，按分片序号排列
+    @return: [(这一组第一个分片的序号, 这一组的分片), ...]
+    """
+    conn = sqlite3.connect(':memory:')
+    try:
+        limit = conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+    finally:
+        conn.close()
+    return [(start, shard_paths[start:start + limit]) for start in range(0, len(shard_paths), limit)]
+
+
+def connect_shards(shard_paths, start=0):
+    """
+    不合并 MSG 分片，把各分片 ATTACH 到一个内存数据库上，并建立同名的临时视图 MSG (各分片 MSG 表的 UNION ALL)，
+    原来针对 MSG 表的查询不用修改。查询条件会下推到每个分片，仍然可以使用各分片上的索引
+    @param shard_paths: 解密后的 MSG0.db..MSGn.db，按分片序号排列，不超过 SQLite 可挂载的数据库数量上限(见 group_shards)
+    @param start: 第一个分片的序号，分组联合查询时各组的 localId 也不重复
+    @return: sqlite3.Connection
+    """
+    conn = sqlite3.connect(':memory:', check_same_thread=False)
+    selects = []
+    for index, shard_path in enumerate(shard_paths):
+        conn.execute(f"ATTACH DATABASE ? AS shard{index};", [shard_path])
+        columns = [row[1] for row in conn.execute(f"PRAGMA shard{index}.table_info(MSG);")]
+        columns = [
+            f'localId + {(start + index) << SHARD_LOCAL_ID_SHIFT} AS localId' if column == 'localId' else column
+            for column in columns
+        ]
+        selects.append(f"SELECT {','.join(columns)} FROM shard{index}.MSG")
+    conn.execute(f"CREATE TEMP VIEW MSG AS {' UNION ALL '.join(selects)};")
+    return conn
 
 
 def convert_to_timestamp_(time_input) -> int:
@@ -52,10 +123,252 @@ def convert_to_timestamp(time_range) -> Tuple[int, int]:
         return convert_to_timestamp_(time_range[0]), convert_to_timestamp_(time_range[1])
 
 
-def parser_chatroom_message(messages):
-    from app.DataBase import micro_msg_db, misc_db
-    from app.util.protocbuf.msg_pb2 import MessageBytesExtra
-    from app.person import Contact, Me, ContactDefault
+def resolve_time_range(time_range=None, year_='all', month=None, day=None) -> Tuple[int, int]:
+    """
+    把各种时间选择统一转换成本地时间的半开区间 [start, end) 的整数时间戳，
+    查询时写成 CreateTime>=start AND CreateTime<end，可以走 CreateTime 上的索引，不用对每一行调用 strftime
+    @param time_range: (开始时间, 结束时间)，可以是时间戳、'%Y-%m-%d %H:%M:%S' 格式的字符串或 date
+    @param year_: 年份，'all' 表示不限
+    @param month: 月份，需同时给出 year_
+    @param day: 日，需同时给出 year_ 和 month
+    @return: (start, end)，两者都给出时取交集，都没有限制时返回 None
+    """
+    bounds = convert_to_timestamp(time_range) if isinstance(time_range, (tuple, list)) and time_range else None
+    if year_ not in (None, '', 'all'):
+        year_ = int(year_)
+        if month is None:
+            start, end = datetime(year_, 1, 1), datetime(year_ + 1, 1, 1)
+        elif day is None:
+            start, end = datetime(year_, month, 1), datetime(year_ + month // 12, month % 12 + 1, 1)
+        else:
+            start = datetime(year_, month, day)
+            end = start + timedelta(days=1)
+        # datetime.timestamp 按本地时区换算，和 SQL 里的 'localtime' 一致
+        year_bounds = int(start.timestamp()), int(end.timestamp())
+        bounds = (max(bounds[0], year_bounds[0]), min(bounds[1], year_bounds[1])) if bounds else year_bounds
+    return bounds
+
+
+def time_range_sql(time_range=None, year_='all', month=None, day=None, keyword='AND') -> str:
+    """
+    @return: resolve_time_range 得到的时间范围对应的查询条件，如 'AND CreateTime>=1672502400 AND CreateTime<1704038400'，不限时间时为空串
+    """
+    bounds = resolve_time_range(time_range, year_, month, day)
+    return f'{keyword} CreateTime>={bounds[0]} AND CreateTime<{bounds[1]}' if bounds else ''
+
+
+# 时、分、秒的两位数字符串，格式化时间时查表比 f'{x:02d}' 快得多
+_TWO_DIGITS = [f'{i:02d}' for i in range(60)]
+
+
+class LocalTimeFormatter:
+    """
+    把 CreateTime 格式化成本地时间 '%Y-%m-%d %H:%M:%S'，结果和 SQL 里的 strftime(..., 'unixepoch', 'localtime') 相同
+    缓存最近一个本地日的 0 点时间戳(即这一天的 UTC 偏移)和日期，消息按时间顺序读取，同一天的消息只需要整数运算
+    """
+
+    def __init__(self):
+        # (当天 0 点, 次日 0 点, 日期)，整体替换，多个线程共用时不会读到不一致的值
+        self._day = (0, 0, None)
+
+    @staticmethod
+    def _load_day(timestamp):
+        local = time.localtime(timestamp)
+        start = int(time.mktime((local.tm_year, local.tm_mon, local.tm_mday, 0, 0, 0, 0, 0, -1)))
+        end = int(time.mktime((local.tm_year, local.tm_mon, local.tm_mday + 1, 0, 0, 0, 0, 0, -1)))
+        day = time.strftime('%Y-%m-%d', local)
+        # 夏令时切换的那天不是 24 小时，这一天的消息逐条换算
+        if end - start != 86400 or time.localtime(start)[:6] != (local.tm_year, local.tm_mon, local.tm_mday, 0, 0, 0):
+            day = None
+        return start, end, day
+
+    def format(self, timestamp):
+        """
+        @param timestamp: CreateTime
+        @return: '%Y-%m-%d %H:%M:%S'，timestamp 为 None 或超出范围时为 None
+        """
+        if timestamp is None:
+            return None
+        start, end, day = self._day
+        try:
+            if not start <= timestamp < end:
+                start, end, day = self._day = self._load_day(timestamp)
+            if day is None:
+                return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+        except (OverflowError, OSError, ValueError):
+            return None
+        seconds = int(timestamp - start)
+        return f'{day} {_TWO_DIGITS[seconds // 3600]}:{_TWO_DIGITS[seconds // 60 % 60]}:{_TWO_DIGITS[seconds % 60]}'
+
+
+time_formatter = LocalTimeFormatter()
+
+
+def _column(name):
+    def getter(self):
+        index = self.columns.get(name)
+        return None if index is None else self.row[index]
+
+    return property(getter, doc=f'MSG.{name}，查询中没有这一列时为 None')
+
+
+class Message:
+    """
+    一条聊天记录，由游标的 row_factory 直接把 SQLite 返回的行包装成它，不再复制成 list 再转回 tuple
+    仍然可以按下标访问，message[0]..message[12] 的含义见 Msg.get_messages，群聊消息的 message[13] 是 sender；
+    也可以按名字访问，CompressContent 解压后的 xml 在第一次访问 compress_xml 时才解压；
+    查询时 StrTime 列为 NULL，访问 str_time (或 message[8]) 时才由 time_formatter 格式化 CreateTime
+    """
+    __slots__ = ('row', 'columns', 'sender', '_compress_xml')
+
+    local_id = _column('localId')
+    talker_id = _column('TalkerId')
+    type = _column('Type')
+    sub_type = _column('SubType')
+    is_sender = _column('IsSender')
+    create_time = _column('CreateTime')
+    status = _column('Status')
+    str_content = _column('StrContent')
+    msg_svr_id = _column('MsgSvrID')
+    bytes_extra = _column('BytesExtra')
+    compress_content = _column('CompressContent')
+    display_content = _column('DisplayContent')
+    str_talker = _column('StrTalker')
+
+    def __init__(self, row, columns):
+        """
+        @param row: 查询得到的一行
+        @param columns: {列名: 下标}，同一次查询的所有消息共用一个
+        """
+        self.row = row
+        self.columns = columns
+        self.sender = None  # 群聊消息的发送人，Contact、ContactDefault 或 Me，由 parser_chatroom_message 填上
+        self._compress_xml = None
+
+    @staticmethod
+    def row_factory(cursor):
+        """
+        @param cursor: 已经执行了查询的游标
+        @return: 设置给 cursor.row_factory 的函数，之后取出的每一行都是 Message
+        """
+        columns = {description[0]: index for index, description in enumerate(cursor.description)}
+        return lambda _, row: Message(row, columns)
+
+    @property
+    def str_time(self) -> str:
+        index = self.columns.get('StrTime')
+        value = None if index is None else self.row[index]
+        return time_formatter.format(self.create_time) if value is None else value
+
+    @property
+    def compress_xml(self) -> str:
+        if self._compress_xml is None:
+            self._compress_xml = decompress_CompressContent(self.compress_content)
+        return self._compress_xml
+
+    def set_columns(self, indexes, values):
+        """
+        补上分页查询时没有读取的列
+        """
+        row = list(self.row)
+        for index, value in zip(indexes, values):
+            row[index] = value
+        self.row = tuple(row)
+        self._compress_xml = None
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self)[index]
+        if self.sender is not None:
+            if index < 0:
+                index += len(self.row) + 1
+            if index == len(self.row):
+                return self.sender
+        value = self.row[index]
+        if value is None and index % len(self.row) == self.columns.get('StrTime'):
+            return self.str_time
+        return value
+
+    def __len__(self):
+        return len(self.row) + (self.sender is not None)
+
+    def __iter__(self):
+        str_time_index = self.columns.get('StrTime')
+        for index, value in enumerate(self.row):
+            yield self.str_time if value is None and index == str_time_index else value
+        if self.sender is not None:
+            yield self.sender
+
+    def __repr__(self):
+        return f'Message{tuple(self)!r}'
+
+
+class SenderCache:
+    """
+    群聊消息发送人的 Contact 缓存，同一个 wxid 共用一个 Contact，联系人信息和头像只在第一次出现时查询，
+    一批消息中未缓存的发送人合并成 MicroMsg、Misc 上各一条 IN 查询，超过 maxsize 后淘汰最久未用的
+    """
+
+    def __init__(self, maxsize=SENDER_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._contacts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, wxids) -> dict:
+        """
+        @param wxids: 发送人 wxid，可以重复
+        @return: {wxid: Contact 或 ContactDefault}
+        """
+        from app.DataBase import micro_msg_db, misc_db
+        from app.person import Contact, ContactDefault
+        result = {}
+        missing = []
+        with self._lock:
+            for wxid in dict.fromkeys(wxids):
+                contact = self._contacts.get(wxid)
+                if contact is None:
+                    missing.append(wxid)
+                else:
+                    self._contacts.move_to_end(wxid)
+                    result[wxid] = contact
+        if not missing:
+            return result
+        contact_info_lists = micro_msg_db.get_contacts_by_usernames([wxid for wxid in missing if wxid])
+        avatars = misc_db.get_avatar_buffers(list(contact_info_lists))
+        for wxid in missing:
+            contact_info_list = contact_info_lists.get(wxid)
+            if contact_info_list is None:  # 系统消息没有 wxid，群聊中已退群的联系人不会保存在数据库里
+                result[wxid] = ContactDefault(wxid)
+                continue
+            contact_info = {
+                'UserName': contact_info_list[0],
+                'Alias': contact_info_list[1],
+                'Type': contact_info_list[2],
+                'Remark': contact_info_list[3],
+                'NickName': contact_info_list[4],
+                'smallHeadImgUrl': contact_info_list[7]
+            }
+            contact = Contact(contact_info)
+            contact.smallHeadImgBLOG = avatars.get(wxid)
+            contact.set_avatar(contact.smallHeadImgBLOG)
+            result[wxid] = contact
+        with self._lock:
+            for wxid in missing:
+                self._contacts[wxid] = result[wxid]
+            while len(self._contacts) > self.maxsize:
+                self._contacts.popitem(last=False)
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._contacts.clear()
+
+
+sender_cache = SenderCache()
+
+
+def parser_chatroom_message(messages, senders=None):
+    from app.person import Me
     '''
     获取一个群聊的聊天记录
     return list
@@ -73,51 +386,19 @@ def parser_chatroom_message(messages):
         a[11]: CompressContent,
         a[12]: DisplayContent,
         a[13]: msg_sender, （ContactPC 或 ContactDefault 类型，这个才是群聊里的信息发送人，不是群聊或者自己是发送者没有这个字段）
+    @param messages: Message 列表，发送人直接填到 Message.sender，不复制消息
+    @param senders: Msg.get_senders 得到的发送人，没有给出时解析 BytesExtra
     '''
-    updated_messages = []  # 用于存储修改后的消息列表
-    for row in messages:
-        message = list(row)
-        if message[4] == 1:  # 自己发送的就没必要解析了
-            message.append(Me())
-            updated_messages.append(tuple(message))
-            continue
-        if message[10] is None:  # BytesExtra是空的跳过
-            message.append(ContactDefault(wxid))
-            updated_messages.append(tuple(message))
-            continue
-        msgbytes = MessageBytesExtra()
-        msgbytes.ParseFromString(message[10])
-        wxid = ''
-        for tmp in msgbytes.message2:
-            if tmp.field1 != 1:
-                continue
-            wxid = tmp.field2
-        if wxid == "":  # 系统消息里面 wxid 不存在
-            message.append(ContactDefault(wxid))
-            updated_messages.append(tuple(message))
-            continue
-        # todo 解析还是有问题，会出现这种带:的东西
-        if ':' in wxid:  # wxid_ewi8gfgpp0eu22:25319:1
-            wxid = wxid.split(':')[0]
-        contact_info_list = micro_msg_db.get_contact_by_username(wxid)
-        if contact_info_list is None:  # 群聊中已退群的联系人不会保存在数据库里
-            message.append(ContactDefault(wxid))
-            updated_messages.append(tuple(message))
-            continue
-        contact_info = {
-            'UserName': contact_info_list[0],
-            'Alias': contact_info_list[1],
-            'Type': contact_info_list[2],
-            'Remark': contact_info_list[3],
-            'NickName': contact_info_list[4],
-            'smallHeadImgUrl': contact_info_list[7]
-        }
-        contact = Contact(contact_info)
-        contact.smallHeadImgBLOG = misc_db.get_avatar_buffer(contact.wxid)
-        contact.set_avatar(contact.smallHeadImgBLOG)
-        message.append(contact)
-        updated_messages.append(tuple(message))
-    return updated_messages
+    if senders is None:
+        received = [row for row in messages if row[4] != 1]
+        senders = dict(zip([row[0] for row in received], get_sender_batch([row[10] for row in received])))
+    # 自己发送的就没必要解析了，BytesExtra 是空的发送人为空串
+    wxids = [None if row[4] == 1 else senders.get(row[0]) or '' for row in messages]
+    contacts = sender_cache.get_many(wxid for wxid in wxids if wxid is not None)
+    me = Me()
+    for message, wxid in zip(messages, wxids):
+        message.sender = me if wxid is None else contacts[wxid]
+    return messages
 
 
 def singleton(cls):
@@ -131,6 +412,155 @@ def singleton(cls):
     return inner
 
 
+def federated(combine):
+    """
+    MSG 分片分成多组联合查询时(见 group_shards)，被装饰的方法在每一组上各执行一次，
+    再用 combine(各组的结果, 调用参数) 合并成与查询合并后的 MSG.db 相同的结果；只有一组或数据库已关闭时直接调用。
+    生成器方法的各组结果是各组的生成器
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if not self.open_flag or len(self.pools) < 2 or getattr(self._local, 'group', None) is not None:
+                return func(self, *args, **kwargs)
+            arguments = signature.bind(self, *args, **kwargs)
+            arguments.apply_defaults()
+            if inspect.isgeneratorfunction(func):
+                results = [self._iter_group(group, func(self, *args, **kwargs)) for group in range(len(self.pools))]
+            else:
+                results = [self._call_group(group, func, *args, **kwargs) for group in range(len(self.pools))]
+            return combine([result for result in results if result is not None], arguments.arguments)
+
+        return wrapper
+
+    return decorator
+
+
+def _message_key(message):
+    return message[5], message[0]
+
+
+def _concat_messages(results, arguments):
+    # localId 已按分片序号偏移，和合并后的 MSG.db 中的先后顺序一致
+    return sorted(chain.from_iterable(results), key=_message_key)
+
+
+def _merge_message_batches(results, arguments):
+    batch_size = arguments['batch_size']
+    messages = heapq.merge(*(chain.from_iterable(result) for result in results), key=_message_key)
+    while True:
+        batch = list(islice(messages, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def _concat_results(results, arguments):
+    return list(chain.from_iterable(results))
+
+
+def _sum_results(results, arguments):
+    return sum(result or 0 for result in results)
+
+
+def _sum_by_key(results):
+    """
+    @param results: 各组 group by 的结果 [(键..., 条数), ...]
+    @return: Counter {键: 各组条数之和}
+    """
+    counter = Counter()
+    for result in results:
+        for *key, num in result:
+            counter[tuple(key)] += num
+    return counter
+
+
+def _sum_sorted_by_key(results, arguments):
+    return [(*key, num) for key, num in sorted(_sum_by_key(results).items())]
+
+
+def _sum_sorted_by_count(results, arguments):
+    return [(*key, num) for key, num in _sum_by_key(results).most_common(arguments.get('top_n'))]
+
+
+def _union_sorted(results, arguments):
+    return sorted(set(chain.from_iterable(results)))
+
+
+def _newest_messages(results, arguments):
+    return heapq.nlargest(20, chain.from_iterable(results), key=_message_key)
+
+
+def _earliest_message(results, arguments):
+    # (StrContent, StrTime)，各组按分片顺序排列，时间相同时取前面的
+    return min(results, key=lambda result: result[1], default=None)
+
+
+def _concat_keyword_messages(results, arguments):
+    return sorted(chain.from_iterable(results), key=lambda message: message[2], reverse=True)
+
+
+def _latest_night_messages(results, arguments):
+    return heapq.nlargest(20, chain.from_iterable(results), key=lambda message: message[3])
+
+
+def _merge_statistics(results, arguments):
+    """
+    合并各组的 Msg._count_statistics
+    """
+    merged = {
+        'message_num': 0,
+        'send_num': 0,
+        'send_length': 0,
+        'message_length': 0,
+        'type_number': Counter(),
+        'send_type_number': Counter(),
+        'send_number_by_hour': Counter(),
+        'number_by_hour': Counter(),
+        'first': None,
+        'first_time': None,
+        'night_messages': [],
+    }
+    for result in results:
+        for key in ('message_num', 'send_num', 'send_length', 'message_length'):
+            merged[key] += result[key]
+        for key in ('type_number', 'send_type_number', 'send_number_by_hour', 'number_by_hour'):
+            merged[key].update(result[key])
+        if result['first'] and (merged['first'] is None or result['first'] < merged['first']):
+            merged['first'], merged['first_time'] = result['first'], result['first_time']
+        merged['night_messages'] += result['night_messages']
+    return merged
+
+
+def _merge_first_found(results, arguments):
+    # 靠前的组 localId 更小，{localId: ...} 中同一个 localId 以先找到的为准
+    merged = {}
+    for result in results:
+        for key, value in result.items():
+            merged.setdefault(key, value)
+    return merged
+
+
+def _sum_talker_summaries(results, arguments):
+    merged = {}
+    for result in results:
+        for talker, (msg_count, text_length) in result.items():
+            count0, length0 = merged.get(talker, (0, 0))
+            merged[talker] = (count0 + msg_count, length0 + text_length)
+    return merged
+
+
+def _merge_last_times(results, arguments):
+    merged = {}
+    for result in results:
+        for talker, last_time in result.items():
+            merged[talker] = max(last_time, merged.get(talker, last_time))
+    return merged
+
+
 class MsgType:
     TEXT = 1
     IMAGE = 3
@@ -139,50 +569,169 @@ class MsgType:
 
 class Msg:
     def __init__(self):
-        self.DB = None
-        self.cursor = None
+        # 每组分片一个连接池，打开 MSG.db 或分片不超过可挂载上限时只有一个
+        self.pools: List[ConnectionPool] = []
+        # group: 当前线程正在查询的分片组，见 federated
+        self._local = threading.local()
         self.open_flag = False
+        self.stats_ready = False
         self.init_database()
 
-    def init_database(self, path=None):
+    @property
+    def pool(self) -> ConnectionPool:
+        """
+        当前线程正在查询的那一组分片的连接池
+        """
+        return self.pools[getattr(self._local, 'group', None) or 0]
+
+    @property
+    def cursor(self) -> sqlite3.Cursor:
+        """
+        当前线程自己的游标，见 ConnectionPool
+        """
+        return self.pool.cursor()
+
+    def _call_group(self, group, func, *args, **kwargs):
+        """
+        在第 group 组分片上执行 func
+        """
+        self._local.group = group
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            self._local.group = None
+
+    def _iter_group(self, group, generator):
+        """
+        在第 group 组分片上逐批执行生成器 generator
+        """
+        while True:
+            self._local.group = group
+            try:
+                batch = next(generator, None)
+            finally:
+                self._local.group = None
+            if batch is None:
+                return
+            yield batch
+
+    def init_database(self, path=None, shard_paths=None):
+        """
+        @param path: 数据库路径，也可以是已打开的 sqlite3.Connection (如 decrypt_to_connection 得到的内存数据库)
+        @param shard_paths: 未合并的 MSG0.db..MSGn.db，给出时通过 connect_shards 联合查询各分片；
+                            没有给出且合并后的 MSG.db 不存在时，使用其所在目录下的分片
+        """
         global db_path
         if not self.open_flag:
-            if path:
+            if path and not isinstance(path, sqlite3.Connection):
                 db_path = path
-            if os.path.exists(db_path):
-                self.DB = sqlite3.connect(db_path, check_same_thread=False)
-                # '''创建游标'''
-                self.cursor = self.DB.cursor()
+            if shard_paths is None and not path and not os.path.exists(db_path):
+                shard_paths = find_shards(os.path.dirname(db_path))
+            pools = []
+            if shard_paths:
+                # 每个线程各自挂载一遍分片，超过可挂载上限时分组，查询方法由 federated 在各组上执行后合并结果
+                pools = [
+                    ConnectionPool(lambda paths=paths, start=start: tune_readonly(connect_shards(paths, start)))
+                    for start, paths in group_shards(shard_paths)
+                ]
+            elif isinstance(path, sqlite3.Connection):
+                pools = [ConnectionPool.shared(path)]
+            if not pools and os.path.exists(db_path):
+                pools = [ConnectionPool.readonly(db_path)]
+            if pools:
+                self.pools = pools
                 self.open_flag = True
+                self.stats_ready = self._stats_available()
                 if lock.locked():
                     lock.release()
 
+    def _fetch_messages(self, sql, params=()):
+        """
+        @return: 查询结果，每一行都是 Message
+        """
+        # 当前线程共用的 self.cursor 还要执行别的查询，单独开一个游标设置 row_factory
+        cursor = self.pool.connection().cursor()
+        try:
+            cursor.execute(sql, params)
+            cursor.row_factory = Message.row_factory(cursor)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def _stats_available(self):
+        """
+        MsgStats 由 build_msg_stats 汇总到最新时才使用，联合查询分片、旧版本生成的 MSG.db 等情况下仍直接统计 MSG
+        """
+        try:
+            state = self.cursor.execute("SELECT Version, TimeZone, MaxRowId FROM main.MsgStatsState;").fetchone()
+            max_rowid = self.cursor.execute("SELECT max(rowid) FROM MSG;").fetchone()[0] or 0
+        except sqlite3.DatabaseError:
+            return False
+        return state == (MSG_STATS_VERSION, time.timezone, max_rowid)
+
+    def _stats_time_sql(self, time_range=None, year_='all'):
+        """
+        MsgStats 按小时汇总，时间范围的起止都是整点时才能由它得到准确的结果
+        @return: MsgStats 上的时间条件，不限时间时为空串，不能使用 MsgStats 时返回 None
+        """
+        if not self.stats_ready:
+            return None
+        bounds = resolve_time_range(time_range, year_)
+        if not bounds:
+            return ''
+        try:
+            if any(datetime.fromtimestamp(t).minute or datetime.fromtimestamp(t).second for t in bounds):
+                return None
+        except (OverflowError, OSError, ValueError):
+            return None
+        return f'AND HourStart>={bounds[0]} AND HourStart<{bounds[1]}'
+
+    def get_senders(self, messages, username_=None):
+        """
+        别人发的消息的发送人，先从 MsgSender 中按群聊和这批消息的 localId 范围读取，MsgSender 中没有的再解析 BytesExtra
+        @param messages: get_messages/get_messages_all 格式的消息
+        @param username_: 这批消息所属的群聊，为空时按每条消息的 StrTalker 分组
+        @return: {localId: wxid}，只包含别人发的消息，BytesExtra 为空时 wxid 为 None
+        """
+        received = [message for message in messages if message[4] != 1]
+        senders = {}
+        if self.stats_ready and received:
+            talkers = {}  # 群聊 -> 这批消息中别人发的消息的 localId
+            for message in received:
+                talker = username_ or (message.str_talker if isinstance(message, Message) else None)
+                talkers.setdefault(talker, set()).add(message[0])
+            for talker, local_ids in talkers.items():
+                # MsgSender 上有 (StrTalker, localId) 索引，只读取这个群聊在该范围内的行
+                sql = f'''
+                    SELECT localId, Sender
+                    FROM MsgSender
+                    WHERE {'StrTalker = ? AND' if talker else ''} localId BETWEEN ? AND ?
+                '''
+                self.cursor.execute(sql, ([talker] if talker else []) + [min(local_ids), max(local_ids)])
+                senders.update(
+                    (local_id, sender) for local_id, sender in self.cursor.fetchall() if local_id in local_ids
+                )
+        missing = [message for message in received if message[0] not in senders]
+        senders.update(zip(
+            [message[0] for message in missing],
+            get_sender_batch([message[10] for message in missing])
+        ))
+        return senders
+
     def add_sender(self, messages):
         """
         @param messages:
-        @return:
+        @return: 每条消息末尾加上发送人 wxid，自己发的为空串
         """
-        new_messages = []
-        for message in messages:
-            is_sender = message[4]
-            wxid = ''
-            if is_sender:
-                pass
-            else:
-                msgbytes = MessageBytesExtra()
-                msgbytes.ParseFromString(message[10])
-                for tmp in msgbytes.message2:
-                    if tmp.field1 != 1:
-                        continue
-                    wxid = tmp.field2
-            new_message = (*message, wxid)
-            new_messages.append(new_message)
-        return new_messages
+        senders = self.get_senders(messages)
+        return [(*message, senders.get(message[0]) or '') for message in messages]
 
+    @federated(_concat_messages)
     def get_messages(
             self,
             username_,
             time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+            lazy_blobs=True,
     ):
         """
         return list
@@ -200,48 +749,176 @@ class Msg:
             a[11]: CompressContent,
             a[12]: DisplayContent,
             a[13]: 联系人的类（如果是群聊就有，不是的话没有这个字段）
+            每条消息是一个 Message，也可以按名字访问这些字段，a[13] 即 Message.sender
+        @param lazy_blobs: 同 iter_messages，查询时不读取大字段，只为需要的消息按 localId 批量补上
         """
         if not self.open_flag:
             return None
-        if time_range:
-            start_time, end_time = convert_to_timestamp(time_range)
+        time_sql = time_range_sql(time_range)
         sql = f'''
-            select localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,MsgSvrID,BytesExtra,CompressContent,DisplayContent
+            select localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,StrContent,NULL as StrTime,MsgSvrID,
+                {self._blob_columns_sql(lazy_blobs)}
             from MSG
             where StrTalker=?
-            {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
+            {time_sql}
             order by CreateTime
         '''
-        try:
-            lock.acquire(True)
-            self.cursor.execute(sql, [username_])
-            result = self.cursor.fetchall()
-        finally:
-            lock.release()
-        return parser_chatroom_message(result) if username_.__contains__('@chatroom') else result
+        result = self._fetch_messages(sql, [username_])
+        if lazy_blobs:
+            self._load_blobs(result, username_, TALKER_BLOB_COLUMNS, TALKER_BLOB_INDEXES)
+        return parser_chatroom_message(result, self.get_senders(result, username_)) if username_.__contains__('@chatroom') else result
         # result.sort(key=lambda x: x[5])
         # return self.add_sender(result)
 
+    @federated(_concat_messages)
     def get_messages_all(self,time_range=None):
-        if time_range:
-            start_time, end_time = convert_to_timestamp(time_range)
+        time_sql = time_range_sql(time_range, keyword='WHERE')
         sql = f'''
-            select localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,MsgSvrID,BytesExtra,StrTalker,Reserved1,CompressContent
+            select localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,StrContent,NULL as StrTime,MsgSvrID,BytesExtra,StrTalker,Reserved1,CompressContent
             from MSG
-            {'WHERE CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
+            {time_sql}
             order by CreateTime
         '''
         if not self.open_flag:
             return None
-        try:
-            lock.acquire(True)
-            self.cursor.execute(sql)
-            result = self.cursor.fetchall()
-        finally:
-            lock.release()
+        result = self._fetch_messages(sql)
         result.sort(key=lambda x: x[5])
         return result
 
+    @staticmethod
+    def _messages_filter(username_=None, time_range=None, types=None):
+        """
+        @return: iter_messages 和 count_messages 共用的 where 条件及参数
+        """
+        conditions = []
+        params = []
+        if username_:
+            conditions.append('StrTalker=?')
+            params.append(username_)
+        bounds = resolve_time_range(time_range)
+        if bounds:
+            conditions.append('CreateTime>=? AND CreateTime<?')
+            params += list(bounds)
+        if types:
+            conditions.append(f"Type IN ({','.join('?' * len(types))})")
+            params += list(types)
+        return conditions, params
+
+    @federated(_merge_message_batches)
+    def iter_messages(self, username_=None, time_range=None, types=None, batch_size=1000, lazy_blobs=True):
+        """
+        按 (CreateTime, localId) 键集分页逐批读取聊天记录，每批都是一次索引范围扫描，
+        内存占用只和 batch_size 有关，导出时第一批消息马上就能写出去
+        @param username_: 联系人wxid，每条消息的字段同 get_messages；为空时读取所有人的消息，字段同 get_messages_all
+        @param time_range: 时间范围
+        @param types: 只读取这些类型的消息，None 为全部类型
+        @param batch_size: 每批的消息数
+        @param lazy_blobs: 分页查询不读取 BytesExtra/CompressContent/DisplayContent，
+                           只为 BLOB_MESSAGE_TYPES 类型的消息和群聊里别人发的消息(没有 MsgSender 时解析发送人)按 localId 批量补上，
+                           其余消息这几列为 None
+        @return: 生成器，每次产出一批消息(Message 的 list)
+        """
+        if not self.open_flag:
+            return
+        blob_columns = ['BytesExtra', 'CompressContent', 'DisplayContent'] if username_ else ['BytesExtra', 'CompressContent']
+        columns = [
+            'localId', 'TalkerId', 'Type', 'SubType', 'IsSender', 'CreateTime', 'Status', 'StrContent',
+            'NULL as StrTime', 'MsgSvrID', 'BytesExtra',
+            *(['CompressContent', 'DisplayContent'] if username_ else ['StrTalker', 'Reserved1', 'CompressContent'])
+        ]
+        blob_indexes = [columns.index(column) for column in blob_columns]
+        if lazy_blobs:
+            columns = [f'NULL as {column}' if column in blob_columns else column for column in columns]
+        conditions, params = self._messages_filter(username_, time_range, types)
+        conditions.append('(CreateTime, localId) > (?, ?)')
+        sql = f'''
+            select {','.join(columns)}
+            from MSG
+            where {' AND '.join(conditions)}
+            order by CreateTime, localId
+            limit ?
+        '''
+        last_key = (-1, -1)
+        while True:
+            # 每批都 fetchall 取完再交出去，调用方在两批之间用同一个线程查询别的数据不受影响
+            result = self._fetch_messages(sql, [*params, *last_key, batch_size])
+            if not result:
+                return
+            last_key = (result[-1][5], result[-1][0])
+            if lazy_blobs:
+                self._load_blobs(result, username_, blob_columns, blob_indexes)
+            if username_ and username_.__contains__('@chatroom'):
+                result = parser_chatroom_message(result, self.get_senders(result, username_))
+            yield result
+            if len(result) < batch_size:
+                return
+
+    @staticmethod
+    def _blob_columns_sql(lazy_blobs):
+        """
+        @return: get_messages 等查询中大字段的列，lazy_blobs 时为 NULL
+        """
+        if lazy_blobs:
+            return ','.join(f'NULL as {column}' for column in TALKER_BLOB_COLUMNS)
+        return ','.join(TALKER_BLOB_COLUMNS)
+
+    def _load_blobs(self, result, username_, blob_columns, blob_indexes):
+        """
+        为查询时没有读取大字段的消息补上需要的大字段：BLOB_MESSAGE_TYPES 类型的消息，
+        以及没有 MsgSender 时群聊里别人发的消息(解析发送人要用 BytesExtra)
+        @param username_: 联系人wxid，为空时 result 是 get_messages_all 格式，按每条消息的 StrTalker 判断群聊
+        """
+        # 有 MsgSender 时群聊消息的发送人不用再解析 BytesExtra
+        if self.stats_ready:
+            need_blobs = [message for message in result if message[2] in BLOB_MESSAGE_TYPES]
+        elif username_:
+            is_chatroom = username_.__contains__('@chatroom')
+            need_blobs = [message for message in result if message[2] in BLOB_MESSAGE_TYPES or (
+                    is_chatroom and not message[4])]
+        else:
+            need_blobs = [message for message in result if message[2] in BLOB_MESSAGE_TYPES or (
+                    not message[4] and message[11].__contains__('@chatroom'))]
+        self._fill_blobs(need_blobs, blob_columns, blob_indexes)
+
+    def _fill_blobs(self, need_blobs, blob_columns, blob_indexes):
+        """
+        按 localId 批量读取 need_blobs 中消息的大字段，直接填回这些 Message
+        条件里带上这一批的 CreateTime 范围，联合查询分片时也能走各分片的 CreateTime 索引
+        """
+        if not need_blobs:
+            return
+        blobs = {}
+        for i in range(0, len(need_blobs), BLOB_FETCH_SIZE):
+            chunk = need_blobs[i:i + BLOB_FETCH_SIZE]
+            sql = f'''
+                select localId,{','.join(blob_columns)}
+                from MSG
+                where CreateTime>=? AND CreateTime<=? AND localId IN ({','.join('?' * len(chunk))})
+            '''
+            self.cursor.execute(sql, [chunk[0][5], chunk[-1][5], *[message[0] for message in chunk]])
+            blobs.update((row[0], row[1:]) for row in self.cursor.fetchall())
+        for message in need_blobs:
+            values = blobs.get(message[0])
+            if values is not None:
+                message.set_columns(blob_indexes, values)
+
+    @federated(_sum_results)
+    def count_messages(self, username_=None, time_range=None, types=None) -> int:
+        """
+        @return: iter_messages 相同条件下的消息总数，用于显示进度
+        """
+        if not self.open_flag:
+            return 0
+        conditions, params = self._messages_filter(username_, time_range, types)
+        sql = f'''
+            select count(*)
+            from MSG
+            {'where ' + ' AND '.join(conditions) if conditions else ''}
+        '''
+        self.cursor.execute(sql, params)
+        return self.cursor.fetchone()[0]
+
+    @federated(_sum_results)
     def get_messages_length(self):
         sql = '''
             select count(*)
@@ -251,18 +928,16 @@ class Msg:
         if not self.open_flag:
             return None
         try:
-            lock.acquire(True)
             self.cursor.execute(sql)
             result = self.cursor.fetchone()
         except Exception as e:
             result = None
-        finally:
-            lock.release()
         return result[0]
 
+    @federated(_newest_messages)
     def get_message_by_num(self, username_, local_id):
         sql = '''
-                select localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,MsgSvrID,BytesExtra,CompressContent,DisplayContent
+                select localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,StrContent,NULL as StrTime,MsgSvrID,BytesExtra,CompressContent,DisplayContent
                 from MSG
                 where StrTalker = ? and localId < ? and (Type=1 or Type=3)
                 order by CreateTime desc 
@@ -272,133 +947,142 @@ class Msg:
         if not self.open_flag:
             return None
         try:
-            lock.acquire(True)
-            self.cursor.execute(sql, [username_, local_id])
-            result = self.cursor.fetchall()
+            result = self._fetch_messages(sql, [username_, local_id])
         except sqlite3.DatabaseError:
             logger.error(f'{traceback.format_exc()}\n数据库损坏请删除msg文件夹重试')
-        finally:
-            lock.release()
         # result.sort(key=lambda x: x[5])
-        return parser_chatroom_message(result) if username_.__contains__('@chatroom') else result
+        return parser_chatroom_message(result, self.get_senders(result, username_)) if username_.__contains__('@chatroom') else result
 
+    @federated(_concat_messages)
     def get_messages_by_type(
             self,
             username_,
             type_,
             year_='all',
             time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+            lazy_blobs=True,
     ):
         """
         @param username_:
         @param type_:
         @param year_:
         @param time_range: Tuple(timestamp:开始时间戳,timestamp:结束时间戳)
+        @param lazy_blobs: 不读取大字段(为 None)，type_ 在 BLOB_MESSAGE_TYPES 中时每条消息都要用到大字段，仍然直接读取
         @return:
         """
         if not self.open_flag:
             return None
-        if time_range:
-            start_time, end_time = convert_to_timestamp(time_range)
-        if year_ == 'all':
-            sql = f'''
-                        select localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,MsgSvrID,BytesExtra,CompressContent,DisplayContent
-                        from MSG
-                        where StrTalker=? and Type=? 
-                        {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
-                        order by CreateTime
-                    '''
-            try:
-                lock.acquire(True)
-                self.cursor.execute(sql, [username_, type_])
-                result = self.cursor.fetchall()
-            finally:
-                lock.release()
-        else:
-            sql = '''
-                select localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,MsgSvrID,BytesExtra,CompressContent,DisplayContent
-                from MSG
-                where StrTalker=? and Type=? and strftime('%Y', CreateTime, 'unixepoch', 'localtime') = ?
-                order by CreateTime
-             '''
-            try:
-                lock.acquire(True)
-                self.cursor.execute(sql, [username_, type_, year_])
-            finally:
-                lock.release()
-                result = self.cursor.fetchall()
+        lazy_blobs = lazy_blobs and type_ not in BLOB_MESSAGE_TYPES
+        time_sql = time_range_sql(time_range, year_)
+        sql = f'''
+            select localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,StrContent,NULL as StrTime,MsgSvrID,
+                {self._blob_columns_sql(lazy_blobs)}
+            from MSG
+            where StrTalker=? and Type=?
+            {time_sql}
+            order by CreateTime
+        '''
+        result = self._fetch_messages(sql, [username_, type_])
         return result
 
     def get_messages_by_keyword(self, username_, keyword, num=5, max_len=10,time_range=None, year_='all'):
+        """
+        返回值为一个列表，每个列表元素是一个对话
+        每个对话是一个元组数据
+        ('is_send','时间戳','以关键词为分割符的消息内容','格式化时间')
+        """
         if not self.open_flag:
             return None
-        if time_range:
-            start_time, end_time = convert_to_timestamp(time_range)
+        return self.get_messages_by_keywords(username_, [keyword], num, max_len, time_range, year_)[keyword]
+
+    def get_messages_by_keywords(self, username_, keywords, num=5, max_len=10, time_range=None, year_='all'):
+        """
+        批量获取多个关键词所在的对话：一次查询找出包含任一关键词的短文本消息，每个关键词随机取 num 条，
+        再用一次查询取出每条消息之后对方发的第一条文本消息
+        @param keywords: 关键词列表
+        @param num: 每个关键词的对话数
+        @param max_len: 只取长度小于 max_len 的消息
+        @return: {关键词: 对话列表}，对话的格式见 get_messages_by_keyword
+        """
+        res = {keyword: [] for keyword in keywords}
+        if not self.open_flag or not keywords:
+            return res
+        hits = {keyword: [] for keyword in keywords}
+        for message in self._get_keyword_messages(username_, keywords, max_len, time_range, year_):
+            content = message[3].lower()
+            for keyword in keywords:
+                # 与 like 一样不区分大小写
+                if keyword.lower() in content:
+                    hits[keyword].append(message)
+        for keyword, messages in hits.items():
+            if len(messages) > 5:
+                hits[keyword] = random.sample(messages, num)
+        replies = self._get_replies(username_, {(msg[0], msg[1]) for messages in hits.values() for msg in messages})
+        for keyword, messages in hits.items():
+            for msg1 in messages:
+                msg2 = replies.get(msg1[0])
+                if msg2 is None:
+                    res[keyword].append((
+                        ('', '', ['', ''], ''),
+                        ('', '', '', '')
+                    ))
+                else:
+                    res[keyword].append((
+                        (msg1[1], msg1[2], msg1[3].split(keyword), time_formatter.format(msg1[2])),
+                        msg2
+                    ))
+        return res
+
+    @federated(_concat_keyword_messages)
+    def _get_keyword_messages(self, username_, keywords, max_len, time_range, year_):
+        """
+        @return: 包含任一关键词的短文本消息 [(localId, IsSender, CreateTime, StrContent), ...]，按时间倒序
+        """
+        time_sql = time_range_sql(time_range, year_)
         sql = f'''
-            select localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,MsgSvrID,BytesExtra
+            select localId,IsSender,CreateTime,StrContent
             from MSG
-            where StrTalker=? and Type=1 and LENGTH(StrContent)<? and StrContent like ?
-            {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
+            where StrTalker=? and Type=1 and LENGTH(StrContent)<? and ({' or '.join(['StrContent like ?'] * len(keywords))})
+            {time_sql}
             order by CreateTime desc
         '''
-        temp = []
-        try:
-            lock.acquire(True)
-            self.cursor.execute(sql, [username_, max_len, f'%{keyword}%'] if year_ == "all" else [username_, max_len,
-                                                                                                  f'%{keyword}%',
-                                                                                                  year_])
-            messages = self.cursor.fetchall()
-        finally:
-            lock.release()
-        if len(messages) > 5:
-            messages = random.sample(messages, num)
-        try:
-            lock.acquire(True)
-            for msg in messages:
-                local_id = msg[0]
-                is_send = msg[4]
-                sql = '''
-                    select localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,MsgSvrID
-                    from MSG
-                    where localId > ? and StrTalker=? and Type=1 and IsSender=?
-                    limit 1
-                '''
-                self.cursor.execute(sql, [local_id, username_, 1 - is_send])
-                temp.append((msg, self.cursor.fetchone()))
-        finally:
-            lock.release()
-        res = []
-        for dialog in temp:
-            msg1 = dialog[0]
-            msg2 = dialog[1]
-            try:
-                res.append((
-                    (msg1[4], msg1[5], msg1[7].split(keyword), msg1[8]),
-                    (msg2[4], msg2[5], msg2[7], msg2[8])
-                ))
-            except TypeError:
-                res.append((
-                    ('', '', ['', ''], ''),
-                    ('', '', '', '')
-                ))
+        self.cursor.execute(sql, [username_, max_len] + [f'%{keyword}%' for keyword in keywords])
+        return self.cursor.fetchall()
+
+    @federated(_merge_first_found)
+    def _get_replies(self, username_, messages):
         """
-        返回值为一个列表，每个列表元素是一个对话
-        每个对话是一个元组数据
-        ('is_send','时间戳','以关键词为分割符的消息内容','格式化时间')
+        一次查询取出每条消息之后对方发的第一条文本消息
+        @param messages: [(localId, IsSender), ...]
+        @return: {localId: (IsSender, CreateTime, StrContent, StrTime)}
         """
-        return res
+        messages = list(messages)
+        result = {}
+        # 每条消息占用两个参数
+        for i in range(0, len(messages), BLOB_FETCH_SIZE // 2):
+            batch = messages[i:i + BLOB_FETCH_SIZE // 2]
+            sql = f'''
+                WITH hits(localId, IsSender) AS (VALUES {','.join(['(?,?)'] * len(batch))})
+                SELECT hits.localId, MSG.IsSender, MSG.CreateTime, MSG.StrContent
+                FROM hits
+                JOIN MSG ON MSG.localId = (
+                    SELECT localId
+                    FROM MSG
+                    WHERE localId > hits.localId AND StrTalker=? AND Type=1 AND IsSender=1 - hits.IsSender
+                    ORDER BY localId
+                    LIMIT 1
+                )
+            '''
+            params = [value for message in batch for value in message] + [username_]
+            self.cursor.execute(sql, params)
+            for local_id, is_sender, create_time, str_content in self.cursor.fetchall():
+                result[local_id] = (is_sender, create_time, str_content, time_formatter.format(create_time))
+        return result
 
     def get_contact(self, contacts):
         if not self.open_flag:
             return None
-        try:
-            lock.acquire(True)
-            sql = '''select StrTalker, MAX(CreateTime) from MSG group by StrTalker'''
-            self.cursor.execute(sql)
-            res = self.cursor.fetchall()
-        finally:
-            lock.release()
-        res = {StrTalker: CreateTime for StrTalker, CreateTime in res}
+        res = self._get_last_times()
         contacts = [list(cur_contact) for cur_contact in contacts]
         for i, cur_contact in enumerate(contacts):
             if cur_contact[0] in res:
@@ -408,7 +1092,93 @@ class Msg:
         contacts.sort(key=lambda cur_contact: cur_contact[-1], reverse=True)
         return contacts
 
+    @federated(_sum_talker_summaries)
+    def get_talker_summaries(self, usernames, time_range=None):
+        """
+        一次查询得到多个联系人的消息条数和文本长度，不限时间时读 MsgTalkerSummary，限定时间时读 MsgStats，
+        汇总表不可用时才直接统计 MSG
+        @param usernames: wxid 列表
+        @param time_range: 时间范围
+        @return: {wxid: (MsgCount, TextLength)}，TextLength 只计文本消息(Type=1)，没有消息的联系人不在其中
+        """
+        usernames = list(usernames)
+        if not self.open_flag or not usernames:
+            return {}
+        stats_sql = self._stats_time_sql(time_range)
+        talker_sql = f"StrTalker IN ({','.join('?' * len(usernames))})"
+        if stats_sql == '':
+            sql = f'''
+                SELECT StrTalker, MsgCount, TextLength
+                FROM MsgTalkerSummary
+                WHERE {talker_sql}
+            '''
+        elif stats_sql is not None:
+            sql = f'''
+                SELECT StrTalker, sum(MsgCount), sum(CASE WHEN Type = 1 THEN TextLength ELSE 0 END)
+                FROM MsgStats
+                WHERE {talker_sql}
+                {stats_sql}
+                GROUP BY StrTalker
+            '''
+        else:
+            sql = f'''
+                SELECT StrTalker, count(MsgSvrID), coalesce(sum(CASE WHEN Type = 1 THEN length(StrContent) END), 0)
+                FROM MSG
+                WHERE {talker_sql}
+                {time_range_sql(time_range)}
+                GROUP BY StrTalker
+            '''
+        result = {}
+        try:
+            self.cursor.execute(sql, usernames)
+            result = {talker: (msg_count, text_length) for talker, msg_count, text_length in self.cursor.fetchall()}
+        except sqlite3.DatabaseError:
+            logger.error(f'{traceback.format_exc()}\n数据库损坏请删除msg文件夹重试')
+        return result
+
+    @federated(_merge_last_times)
+    def _get_last_times(self):
+        """
+        @return: {StrTalker: 最后一条消息的 CreateTime}
+        """
+        if self.stats_ready:
+            sql = '''select StrTalker, LastTime from MsgTalkerSummary'''
+        else:
+            sql = '''select StrTalker, MAX(CreateTime) from MSG group by StrTalker'''
+        self.cursor.execute(sql)
+        return {StrTalker: CreateTime for StrTalker, CreateTime in self.cursor.fetchall()}
+
+    def get_talker_summary(self, username_):
+        """
+        联系人的聊天汇总，见 merge.build_msg_stats
+        @param username_: wxid
+        @return: {'MsgCount', 'SendCount', 'ReceiveCount', 'FirstTime', 'LastTime', 'LastLocalId', 'LastType',
+                  'LastContent', 'TextLength'}，没有汇总表或没有聊天记录时返回 None
+        """
+        if not self.open_flag or not self.stats_ready:
+            return None
+        sql = '''
+            SELECT MsgCount, SendCount, ReceiveCount, FirstTime, LastTime, LastLocalId, LastType, LastContent, TextLength
+            FROM MsgTalkerSummary
+            WHERE StrTalker = ?
+        '''
+        self.cursor.execute(sql, [username_])
+        result = self.cursor.fetchone()
+        if not result:
+            return None
+        return dict(zip([column[0] for column in self.cursor.description], result))
+
+    @federated(_union_sorted)
     def get_messages_calendar(self, username_):
+        if self.stats_ready:
+            sql = '''
+                SELECT Day
+                FROM MsgStats
+                WHERE StrTalker = ?
+                group by Day
+            '''
+            self.cursor.execute(sql, [username_])
+            return [date[0] for date in self.cursor.fetchall()]
         sql = '''
             SELECT strftime('%Y-%m-%d',CreateTime,'unixepoch','localtime') as days
             from (
@@ -422,14 +1192,11 @@ class Msg:
         if not self.open_flag:
             print('数据库未就绪')
             return None
-        try:
-            lock.acquire(True)
-            self.cursor.execute(sql, [username_])
-            result = self.cursor.fetchall()
-        finally:
-            lock.release()
+        self.cursor.execute(sql, [username_])
+        result = self.cursor.fetchall()
         return [date[0] for date in result]
 
+    @federated(_sum_sorted_by_key)
     def get_messages_by_days(
             self,
             username_,
@@ -438,29 +1205,36 @@ class Msg:
         result = None
         if not self.open_flag:
             return None
-        if time_range:
-            start_time, end_time = convert_to_timestamp(time_range)
+        stats_sql = self._stats_time_sql(time_range)
+        if stats_sql is not None:
+            sql = f'''
+                SELECT Day, sum(MsgCount)
+                FROM MsgStats
+                WHERE StrTalker = ?
+                {stats_sql}
+                group by Day
+            '''
+            self.cursor.execute(sql, [username_])
+            return self.cursor.fetchall()
+        time_sql = time_range_sql(time_range)
         sql = f'''
             SELECT strftime('%Y-%m-%d',CreateTime,'unixepoch','localtime') as days,count(MsgSvrID)
             from (
                 SELECT MsgSvrID, CreateTime
                 FROM MSG
                 WHERE StrTalker = ?
-                {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
+                {time_sql}
             )
             group by days
         '''
         result = None
         if not self.open_flag:
             return None
-        try:
-            lock.acquire(True)
-            self.cursor.execute(sql, [username_])
-            result = self.cursor.fetchall()
-        finally:
-            lock.release()
+        self.cursor.execute(sql, [username_])
+        result = self.cursor.fetchall()
         return result
 
+    @federated(_sum_sorted_by_key)
     def get_messages_by_month(
             self,
             username_,
@@ -469,96 +1243,86 @@ class Msg:
         result = None
         if not self.open_flag:
             return None
-        if time_range:
-            start_time, end_time = convert_to_timestamp(time_range)
+        stats_sql = self._stats_time_sql(time_range)
+        time_sql = time_range_sql(time_range)
         sql = f'''
             SELECT strftime('%Y-%m',CreateTime,'unixepoch','localtime') as days,count(MsgSvrID)
             from (
                 SELECT MsgSvrID, CreateTime
                 FROM MSG
                 WHERE StrTalker = ?
-                {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
+                {time_sql}
             )
             group by days
+        ''' if stats_sql is None else f'''
+            SELECT substr(Day, 1, 7) as days, sum(MsgCount)
+            FROM MsgStats
+            WHERE StrTalker = ?
+            {stats_sql}
+            group by days
         '''
         try:
-            lock.acquire(True)
             self.cursor.execute(sql, [username_])
             result = self.cursor.fetchall()
         except sqlite3.DatabaseError:
             logger.error(f'{traceback.format_exc()}\n数据库损坏请删除msg文件夹重试')
-        finally:
-            lock.release()
         return result
 
+    @federated(_sum_sorted_by_key)
     def get_messages_by_hour(self, username_, time_range=None,year_='all'):
         result = []
         if not self.open_flag:
             return result
-        if time_range:
-            start_time, end_time = convert_to_timestamp(time_range)
+        # 年度报告调用时 time_range 传的是 True，表示按 year_ 统计
+        if time_range is True:
+            time_range = None
+        else:
+            year_ = 'all'
+        stats_sql = self._stats_time_sql(time_range, year_)
+        time_sql = time_range_sql(time_range, year_)
         sql = f'''
             SELECT strftime('%H:00',CreateTime,'unixepoch','localtime') as hours,count(MsgSvrID)
             from (
                 SELECT MsgSvrID, CreateTime
                 FROM MSG
                 where StrTalker = ?
-                {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
+                {time_sql}
             )
             group by hours
+        ''' if stats_sql is None else f'''
+            SELECT printf('%02d:00', Hour) as hours, sum(MsgCount)
+            FROM MsgStats
+            where StrTalker = ?
+            {stats_sql}
+            group by hours
         '''
         try:
-            lock.acquire(True)
             self.cursor.execute(sql, [username_])
         except sqlite3.DatabaseError:
             logger.error(f'{traceback.format_exc()}\n数据库损坏请删除msg文件夹重试')
         finally:
-            lock.release()
             result = self.cursor.fetchall()
         return result
 
+    @federated(_earliest_message)
     def get_first_time_of_message(self, username_=''):
         if not self.open_flag:
             return None
         sql = f'''
-            select StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime
+            select StrContent,CreateTime
             from MSG
             {'where StrTalker=?' if username_ else ''}
             order by CreateTime
             limit 1
         '''
-        try:
-            lock.acquire(True)
-            self.cursor.execute(sql, [username_] if username_ else [])
-            result = self.cursor.fetchone()
-        finally:
-            lock.release()
-        return result
+        self.cursor.execute(sql, [username_] if username_ else [])
+        result = self.cursor.fetchone()
+        return (result[0], time_formatter.format(result[1])) if result else None
 
     def get_latest_time_of_message(self, username_='', time_range=None,year_='all'):
         if not self.open_flag:
             return None
-        if time_range:
-            start_time, end_time = convert_to_timestamp(time_range)
-        sql = f'''
-                SELECT isSender,StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,
-                strftime('%H:%M:%S', CreateTime,'unixepoch','localtime') as hour
-                FROM MSG
-                WHERE Type=1 AND 
-                {'StrTalker = ? AND ' if username_ else f"'{username_}'=? AND "} 
-                hour BETWEEN '00:00:00' AND '05:00:00'
-                {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
-                ORDER BY hour DESC
-                LIMIT 20;
-            '''
-        try:
-            lock.acquire(True)
-            self.cursor.execute(sql, [username_, year_] if year_ != "all" else [username_])
-        except sqlite3.DatabaseError:
-            logger.error(f'{traceback.format_exc()}\n数据库损坏请删除msg文件夹重试')
-        finally:
-            lock.release()
-            result = self.cursor.fetchall()
+        result = self._get_night_messages(username_, time_range, year_)
         if not result:
             return []
         res = []
@@ -570,6 +1334,35 @@ class Msg:
                 break
         return res
 
+    @federated(_latest_night_messages)
+    def _get_night_messages(self, username_='', time_range=None, year_='all'):
+        """
+        @return: 凌晨最晚的 20 条文本消息 [(isSender, StrContent, StrTime, hour), ...]
+        """
+        result = []
+        time_sql = time_range_sql(time_range, year_)
+        sql = f'''
+                SELECT isSender,StrContent,CreateTime
+                FROM MSG
+                WHERE Type=1
+                {'AND StrTalker = ?' if username_ else ''}
+                {time_sql}
+            '''
+        try:
+            self.cursor.execute(sql, [username_] if username_ else [])
+        except sqlite3.DatabaseError:
+            logger.error(f'{traceback.format_exc()}\n数据库损坏请删除msg文件夹重试')
+        else:
+            # 本地时间由 time_formatter 换算，和 StrTime 一致
+            night_messages = []
+            for is_sender, str_content, create_time in self.cursor:
+                str_time = time_formatter.format(create_time)
+                if str_time and '00:00:00' <= str_time[11:] <= '05:00:00':
+                    night_messages.append((is_sender, str_content, str_time, str_time[11:]))
+            result = heapq.nlargest(20, night_messages, key=lambda message: message[3])
+        return result
+
+    @federated(_sum_sorted_by_count)
     def get_send_messages_type_number(
             self,
             time_range: Tuple[int | float | str | date, int | float | str | date] = None,
@@ -579,13 +1372,12 @@ class Msg:
         return [(type_1, subtype_1, number_1), (type_2, subtype_2, number_2), ...]\n
         be like [(1, 0, 71481), (3, 0, 6686), (49, 57, 3887), ..., (10002, 0, 1)]
         """
-        if time_range:
-            start_time, end_time = convert_to_timestamp(time_range)
+        time_sql = time_range_sql(time_range)
         sql = f"""
             SELECT type, subtype, Count(MsgSvrID)
             from MSG
             where isSender = 1
-            {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
+            {time_sql}
             group by type, subtype
             order by Count(MsgSvrID) desc
         """
@@ -593,15 +1385,13 @@ class Msg:
         if not self.open_flag:
             return None
         try:
-            lock.acquire(True)
             self.cursor.execute(sql)
             result = self.cursor.fetchall()
         except sqlite3.DatabaseError:
             logger.error(f'{traceback.format_exc()}\n数据库损坏请删除msg文件夹重试')
-        finally:
-            lock.release()
         return result
 
+    @federated(_sum_results)
     def get_messages_number(
             self,
             username_,
@@ -613,27 +1403,39 @@ class Msg:
         @param time_range:
         @return:
         """
-        if time_range:
-            start_time, end_time = convert_to_timestamp(time_range)
-        sql = f"""
-            SELECT Count(MsgSvrID)
-            from MSG
-            where StrTalker = ?
-            {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
-        """
+        stats_sql = self._stats_time_sql(time_range)
+        time_sql = time_range_sql(time_range)
+        if stats_sql == '':
+            sql = """
+                SELECT MsgCount
+                from MsgTalkerSummary
+                where StrTalker = ?
+            """
+        elif stats_sql is not None:
+            sql = f"""
+                SELECT sum(MsgCount)
+                from MsgStats
+                where StrTalker = ?
+                {stats_sql}
+            """
+        else:
+            sql = f"""
+                SELECT Count(MsgSvrID)
+                from MSG
+                where StrTalker = ?
+                {time_sql}
+            """
         result = 0
         if not self.open_flag:
             return 0
         try:
-            lock.acquire(True)
             self.cursor.execute(sql, [username_])
             result = self.cursor.fetchone()
         except sqlite3.DatabaseError:
             logger.error(f'{traceback.format_exc()}\n数据库损坏请删除msg文件夹重试')
-        finally:
-            lock.release()
-        return result[0] if result else 0
+        return (result[0] or 0) if result else 0
 
+    @federated(_sum_sorted_by_count)
     def get_chatted_top_contacts(
             self,
             time_range: Tuple[int | float | str | date, int | float | str | date] = None,
@@ -644,31 +1446,50 @@ class Msg:
         统计聊天最多的 n 个联系人（默认不包含群组），按条数降序\n
         return [(wxid_1, number_1), (wxid_2, number_2), ...]
         """
-        if time_range:
-            start_time, end_time = convert_to_timestamp(time_range)
-        sql = f"""
-            SELECT strtalker, Count(MsgSvrID)
-            from MSG
-            where strtalker != "filehelper" and strtalker != "notifymessage" and strtalker not like "gh_%"
-            {"and strtalker not like '%@chatroom'" if not contain_chatroom else ""}
-            {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
-            group by strtalker
-            order by Count(MsgSvrID) desc
-            limit {top_n}
-        """
+        stats_sql = self._stats_time_sql(time_range)
+        time_sql = time_range_sql(time_range)
+        talker_sql = f'''strtalker != "filehelper" and strtalker != "notifymessage" and strtalker not like "gh_%"
+            {"and strtalker not like '%@chatroom'" if not contain_chatroom else ""}'''
+        if stats_sql == '':
+            sql = f"""
+                SELECT strtalker, MsgCount
+                from MsgTalkerSummary
+                where {talker_sql}
+                order by MsgCount desc
+                limit {top_n}
+            """
+        elif stats_sql is not None:
+            sql = f"""
+                SELECT strtalker, sum(MsgCount) as num
+                from MsgStats
+                where {talker_sql}
+                {stats_sql}
+                group by strtalker
+                order by num desc
+                limit {top_n}
+            """
+        else:
+            # 分片分组查询时各组不能先截断，合并各组的条数后再取前 top_n
+            sql = f"""
+                SELECT strtalker, Count(MsgSvrID)
+                from MSG
+                where {talker_sql}
+                {time_sql}
+                group by strtalker
+                order by Count(MsgSvrID) desc
+                {'' if len(self.pools) > 1 else f'limit {top_n}'}
+            """
         result = None
         if not self.open_flag:
             return None
         try:
-            lock.acquire(True)
             self.cursor.execute(sql)
             result = self.cursor.fetchall()
         except sqlite3.DatabaseError:
             logger.error(f'{traceback.format_exc()}\n数据库损坏请删除msg文件夹重试')
-        finally:
-            lock.release()
         return result
 
+    @federated(_sum_results)
     def get_send_messages_length(
             self,
             time_range: Tuple[int | float | str | date, int | float | str | date] = None,
@@ -676,19 +1497,18 @@ class Msg:
         """
         统计自己总共发消息的字数，包含type=1的文本和type=49,subtype=57里面自己发的文本
         """
-        if time_range:
-            start_time, end_time = convert_to_timestamp(time_range)
+        time_sql = time_range_sql(time_range)
         sql_type_1 = f"""
             SELECT sum(length(strContent))
             from MSG
             where isSender = 1 and type = 1
-            {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
+            {time_sql}
         """
         sql_type_49 = f"""
             SELECT CompressContent
             from MSG
             where isSender = 1 and type = 49 and subtype = 57
-            {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
+            {time_sql}
         """
         sum_type_1 = None
         result_type_49 = None
@@ -697,7 +1517,6 @@ class Msg:
         if not self.open_flag:
             return None
         try:
-            lock.acquire(True)
             self.cursor.execute(sql_type_1)
             sum_type_1 = self.cursor.fetchall()[0][0]
             self.cursor.execute(sql_type_49)
@@ -710,36 +1529,63 @@ class Msg:
                 sum_type_49 += len(content["title"])
         except sqlite3.DatabaseError:
             logger.error(f'{traceback.format_exc()}\n数据库损坏请删除msg文件夹重试')
-        finally:
-            lock.release()
-        return sum_type_1 + sum_type_49
+        return (sum_type_1 or 0) + sum_type_49
+
+    @federated(_concat_results)
+    def get_send_text(
+            self,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+    ) -> list:
+        """
+        自己发的文本消息的内容，用于生成词云；条数、长度等统计见 get_statistics
+        """
+        if not self.open_flag:
+            return None
+        time_sql = time_range_sql(time_range)
+        sql = f"""
+            SELECT StrContent
+            from MSG
+            where isSender = 1 and type = 1
+            {time_sql}
+        """
+        result = []
+        try:
+            self.cursor.execute(sql)
+            result = [row[0] for row in self.cursor.fetchall() if row[0]]
+        except sqlite3.DatabaseError:
+            logger.error(f'{traceback.format_exc()}\n数据库损坏请删除msg文件夹重试')
+        return result
 
+    @federated(_sum_results)
     def get_send_messages_number_sum(
             self,
             time_range: Tuple[int | float | str | date, int | float | str | date] = None,
     ) -> int:
         """统计自己总共发了多少条消息"""
-        if time_range:
-            start_time, end_time = convert_to_timestamp(time_range)
+        stats_sql = self._stats_time_sql(time_range)
+        time_sql = time_range_sql(time_range)
         sql = f"""
             SELECT count(MsgSvrID)
             from MSG
             where isSender = 1
-            {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
+            {time_sql}
+        """ if stats_sql is None else f"""
+            SELECT coalesce(sum(MsgCount), 0)
+            from MsgStats
+            where IsSender = 1
+            {stats_sql}
         """
         result = None
         if not self.open_flag:
             return None
         try:
-            lock.acquire(True)
             self.cursor.execute(sql)
             result = self.cursor.fetchall()[0][0]
         except sqlite3.DatabaseError:
             logger.error(f'{traceback.format_exc()}\n数据库损坏请删除msg文件夹重试')
-        finally:
-            lock.release()
         return result
 
+    @federated(_sum_sorted_by_count)
     def get_send_messages_number_by_hour(
             self,
             time_range: Tuple[int | float | str | date, int | float | str | date] = None,
@@ -748,31 +1594,36 @@ class Msg:
         统计每个（小时）时段自己总共发了多少消息，从最多到最少排序\n
         return be like [('23', 9526), ('00', 7890), ('22', 7600),  ..., ('05', 29)]
         """
-        if time_range:
-            start_time, end_time = convert_to_timestamp(time_range)
+        stats_sql = self._stats_time_sql(time_range)
+        time_sql = time_range_sql(time_range)
         sql = f"""
             SELECT strftime('%H', CreateTime, 'unixepoch', 'localtime') as hour,count(MsgSvrID)
             from (
                 SELECT MsgSvrID, CreateTime
                 FROM MSG
                 where isSender = 1
-                    {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
+                    {time_sql}
             )
             group by hour
             order by count(MsgSvrID) desc
+        """ if stats_sql is None else f"""
+            SELECT printf('%02d', Hour) as hour, sum(MsgCount)
+            from MsgStats
+            where IsSender = 1
+            {stats_sql}
+            group by hour
+            order by sum(MsgCount) desc
         """
         result = None
         if not self.open_flag:
             return None
         try:
-            lock.acquire(True)
             self.cursor.execute(sql)
             result = self.cursor.fetchall()
         except sqlite3.DatabaseError:
             logger.error(f'{traceback.format_exc()}\n数据库损坏请删除msg文件夹重试')
-        finally:
-            lock.release()
         return result
+    @federated(_sum_results)
     def get_message_length(
             self,
             username_='',
@@ -781,21 +1632,36 @@ class Msg:
         """
                 统计自己总共发消息的字数，包含type=1的文本和type=49,subtype=57里面自己发的文本
                 """
-        if time_range:
-            start_time, end_time = convert_to_timestamp(time_range)
-        sql_type_1 = f"""
+        stats_sql = self._stats_time_sql(time_range)
+        time_sql = time_range_sql(time_range)
+        if stats_sql == '':
+            sql_type_1 = """
+                    SELECT TextLength
+                    from MsgTalkerSummary
+                    where StrTalker = ?
+                """
+        elif stats_sql is not None:
+            sql_type_1 = f"""
+                    SELECT sum(TextLength)
+                    from MsgStats
+                    where StrTalker = ? and
+                    type = 1
+                    {stats_sql}
+                """
+        else:
+            sql_type_1 = f"""
                     SELECT sum(length(strContent))
                     from MSG
                     where  StrTalker = ? and
                     type = 1
-                    {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
+                    {time_sql}
                 """
         sql_type_49 = f"""
                     SELECT CompressContent
                     from MSG
                     where  StrTalker = ? and
                     type = 49 and subtype = 57
-                    {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
+                    {time_sql}
                 """
         sum_type_1 = 0
         result_type_1 = 0
@@ -805,15 +1671,13 @@ class Msg:
         if not self.open_flag:
             return None
         try:
-            lock.acquire(True)
             self.cursor.execute(sql_type_1,[username_])
-            result_type_1 = self.cursor.fetchall()[0][0]
+            result_type_1 = self.cursor.fetchone()
+            result_type_1 = result_type_1[0] if result_type_1 else 0
             self.cursor.execute(sql_type_49,[username_])
             result_type_49 = self.cursor.fetchall()
         except sqlite3.DatabaseError:
             logger.error(f'{traceback.format_exc()}\n数据库损坏请删除msg文件夹重试')
-        finally:
-            lock.release()
         for message in result_type_49:
             message = message[0]
             content = parser_reply(message)
@@ -822,12 +1686,208 @@ class Msg:
             sum_type_49 += len(content["title"])
         sum_type_1 = result_type_1 if result_type_1 else 0
         return sum_type_1 + sum_type_49
+
+    def get_statistics(
+            self,
+            username_='',
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+    ) -> dict:
+        """
+        年度报告用到的统计一次扫描 MSG 得到；MsgStats 可用时改为读取汇总表，MSG 中只查引用消息、最早的一条和凌晨的文本消息。
+        结果与下列方法相同(username_ 为空时统计所有人)：
+        send_type_number: get_send_messages_type_number
+        send_length: get_send_messages_length
+        send_num: get_send_messages_number_sum
+        send_number_by_hour: get_send_messages_number_by_hour
+        message_num: get_messages_number
+        message_length: get_message_length
+        number_by_hour: get_messages_by_hour
+        first_time: get_first_time_of_message，限定在 time_range 内
+        latest_time: get_latest_time_of_message
+        另外还有 receive_num 收到的消息条数，type_number 所有消息各类型的条数(格式同 send_type_number)
+        """
+        result = {
+            'message_num': 0,
+            'send_num': 0,
+            'receive_num': 0,
+            'type_number': [],
+            'send_type_number': [],
+            'send_length': 0,
+            'send_number_by_hour': [],
+            'message_length': 0,
+            'number_by_hour': [],
+            'first_time': None,
+            'latest_time': [],
+        }
+        if not self.open_flag:
+            return result
+        counts = self._count_statistics(username_, time_range)
+        for key in ('message_num', 'send_num', 'send_length', 'message_length', 'first_time'):
+            result[key] = counts[key]
+        result['receive_num'] = result['message_num'] - result['send_num']
+        for key in ('type_number', 'send_type_number'):
+            result[key] = [(type_, sub_type, num) for (type_, sub_type), num in counts[key].most_common()]
+        result['send_number_by_hour'] = counts['send_number_by_hour'].most_common()
+        result['number_by_hour'] = [(f'{hour}:00', num) for hour, num in sorted(counts['number_by_hour'].items())]
+        # 与 get_latest_time_of_message 相同：凌晨最晚的 20 条中，最晚的一条以及之后第一条对方发的(或自己发的)
+        latest = heapq.nlargest(20, counts['night_messages'], key=lambda message: message[0])
+        if latest:
+            is_sender = latest[0][2]
+            for hour, create_time, sender, text in latest:
+                if sender == is_sender and result['latest_time']:
+                    continue
+                str_time = time_formatter.format(create_time)
+                result['latest_time'].append((sender, text, str_time, hour))
+                if len(result['latest_time']) == 2:
+                    break
+        return result
+
+    @federated(_merge_statistics)
+    def _count_statistics(self, username_, time_range):
+        """
+        get_statistics 中可以按分片组分别统计再相加的部分
+        @return: {'message_num', 'send_num', 'send_length', 'message_length': 条数和文本长度,
+                  'type_number', 'send_type_number', 'send_number_by_hour', 'number_by_hour': Counter,
+                  'first': 最早一条消息的 (CreateTime, localId), 'first_time': 这条消息的 (StrContent, StrTime),
+                  'night_messages': 凌晨的文本消息 [(hour, CreateTime, IsSender, StrContent), ...]}
+        """
+        result = {
+            'message_num': 0,
+            'send_num': 0,
+            'send_length': 0,
+            'message_length': 0,
+            'first_time': None,
+        }
+        stats_sql = self._stats_time_sql(time_range)
+        time_sql = time_range_sql(time_range)
+        talker_sql = 'StrTalker = ?' if username_ else '1'
+        params = [username_] if username_ else []
+        type_number = Counter()
+        send_type_number = Counter()
+        send_number_by_hour = Counter()
+        number_by_hour = Counter()
+        first = None
+        night_messages = []
+        try:
+            if stats_sql is None:
+                # 只取统计需要的列：文本长度在 SQL 中计算，文本内容只取凌晨的文本消息，CompressContent 只取引用消息
+                sql = f'''
+                    SELECT localId, IsSender, Type, SubType, CreateTime, hour, TextLength,
+                        CASE WHEN Type = 1 AND hour BETWEEN '00:00:00' AND '05:00:00' THEN StrContent END,
+                        CASE WHEN Type = 49 AND SubType = 57 THEN CompressContent END
+                    FROM (
+                        SELECT localId, IsSender, Type, SubType, CreateTime, StrContent, CompressContent,
+                            strftime('%H:%M:%S', CreateTime, 'unixepoch', 'localtime') as hour,
+                            CASE WHEN Type = 1 THEN length(StrContent) ELSE 0 END as TextLength
+                        FROM MSG
+                        WHERE {talker_sql}
+                        {time_sql}
+                    )
+                '''
+                self.cursor.execute(sql, params)
+                for local_id, is_sender, type_, sub_type, create_time, hour, text_length, night_text, compress_content in self.cursor:
+                    result['message_num'] += 1
+                    number_by_hour[hour[:2]] += 1
+                    type_number[(type_, sub_type)] += 1
+                    if first is None or (create_time, local_id) < first:
+                        first = create_time, local_id
+                    if night_text is not None:
+                        night_messages.append((hour, create_time, is_sender, night_text))
+                    if compress_content is not None:
+                        content = parser_reply(compress_content)
+                        text_length += 0 if content["is_error"] else len(content["title"])
+                    result['message_length'] += text_length
+                    if is_sender == 1:
+                        result['send_num'] += 1
+                        result['send_length'] += text_length
+                        send_type_number[(type_, sub_type)] += 1
+                        send_number_by_hour[hour[:2]] += 1
+            else:
+                # 条数、文本长度和按小时的分布直接由 MsgStats 汇总
+                sql = f'''
+                    SELECT IsSender, Type, SubType, Hour, sum(MsgCount), sum(CASE WHEN Type = 1 THEN TextLength ELSE 0 END)
+                    FROM MsgStats
+                    WHERE {talker_sql}
+                    {stats_sql}
+                    GROUP BY IsSender, Type, SubType, Hour
+                '''
+                self.cursor.execute(sql, params)
+                for is_sender, type_, sub_type, hour, num, text_length in self.cursor.fetchall():
+                    hour = f'{hour:02d}'
+                    result['message_num'] += num
+                    result['message_length'] += text_length
+                    number_by_hour[hour] += num
+                    type_number[(type_, sub_type)] += num
+                    if is_sender == 1:
+                        result['send_num'] += num
+                        result['send_length'] += text_length
+                        send_type_number[(type_, sub_type)] += num
+                        send_number_by_hour[hour] += num
+                # 引用消息的文本在 CompressContent 中
+                sql = f'''
+                    SELECT IsSender, CompressContent
+                    FROM MSG
+                    WHERE {talker_sql} AND Type = 49 AND SubType = 57
+                    {time_sql}
+                '''
+                self.cursor.execute(sql, params)
+                for is_sender, compress_content in self.cursor.fetchall():
+                    content = parser_reply(compress_content)
+                    text_length = 0 if content["is_error"] else len(content["title"])
+                    result['message_length'] += text_length
+                    if is_sender == 1:
+                        result['send_length'] += text_length
+                sql = f'''
+                    SELECT CreateTime, localId
+                    FROM MSG
+                    WHERE {talker_sql}
+                    {time_sql}
+                    ORDER BY CreateTime, localId
+                    LIMIT 1
+                '''
+                self.cursor.execute(sql, params)
+                first = self.cursor.fetchone()
+                sql = f'''
+                    SELECT hour, CreateTime, IsSender, StrContent
+                    FROM (
+                        SELECT CreateTime, IsSender, StrContent,
+                            strftime('%H:%M:%S', CreateTime, 'unixepoch', 'localtime') as hour
+                        FROM MSG
+                        WHERE {talker_sql} AND Type = 1
+                        {time_sql}
+                    )
+                    WHERE hour BETWEEN '00:00:00' AND '05:00:00'
+                    ORDER BY hour DESC
+                    LIMIT 20
+                '''
+                self.cursor.execute(sql, params)
+                night_messages = self.cursor.fetchall()
+            if first:
+                self.cursor.execute("SELECT StrContent FROM MSG WHERE localId=?", [first[1]])
+                row = self.cursor.fetchone()
+                result['first_time'] = (row[0], time_formatter.format(first[0])) if row else None
+        except sqlite3.DatabaseError:
+            logger.error(f'{traceback.format_exc()}\n数据库损坏请删除msg文件夹重试')
+        result.update(
+            type_number=type_number,
+            send_type_number=send_type_number,
+            send_number_by_hour=send_number_by_hour,
+            number_by_hour=number_by_hour,
+            first=tuple(first) if first else None,
+            night_messages=night_messages,
+        )
+        return result
+
     def close(self):
         if self.open_flag:
             try:
                 lock.acquire(True)
                 self.open_flag = False
-                self.DB.close()
+                # 保留关闭后的连接池，之后的查询和原来一样报数据库已关闭
+                for pool in self.pools:
+                    pool.close()
+                # 重新解密后联系人可能变化
+                sender_cache.clear()
             finally:
                 lock.release()
 
@@ -1,9 +1,7 @@
 import threading
 
-from app.DataBase import msg_db, micro_msg_db, misc_db
-from app.util.protocbuf.msg_pb2 import MessageBytesExtra
+from app.DataBase import msg_db, micro_msg_db
 from app.util.protocbuf.roomdata_pb2 import ChatRoomData
-from app.person import Contact, Me, ContactDefault
 
 lock = threading.Lock()
 
@@ -29,71 +27,65 @@ class PackageMsg:
         获取完整的聊天记录
         '''
         updated_messages = []  # 用于存储修改后的消息列表
+        contacts = {}  # wxid -> 联系人信息，每批消息中没查过的联系人和群聊发送人合并成一次查询
+        for messages in msg_db.iter_messages():
+            # 群聊中别人发送的消息的发送人，存在BytesExtra为空的情况，此时消息类型应该为提示性消息，发送人为None
+            senders = msg_db.get_senders([row for row in messages if row[11].__contains__('@chatroom')])
+            unknown = ({row[11] for row in messages} | {wxid for wxid in senders.values() if wxid}) - contacts.keys()
+            if unknown:
+                infos = micro_msg_db.get_contacts_by_usernames(unknown)
+                contacts.update((wxid, infos.get(wxid)) for wxid in unknown)
+            for row in messages:
+                # 删除不使用的几个字段
+                row_list = list(row[:9])
 
-        messages = msg_db.get_messages_all()
-        for row in messages:
-            row_list = list(row)
-            # 删除不使用的几个字段
-            del row_list[13]
-            del row_list[12]
-            del row_list[11]
-            del row_list[10]
-            del row_list[9]
-
-            strtalker = row[11]
-            info = micro_msg_db.get_contact_by_username(strtalker)
-            if info is not None:
-                row_list.append(info[3])
-                row_list.append(info[4])
-            else:
-                row_list.append('')
-                row_list.append('')
-            # 判断是否是群聊
-            if strtalker.__contains__('@chatroom'):
-                # 自己发送
-                if row[4] == 1:
-                    row_list.append('我')
+                strtalker = row[11]
+                info = contacts.get(strtalker)
+                if info is not None:
+                    row_list.append(info[3])
+                    row_list.append(info[4])
                 else:
-                    # 存在BytesExtra为空的情况，此时消息类型应该为提示性消息。跳过不处理
-                    if row[10] is None:
-                        continue
-                    # 解析BytesExtra
-                    msgbytes = MessageBytesExtra()
-                    msgbytes.ParseFromString(row[10])
-                    wxid = ''
-                    for tmp in msgbytes.message2:
-                        if tmp.field1 != 1:
+                    row_list.append('')
+                    row_list.append('')
+                # 判断是否是群聊
+                if strtalker.__contains__('@chatroom'):
+                    # 自己发送
+                    if row[4] == 1:
+                        row_list.append('我')
+                    else:
+                        # BytesExtra为空的提示性消息跳过不处理
+                        wxid = senders.get(row[0])
+                        if wxid is None:
                             continue
-                        wxid = tmp.field2
-                    sender = ''
-                    # 获取群聊成员列表
-                    membersMap = self.get_chatroom_member_list(strtalker)
-                    if membersMap is not None:
-                        if wxid in membersMap:
-                            sender = membersMap.get(wxid)
-                        else:
-                            senderinfo = micro_msg_db.get_contact_by_username(wxid)
-                            if senderinfo is not None:
-                                sender = senderinfo[4]
-                                membersMap[wxid] = senderinfo[4]
-                                if len(senderinfo[3]) > 0:
-                                    sender = senderinfo[3]
-                                    membersMap[wxid] = senderinfo[3]
-                    row_list.append(sender)
-            else:
-                if row[4] == 1:
-                    row_list.append('我')
+                        sender = ''
+                        # 获取群聊成员列表
+                        membersMap = self.get_chatroom_member_list(strtalker)
+                        if membersMap is not None:
+                            if wxid in membersMap:
+                                sender = membersMap.get(wxid)
+                            else:
+                                senderinfo = contacts.get(wxid)
+                                if senderinfo is not None:
+                                    sender = senderinfo[4]
+                                    membersMap[wxid] = senderinfo[4]
+                                    if len(senderinfo[3]) > 0:
+                                        sender = senderinfo[3]
+                                        membersMap[wxid] = senderinfo[3]
+                        row_list.append(sender)
                 else:
-                    if info is not None:
-                        row_list.append(info[4])
+                    if row[4] == 1:
+                        row_list.append('我')
                     else:
-                        row_list.append('')
-            updated_messages.append(tuple(row_list))
+                        if info is not None:
+                            row_list.append(info[4])
+                        else:
+                            row_list.append('')
+                updated_messages.append(tuple(row_list))
         return updated_messages
 
     def get_package_message_by_wxid(self, chatroom_wxid):
         '''
-        获取一个群聊的聊天记录
+        获取一个群聊的聊天记录，群聊消息的发送人由 msg.parser_chatroom_message 批量解析并缓存
         return list
             a[0]: localId,
             a[1]: talkerId, （和strtalker对应的，不是群聊信息发送人）
@@ -110,48 +102,7 @@ class PackageMsg:
             a[12]: DisplayContent,
             a[13]: msg_sender, （ContactPC 或 ContactDefault 类型，这个才是群聊里的信息发送人，不是群聊或者自己是发送者没有这个字段）
         '''
-        updated_messages = []  # 用于存储修改后的消息列表
-        messages = msg_db.get_messages(chatroom_wxid)
-        for row in messages:
-            message = list(row)
-            if message[4] == 1:  # 自己发送的就没必要解析了
-                message.append(Me())
-                updated_messages.append(message)
-                continue
-            if message[10] is None:  # BytesExtra是空的跳过
-                message.append(ContactDefault(wxid))
-                updated_messages.append(message)
-                continue
-            msgbytes = MessageBytesExtra()
-            msgbytes.ParseFromString(message[10])
-            wxid = ''
-            for tmp in msgbytes.message2:
-                if tmp.field1 != 1:
-                    continue
-                wxid = tmp.field2
-            if wxid == "":  # 系统消息里面 wxid 不存在
-                message.append(ContactDefault(wxid))
-                updated_messages.append(message)
-                continue
-            contact_info_list = micro_msg_db.get_contact_by_username(wxid)
-            if contact_info_list is None:  # 群聊中已退群的联系人不会保存在数据库里
-                message.append(ContactDefault(wxid))
-                updated_messages.append(message)
-                continue
-            contact_info = {
-                'UserName': contact_info_list[0],
-                'Alias': contact_info_list[1],
-                'Type': contact_info_list[2],
-                'Remark': contact_info_list[3],
-                'NickName': contact_info_list[4],
-                'smallHeadImgUrl': contact_info_list[7]
-            }
-            contact = Contact(contact_info)
-            contact.smallHeadImgBLOG = misc_db.get_avatar_buffer(contact.wxid)
-            contact.set_avatar(contact.smallHeadImgBLOG)
-            message.append(contact)
-            updated_messages.append(tuple(message))
-        return updated_messages
+        return msg_db.get_messages(chatroom_wxid)
 
     def get_chatroom_member_list(self, strtalker):
         membermap = {}
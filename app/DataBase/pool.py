@@ -0,0 +1,93 @@
+import os.path
+import pathlib
+import sqlite3
+import threading
+
+# 每个只读连接的调优参数
+MMAP_SIZE = 256 * 1024 * 1024  # 256MB，按需映射，不会真的占用这么多内存
+CACHE_SIZE = -16384  # 16MB
+
+
+def open_readonly(db_path):
+    """
+    以只读方式打开数据库
+    @param db_path: 数据库路径
+    @return: sqlite3.Connection
+    """
+    uri = pathlib.Path(os.path.abspath(db_path)).as_uri() + '?mode=ro'
+    return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+
+def tune_readonly(conn):
+    """
+    设置 mmap_size、cache_size，并禁止写入，对连接上挂载的每个数据库都生效
+    """
+    conn.execute("PRAGMA query_only = ON;")
+    for _, name, _ in conn.execute("PRAGMA database_list;").fetchall():
+        if name == 'temp':
+            continue
+        conn.execute(f'PRAGMA "{name}".mmap_size = {MMAP_SIZE};')
+        conn.execute(f'PRAGMA "{name}".cache_size = {CACHE_SIZE};')
+    return conn
+
+
+class ConnectionPool:
+    """
+    每个线程使用自己的只读连接和游标，SQLite 的读操作可以真正并发，读路径上不需要加锁
+    线程结束后它的连接随 threading.local 一起释放，close() 关闭仍在使用的连接
+    """
+
+    def __init__(self, connect):
+        """
+        @param connect: 无参函数，每个线程第一次查询时调用，返回该线程使用的连接
+        """
+        self._connect = connect
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = {}  # 线程id -> 连接，用于 close
+        self.closed = False
+
+    @classmethod
+    def readonly(cls, db_path):
+        """
+        @param db_path: 数据库路径，每个线程只读打开一次
+        """
+        return cls(lambda: tune_readonly(open_readonly(db_path)))
+
+    @classmethod
+    def shared(cls, conn):
+        """
+        已打开的连接(如内存数据库)无法再打开第二个，所有线程共用它，每个线程使用自己的游标
+        @param conn: 以 check_same_thread=False 打开的连接
+        """
+        return cls(lambda: conn)
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if self.closed:
+                raise sqlite3.ProgrammingError('Cannot operate on a closed database.')
+            conn = self._connect()
+            self._local.conn = conn
+            with self._lock:
+                # 清理已结束线程的连接
+                alive = {thread.ident for thread in threading.enumerate()}
+                for ident in [ident for ident in self._connections if ident not in alive]:
+                    self._connections.pop(ident)
+                self._connections[threading.get_ident()] = conn
+        return conn
+
+    def cursor(self) -> sqlite3.Cursor:
+        cursor = getattr(self._local, 'cursor', None)
+        if cursor is None:
+            cursor = self.connection().cursor()
+            self._local.cursor = cursor
+        return cursor
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            connections = set(self._connections.values())
+            self._connections.clear()
+        for conn in connections:
+            conn.close()
@@ -2,6 +2,7 @@ import os
 from collections import Counter
 import sys
 from datetime import datetime
+from itertools import chain
 from typing import List
 
 import jieba
@@ -14,6 +15,8 @@ from app.person import Contact
 from app.util.region_conversion import conversion_province_to_chinese
 
 os.makedirs('./data/聊天统计/', exist_ok=True)
+# 词云中取前几个关键词的对话，一次 get_messages_by_keywords 批量查询
+DIALOG_KEYWORD_NUM = 5
 
 
 def wordcloud_(wxid, time_range=None):
@@ -61,12 +64,15 @@ def wordcloud_(wxid, time_range=None):
         WordCloud(init_opts=opts.InitOpts())
         .add(series_name="聊天文字", data_pair=text_data, word_size_range=[5, 100])
     )
+    keywords = [word for word, count in text_data[:DIALOG_KEYWORD_NUM]]
+    keyword_dialogs = msg_db.get_messages_by_keywords(wxid, keywords, num=5, max_len=12)
     # return w.render_embed()
     return {
         'chart_data': w.dump_options_with_quotes(),
         'keyword': keyword,
         'max_num': str(max_num),
-        'dialogs': msg_db.get_messages_by_keyword(wxid, keyword, num=5, max_len=12)
+        'dialogs': keyword_dialogs[keyword],
+        'keyword_dialogs': keyword_dialogs,
     }
 
 
@@ -111,6 +117,7 @@ def get_wordcloud(text):
         'chart_data_wordcloud': w.dump_options_with_quotes(),
         'keyword': keyword,
         'keyword_max_num': max_num,
+        'keywords': [word for word, count in text_data[:DIALOG_KEYWORD_NUM]],
     }
 
 
@@ -132,13 +139,16 @@ def wordcloud_christmas(wxid,time_range=None, year='2023'):
     # return w.render_embed()
     keyword = wordcloud_data.get('keyword')
     max_num = wordcloud_data.get('keyword_max_num')
-    dialogs = msg_db.get_messages_by_keyword(wxid, keyword, num=3, max_len=12, time_range=time_range)
+    keyword_dialogs = msg_db.get_messages_by_keywords(
+        wxid, wordcloud_data.get('keywords') or [keyword], num=3, max_len=12, time_range=time_range
+    )
 
     return {
         'wordcloud_chart_data': wordcloud_data.get('chart_data_wordcloud'),
         'keyword': keyword,
         'keyword_max_num': str(max_num),
-        'dialogs': dialogs,
+        'dialogs': keyword_dialogs.get(keyword, []),
+        'keyword_dialogs': keyword_dialogs,
         'total_num': total_msg_len,
     }
 
@@ -307,12 +317,14 @@ def get_weekday(timestamp):
 
 
 def sender(wxid, time_range, my_name='', ta_name=''):
-    msg_data = msg_db.get_messages(wxid, time_range)
+    msg_data = chain.from_iterable(msg_db.iter_messages(wxid, time_range))
 
     types_count = {}
     send_num = 0  # 发送消息的数量
     weekday_count = {}
+    message_num = 0
     for message in msg_data:
+        message_num += 1
         type_ = message[2]
         is_sender = message[4]
         subType = message[3]
@@ -330,7 +342,7 @@ def sender(wxid, time_range, my_name='', ta_name=''):
             weekday_count[weekday] += 1
         else:
             weekday_count[weekday] = 1
-    receive_num = len(msg_data) - send_num
+    receive_num = message_num - send_num
     data = [[types_.get(key), value] for key, value in types_count.items() if key in types_]
     if not data:
         return {
@@ -445,36 +457,18 @@ def contacts_analysis(contacts):
     }
 
 
-def my_message_counter(time_range, my_name=''):
-    msg_data = msg_db.get_messages_all(time_range=time_range)
+def my_message_counter(statistics, time_range=None):
+    """
+    @param statistics: msg_db.get_statistics 的结果，各项条数都由它给出
+    @param time_range: 时间范围，用于读取自己发的文本生成词云
+    """
     types_count = {}
-    send_num = 0  # 发送消息的数量
-    weekday_count = {}
-    str_content = ''
-    total_text_num = 0
-    for message in msg_data:
-        type_ = message[2]
-        is_sender = message[4]
-        subType = message[3]
-        timestamp = message[5]
-        weekday = get_weekday(timestamp)
-        str_time = message[8]
-        send_num += is_sender
-        type_ = f'{type_}{subType:0>2d}' if subType != 0 else type_
-        type_ = int(type_)
-        if type_ in types_count:
-            types_count[type_] += 1
-        else:
-            types_count[type_] = 1
-        if weekday in weekday_count:
-            weekday_count[weekday] += 1
-        else:
-            weekday_count[weekday] = 1
-        if type_ == 1:
-            total_text_num += len(message[7])
-            if is_sender == 1:
-                str_content += message[7]
-    receive_num = len(msg_data) - send_num
+    for type_, subType, num in statistics['type_number']:
+        type_ = int(f'{type_}{subType:0>2d}') if subType != 0 else type_
+        types_count[type_] = types_count.get(type_, 0) + num
+    send_num = statistics['send_num']
+    receive_num = statistics['receive_num']
+    total_text_num = statistics['message_length']
     data = [[types_.get(key), value] for key, value in types_count.items() if key in types_]
     if not data:
         return {
@@ -509,7 +503,7 @@ def my_message_counter(time_range, my_name=''):
         .set_series_opts(label_opts=opts.LabelOpts(formatter="{b}: {c}\n{d}%", position='inside'))
         # .render("./data/聊天统计/pie_scroll_legend.html")
     )
-    w = get_wordcloud(str_content)
+    w = get_wordcloud(''.join(msg_db.get_send_text(time_range) or []))
     return {
         'chart_data_sender': p2.dump_options_with_quotes(),
         'chart_data_types': p1.dump_options_with_quotes(),
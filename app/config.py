@@ -25,7 +25,9 @@ about = f'''
 
 # 数据存放文件路径
 INFO_FILE_PATH = './app/data/info.json'  # 个人信息文件
+KEY_CACHE_PATH = './app/data/key_cache.json'  # 数据库派生密钥缓存
 DB_DIR = './app/Database/Msg'
+MERGE_MSG_SHARDS = True  # 解密后是否把 MSG0.db..MSGn.db 合并成 MSG.db，False 时保留各分片由 Msg 联合查询
 OUTPUT_DIR = './data/'  # 输出文件夹
 os.makedirs('./app/data', exist_ok=True)
 os.makedirs(DB_DIR, exist_ok=True)
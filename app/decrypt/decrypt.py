@@ -15,10 +15,25 @@
 import argparse
 import hmac
 import hashlib
+import json
+import mmap
 import os
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from typing import Union, List
 from Cryptodome.Cipher import AES
 
+try:
+    import win32crypt  # Windows下用DPAPI加密派生密钥的磁盘缓存
+except ImportError:
+    win32crypt = None
+
 # from Crypto.Cipher import AES # 如果上面的导入失败，可以尝试使用这个
 
 SQLITE_FILE_HEADER = "SQLite format 3\x00"  # SQLite文件头
@@ -26,61 +41,712 @@ SQLITE_FILE_HEADER = "SQLite format 3\x00"  # SQLite文件头
 KEY_SIZE = 32
 DEFAULT_PAGESIZE = 4096
 DEFAULT_ITER = 64000
+SALT_SIZE = 16
+CRYPTPROTECT_UI_FORBIDDEN = 0x1
+DPAPI_PREFIX = "dpapi:"  # 磁盘缓存中经DPAPI加密的条目前缀
+OUT_BUFFER_PAGES = 256  # 输出缓冲区大小(页)，即每次写入1MB
+SPLIT_FILE_SIZE = 256 * 1024 * 1024  # 并行解密时超过该大小的文件按页拆分给多个进程
+SPLIT_PAGES = 16384  # 拆分后每个任务解密的页数，即64MB
+IN_FLIGHT_BYTES = 512 * 1024 * 1024  # 并行解密到内存时，正在解密和等待处理的文件总大小上限
+MANIFEST_SUFFIX = ".manifest"  # 增量解密清单文件后缀
+MANIFEST_MAGIC = b"WXDBMF01"
+MANIFEST_HEADER = struct.Struct("<8s32sQQ")  # 魔数, sha256(解密密钥), 输出文件大小, 输出文件修改时间(ns)
+
+key_cache_path = None  # 派生密钥的磁盘缓存文件，见 set_key_cache_path
+_key_cache = {}  # 派生密钥的内存缓存 {sha256(主密钥+盐值): (解密密钥, HMAC密钥)}
+_key_cache_lock = threading.Lock()
+
+
+def _derive_keys(password: bytes, salt: bytes):
+    """
+    由主密钥和盐值派生出解密密钥和HMAC密钥
+    :param password: 主密钥(32字节)
+    :param salt: 数据库文件开头16字节的盐值
+    :return: (解密密钥, HMAC密钥)
+    """
+    byteKey = hashlib.pbkdf2_hmac("sha1", password, salt, DEFAULT_ITER, KEY_SIZE)
+    mac_salt = bytes([(salt[i] ^ 58) for i in range(16)])
+    mac_key = hashlib.pbkdf2_hmac("sha1", byteKey, mac_salt, 2, KEY_SIZE)
+    return byteKey, mac_key
+
+
+def set_key_cache_path(path):
+    """
+    设置派生密钥的磁盘缓存文件，为None时只使用内存缓存
+    缓存中的密钥和主密钥一样敏感：Windows下每个条目用DPAPI加密，只有当前用户能解开，没有pywin32时不写磁盘；
+    其他平台文件以仅当前用户可读写的权限创建
+    """
+    global key_cache_path
+    key_cache_path = path
+
+
+def _protect_keys(keys: bytes) -> Union[str, None]:
+    """
+    把派生密钥(解密密钥+HMAC密钥)编码为磁盘缓存条目，Windows下用DPAPI加密
+    :return: 缓存条目，无法安全保存时返回None
+    """
+    if os.name != "nt":
+        return keys.hex()
+    if win32crypt is None:
+        return None
+    try:
+        return DPAPI_PREFIX + win32crypt.CryptProtectData(keys, None, None, None, None,
+                                                          CRYPTPROTECT_UI_FORBIDDEN).hex()
+    except Exception:
+        return None
+
+
+def _unprotect_keys(entry) -> Union[bytes, None]:
+    """
+    解开磁盘缓存条目，条目无效、被其他用户加密或是Windows下的明文条目时返回None
+    :return: 解密密钥+HMAC密钥(64字节)
+    """
+    if not isinstance(entry, str):
+        return None  # 旧版本的明文条目
+    try:
+        if entry.startswith(DPAPI_PREFIX):
+            if win32crypt is None:
+                return None
+            keys = win32crypt.CryptUnprotectData(bytes.fromhex(entry[len(DPAPI_PREFIX):]), None, None, None,
+                                                 CRYPTPROTECT_UI_FORBIDDEN)[1]
+        elif os.name == "nt":
+            return None
+        else:
+            keys = bytes.fromhex(entry)
+    except Exception:
+        return None
+    return keys if len(keys) == KEY_SIZE * 2 else None
+
+
+def _load_key_cache() -> dict:
+    if not key_cache_path or not os.path.exists(key_cache_path):
+        return {}
+    try:
+        with open(key_cache_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_key_cache(entries: dict):
+    tmp_path = f"{key_cache_path}.{os.getpid()}.tmp"
+    try:
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, "w", encoding="utf-8") as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, key_cache_path)
+    except OSError:
+        # 缓存只是加速手段，写入失败(如其他进程正在读)时忽略
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def derive_keys(password: bytes, salt: bytes):
+    """
+    带缓存的密钥派生，依次查找内存缓存、磁盘缓存，都未命中时才进行64000次迭代的PBKDF2
+    缓存键为 sha256(主密钥 + 盐值)，只有通过 verify_first_page 验证的密钥才会写入缓存
+    :return: (解密密钥, HMAC密钥)
+    """
+    cache_key = hashlib.sha256(password + salt).hexdigest()
+    keys = _key_cache.get(cache_key)
+    if keys:
+        return keys
+    entry = _unprotect_keys(_load_key_cache().get(cache_key)) if key_cache_path else None
+    if entry:
+        keys = entry[:KEY_SIZE], entry[KEY_SIZE:]
+        _key_cache[cache_key] = keys
+        return keys
+    return _derive_keys(password, salt)
+
+
+def verify_first_page(password: bytes, salt: bytes, first) -> Union[bytes, None]:
+    """
+    用首页的消息认证码验证密钥，验证通过的派生密钥写入缓存
+    :param password: 主密钥(32字节)
+    :param salt: 数据库文件开头16字节的盐值
+    :param first: 首页去掉盐值后的数据，即文件的 [16:4096] 字节
+    :return: 验证通过返回解密密钥，否则返回None
+    """
+    byteKey, mac_key = derive_keys(password, salt)
+    if _page_hmac(mac_key, first, 0) != first[-32:-12]:
+        return None
+    cache_key = hashlib.sha256(password + salt).hexdigest()
+    if cache_key not in _key_cache:
+        _key_cache[cache_key] = byteKey, mac_key
+        entry = _protect_keys(byteKey + mac_key) if key_cache_path else None
+        if entry:
+            with _key_cache_lock:
+                # 顺带清理旧版本的明文条目和已无法解开的条目
+                entries = {k: v for k, v in _load_key_cache().items() if _unprotect_keys(v) is not None}
+                entries[cache_key] = entry
+                _save_key_cache(entries)
+    return byteKey
+
+
+def _page_view(view: memoryview, page_no: int) -> memoryview:
+    """
+    取出加密文件中的第 page_no 页(从0开始)，首页去掉开头16字节的盐值
+    """
+    start = page_no * DEFAULT_PAGESIZE
+    return view[start + (SALT_SIZE if page_no == 0 else 0):start + DEFAULT_PAGESIZE]
+
+
+def _page_hmac(mac_key: bytes, page, page_no: int) -> bytes:
+    """
+    计算一页的消息认证码，page_no 从0开始，参与计算的页号从1开始
+    """
+    hash_mac = hmac.new(mac_key, page[:-32], hashlib.sha1)
+    hash_mac.update((page_no + 1).to_bytes(4, 'little'))
+    return hash_mac.digest()
+
+
+def _decrypt_pages(byteKey: bytes, view: memoryview, start_page: int, stop_page: int, write):
+    """
+    逐页解密 [start_page, stop_page) 范围内的页，解密结果写入复用的输出缓冲区，缓冲区写满后交给 write 落盘
+    :param byteKey: 解密密钥
+    :param view: 加密文件的 memoryview
+    :param write: write(data, offset) 写入解密数据，offset 为 data 在输出文件中的偏移
+    """
+    buffer = bytearray(DEFAULT_PAGESIZE * OUT_BUFFER_PAGES)
+    out = memoryview(buffer)
+    try:
+        for chunk_start in range(start_page, stop_page, OUT_BUFFER_PAGES):
+            chunk_stop = min(chunk_start + OUT_BUFFER_PAGES, stop_page)
+            for page_no in range(chunk_start, chunk_stop):
+                page = _page_view(view, page_no)
+                out_page = out[(page_no - chunk_start) * DEFAULT_PAGESIZE:(page_no - chunk_start + 1) * DEFAULT_PAGESIZE]
+                head = DEFAULT_PAGESIZE - len(page)
+                if head:
+                    out_page[:head] = SQLITE_FILE_HEADER.encode()
+                t = AES.new(byteKey, AES.MODE_CBC, page[-48:-32])
+                t.decrypt(page[:-48], output=out_page[head:-48])
+                out_page[-48:] = page[-48:]
+                page.release()
+                out_page.release()
+            write(out[:(chunk_stop - chunk_start) * DEFAULT_PAGESIZE], chunk_start * DEFAULT_PAGESIZE)
+    finally:
+        out.release()
+
+
+def _decrypt_tail(byteKey: bytes, tail, db_path) -> bytes:
+    """
+    解密文件末尾不足一页的残余数据，与整页相同：末尾48字节原样保留，其余部分按AES-CBC解密
+    残余数据不足48字节或长度不是AES块大小的整数倍时无法解密，打印被截掉的字节数并返回空
+    :param tail: 文件末尾不足一页的数据
+    """
+    tail = bytes(tail)
+    if not tail:
+        return b""
+    if len(tail) < 48 or (len(tail) - 48) % AES.block_size:
+        print(f"[-] db_path:'{db_path}' {len(tail)} trailing bytes are not a whole page, truncated")
+        return b""
+    t = AES.new(byteKey, AES.MODE_CBC, tail[-48:-32])
+    return t.decrypt(tail[:-48]) + tail[-48:]
+
+
+def _check_args(key: str, db_path, out_path=None) -> Union[str, None]:
+    """
+    校验参数，out_path 为None时不检查输出路径
+    :return: 错误信息，参数正确时返回None
+    """
+    if not os.path.exists(db_path) or not os.path.isfile(db_path):
+        return f"[-] db_path:'{db_path}' File not found!"
+    if out_path is not None and not os.path.exists(os.path.dirname(out_path)):
+        return f"[-] out_path:'{out_path}' File not found!"
+
+    if len(key) != 64:
+        return f"[-] key:'{key}' Len Error!"
+
+    if os.path.getsize(db_path) < DEFAULT_PAGESIZE:
+        return f"[-] db_path:'{db_path}' File Error!"
+    return None
+
+
+def _check_key(key: str, db_path, out_path=None):
+    """
+    校验参数并用首页的消息认证码验证密钥，out_path 为None时不检查输出路径
+    :return: (True, 解密密钥) 或 (False, 错误信息)
+    """
+    error = _check_args(key, db_path, out_path)
+    if error:
+        return False, error
+
+    password = bytes.fromhex(key.strip())
+    with open(db_path, "rb") as file:
+        first = file.read(DEFAULT_PAGESIZE)
+
+    byteKey = verify_first_page(password, first[:SALT_SIZE], first[SALT_SIZE:])
+    if byteKey is None:
+        return False, f"[-] Key Error! (key:'{key}'; db_path:'{db_path}'; out_path:'{out_path}' )"
+    return True, byteKey
+
+
+def _page_macs(view: memoryview, pages: int) -> bytes:
+    """
+    取出每一页末尾保存的消息认证码(每页20字节)，页内容一旦变化其消息认证码也随之变化
+    """
+    return b"".join(bytes(_page_view(view, page_no)[-32:-12]) for page_no in range(pages))
+
+
+def _load_manifest(byteKey: bytes, out_path):
+    """
+    读取上次解密时保存在输出文件旁的页消息认证码清单
+    清单与当前密钥不符，或输出文件在解密之后被改动过时返回None
+    """
+    manifest_path = out_path + MANIFEST_SUFFIX
+    if not os.path.exists(manifest_path) or not os.path.exists(out_path):
+        return None
+    with open(manifest_path, "rb") as f:
+        data = f.read()
+    if len(data) < MANIFEST_HEADER.size:
+        return None
+    magic, digest, size, mtime = MANIFEST_HEADER.unpack_from(data)
+    stat = os.stat(out_path)
+    if (magic != MANIFEST_MAGIC or digest != hashlib.sha256(byteKey).digest()
+            or size != stat.st_size or mtime != stat.st_mtime_ns):
+        return None
+    macs = data[MANIFEST_HEADER.size:]
+    if len(macs) != size // DEFAULT_PAGESIZE * 20:
+        return None
+    return macs
+
+
+def _save_manifest(byteKey: bytes, out_path, macs: bytes):
+    stat = os.stat(out_path)
+    tmp_path = f"{out_path}{MANIFEST_SUFFIX}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MANIFEST_HEADER.pack(MANIFEST_MAGIC, hashlib.sha256(byteKey).digest(), stat.st_size,
+                                     stat.st_mtime_ns))
+        f.write(macs)
+    os.replace(tmp_path, out_path + MANIFEST_SUFFIX)
+
+
+def _decrypt_incremental(byteKey: bytes, view: memoryview, db_path, out_path) -> int:
+    """
+    增量解密：逐页对比消息认证码与上次保存的清单，只解密并重写变化的页，输出文件按页数截断或扩展
+    没有可用的清单时完整解密一次并生成清单
+    :return: 重写的页数
+    """
+    pages = len(view) // DEFAULT_PAGESIZE
+    macs = _page_macs(view, pages)
+    with view[pages * DEFAULT_PAGESIZE:] as tail:
+        tail = _decrypt_tail(byteKey, tail, db_path)
+    old_macs = _load_manifest(byteKey, out_path)
+    if old_macs is None:
+        with open(out_path, "wb") as deFile:
+            _decrypt_pages(byteKey, view, 0, pages, lambda data, offset: deFile.write(data))
+            deFile.write(tail)
+        _save_manifest(byteKey, out_path, macs)
+        return pages
+
+    def write(data, offset):
+        deFile.seek(offset)
+        deFile.write(data)
+
+    changed_pages = 0
+    with open(out_path, "r+b") as deFile:
+        deFile.truncate(pages * DEFAULT_PAGESIZE)
+        run_start = None  # 连续变化页的起始页号
+        for page_no in range(pages + 1):
+            changed = page_no < pages and macs[page_no * 20:(page_no + 1) * 20] != old_macs[page_no * 20:(page_no + 1) * 20]
+            if changed and run_start is None:
+                run_start = page_no
+            elif not changed and run_start is not None:
+                _decrypt_pages(byteKey, view, run_start, page_no, write)
+                changed_pages += page_no - run_start
+                run_start = None
+        deFile.seek(pages * DEFAULT_PAGESIZE)
+        deFile.write(tail)
+    _save_manifest(byteKey, out_path, macs)
+    return changed_pages
+
+
+def _write_manifest(byteKey: bytes, db_path, out_path):
+    """
+    为按页拆分并行解密完成的文件生成清单
+    """
+    with open(db_path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+        try:
+            macs = _page_macs(view, len(view) // DEFAULT_PAGESIZE)
+        finally:
+            view.release()
+    _save_manifest(byteKey, out_path, macs)
 
 
 # 通过密钥解密数据库
-def decrypt(key: str, db_path, out_path):
+def decrypt(key: str, db_path, out_path, incremental: bool = False):
     """
     通过密钥解密数据库
+    输入文件通过mmap映射，逐页解密到固定大小的输出缓冲区，内存占用与文件大小无关
     :param key: 密钥 64位16进制字符串
     :param db_path:  待解密的数据库路径(必须是文件)
     :param out_path:  解密后的数据库输出路径(必须是文件)
+    :param incremental: 增量解密，在输出文件旁保存页消息认证码清单(out_path.manifest)，再次解密时只重写变化的页
     :return:
     """
-    if not os.path.exists(db_path) or not os.path.isfile(db_path):
-        return False, f"[-] db_path:'{db_path}' File not found!"
-    if not os.path.exists(os.path.dirname(out_path)):
-        return False, f"[-] out_path:'{out_path}' File not found!"
+    code, byteKey = _check_key(key, db_path, out_path)
+    if not code:
+        return False, byteKey
+
+    with open(db_path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+        try:
+            if incremental:
+                _decrypt_incremental(byteKey, view, db_path, out_path)
+            else:
+                pages = len(view) // DEFAULT_PAGESIZE
+                with open(out_path, "wb") as deFile:
+                    _decrypt_pages(byteKey, view, 0, pages, lambda data, offset: deFile.write(data))
+                    with view[pages * DEFAULT_PAGESIZE:] as tail:
+                        deFile.write(_decrypt_tail(byteKey, tail, db_path))
+        finally:
+            view.release()
+    return True, [db_path, out_path, key]
 
-    if len(key) != 64:
-        return False, f"[-] key:'{key}' Len Error!"
 
-    password = bytes.fromhex(key.strip())
-    with open(db_path, "rb") as file:
-        blist = file.read()
+def decrypt_to_bytes(key: str, db_path):
+    """
+    把数据库解密到内存中，不在磁盘上留下明文
+    :param key: 密钥 64位16进制字符串
+    :param db_path: 待解密的数据库路径(必须是文件)
+    :return: (True, 解密后的数据库 bytearray) 或 (False, 错误信息)
+    """
+    code, byteKey = _check_key(key, db_path)
+    if not code:
+        return False, byteKey
+
+    with open(db_path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+        try:
+            pages = len(view) // DEFAULT_PAGESIZE
+            data = bytearray(pages * DEFAULT_PAGESIZE)
+
+            def write(chunk, offset):
+                data[offset:offset + len(chunk)] = chunk
+
+            _decrypt_pages(byteKey, view, 0, pages, write)
+            with view[pages * DEFAULT_PAGESIZE:] as tail:
+                data += _decrypt_tail(byteKey, tail, db_path)
+        finally:
+            view.release()
+    if data[18:20] == b"\x02\x02":
+        data[18:20] = b"\x01\x01"  # 内存数据库不支持WAL，改为回滚日志模式
+    return True, data
+
+
+def decrypt_to_connection(key: str, db_path, check_same_thread: bool = False):
+    """
+    解密数据库并用 sqlite3.Connection.deserialize (Python 3.11+) 加载为内存数据库连接
+    没有 deserialize 时解密到临时文件，用 backup 复制到内存数据库后删除临时文件
+    :return: (True, sqlite3.Connection) 或 (False, 错误信息)
+    """
+    if not hasattr(sqlite3.Connection, "deserialize"):
+        fd, tmp_path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        try:
+            code, ret = decrypt(key, db_path, tmp_path)
+            if not code:
+                return False, ret
+            conn = sqlite3.connect(":memory:", check_same_thread=check_same_thread)
+            source = sqlite3.connect(tmp_path)
+            try:
+                source.backup(conn)
+            finally:
+                source.close()
+            return True, conn
+        finally:
+            os.remove(tmp_path)
+    code, data = decrypt_to_bytes(key, db_path)
+    if not code:
+        return False, data
+    conn = sqlite3.connect(":memory:", check_same_thread=check_same_thread)
+    conn.deserialize(data)
+    return True, conn
+
+
+def _timed_decrypt_to_bytes(key: str, db_path):
+    """
+    子进程任务：把整个文件解密到内存
+    :return: (decrypt_to_bytes 的返回值, 开始时间, 结束时间)
+    """
+    start = time.time()
+    result = decrypt_to_bytes(key, db_path)
+    return result, start, time.time()
 
-    salt = blist[:16]
-    byteKey = hashlib.pbkdf2_hmac("sha1", password, salt, DEFAULT_ITER, KEY_SIZE)
-    first = blist[16:DEFAULT_PAGESIZE]
-    if len(salt) != 16:
-        return False, f"[-] db_path:'{db_path}' File Error!"
 
-    mac_salt = bytes([(salt[i] ^ 58) for i in range(16)])
-    mac_key = hashlib.pbkdf2_hmac("sha1", byteKey, mac_salt, 2, KEY_SIZE)
-    hash_mac = hmac.new(mac_key, first[:-32], hashlib.sha1)
-    hash_mac.update(b'\x01\x00\x00\x00')
+def iter_decrypt_to_bytes(key: str, db_paths: List[str], processes: int = None, max_bytes: int = IN_FLIGHT_BYTES):
+    """
+    多进程并行把多个数据库解密到内存，按 db_paths 的顺序逐个产出，调用方处理当前文件时后面的文件仍在解密
+    正在解密和等待处理的文件数不超过进程数，总大小不超过 max_bytes(至少有一个文件在处理)，内存占用有上限
+    :param processes: 进程数，默认为CPU核数
+    :param max_bytes: 正在解密和等待处理的文件总大小上限(字节)，包括调用方正在处理的文件
+    :return: 生成器，产出 (index, (True, bytearray) 或 (False, 错误信息), speed)，speed为解密速度(MB/s)
+    """
+    processes = processes or os.cpu_count() or 1
+    sizes = [os.path.getsize(db_path) if os.path.isfile(db_path) else 0 for db_path in db_paths]
+    with ProcessPoolExecutor(max_workers=processes, initializer=set_key_cache_path,
+                             initargs=(key_cache_path,)) as executor:
+        pending = deque()
+        next_index = 0
+        in_flight = 0  # 已提交但调用方还没处理完的文件总大小
+
+        def submit():
+            nonlocal next_index, in_flight
+            while next_index < len(db_paths) and len(pending) < processes and (
+                    not in_flight or in_flight + sizes[next_index] <= max_bytes):
+                db_path = db_paths[next_index]
+                pending.append((next_index, db_path, executor.submit(_timed_decrypt_to_bytes, key, db_path)))
+                in_flight += sizes[next_index]
+                next_index += 1
+
+        submit()
+        while pending:
+            index, db_path, future = pending.popleft()
+            try:
+                result, start, end = future.result()
+            except Exception as e:
+                result, start, end = (False, f"[-] db_path:'{db_path}' Decrypt Error! {e}"), 0, 0
+            submit()
+            size = sizes[index] if result[0] else 0
+            yield index, result, size / 1024 / 1024 / max(end - start, 1e-6)
+            del result
+            in_flight -= sizes[index]
+            submit()
+
+
+def _pwrite(fd, data, offset):
+    """
+    在输出文件的指定偏移处写入数据，没有 os.pwrite 的平台(Windows)退化为 lseek + write
+    """
+    view = memoryview(data)
+    while len(view):
+        if hasattr(os, "pwrite"):
+            n = os.pwrite(fd, view, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            n = os.write(fd, view)
+        view = view[n:]
+        offset += n
 
-    if hash_mac.digest() != first[-32:-12]:
-        return False, f"[-] Key Error! (key:'{key}'; db_path:'{db_path}'; out_path:'{out_path}' )"
 
-    newblist = [blist[i:i + DEFAULT_PAGESIZE] for i in range(DEFAULT_PAGESIZE, len(blist), DEFAULT_PAGESIZE)]
+def _timed_decrypt(key: str, db_path, out_path, incremental: bool = False):
+    """
+    子进程任务：解密整个文件
+    :return: (decrypt 的返回值, 开始时间, 结束时间)
+    """
+    start = time.time()
+    result = decrypt(key, db_path, out_path, incremental)
+    return result, start, time.time()
 
-    with open(out_path, "wb") as deFile:
-        deFile.write(SQLITE_FILE_HEADER.encode())
-        t = AES.new(byteKey, AES.MODE_CBC, first[-48:-32])
-        decrypted = t.decrypt(first[:-48])
-        deFile.write(decrypted)
-        deFile.write(first[-48:])
 
-        for i in newblist:
-            t = AES.new(byteKey, AES.MODE_CBC, i[-48:-32])
-            decrypted = t.decrypt(i[:-48])
-            deFile.write(decrypted)
-            deFile.write(i[-48:])
-    return True, [db_path, out_path, key]
+def _decrypt_range(byteKey: bytes, db_path, out_path, start_page: int, stop_page: int):
+    """
+    子进程任务：解密一个文件中 [start_page, stop_page) 范围内的页，直接写到输出文件的最终偏移处
+    :return: (True, 开始时间, 结束时间)
+    """
+    start = time.time()
+    fd = os.open(out_path, os.O_WRONLY | getattr(os, "O_BINARY", 0))
+    try:
+        with open(db_path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                _decrypt_pages(byteKey, view, start_page, stop_page, lambda data, offset: _pwrite(fd, data, offset))
+            finally:
+                view.release()
+    finally:
+        os.close(fd)
+    return True, start, time.time()
+
+
+def decrypt_tasks(tasks: List[list], processes: int = None, callback=None, incremental: bool = False):
+    """
+    多进程并行解密多个数据库
+    每个文件作为一个任务交给进程池，超过 SPLIT_FILE_SIZE 的大文件按页拆分成多个任务，各自写到输出文件的最终偏移处
+    :param tasks: [[key, db_path, out_path], ...]
+    :param processes: 进程数，默认为CPU核数；为1时在当前进程中逐个解密
+    :param callback: callback(index, result, speed) 每个文件解密完成后调用，speed为该文件的解密速度(MB/s)
+    :param incremental: 增量解密，见 decrypt；已有清单的大文件不再拆分，直接整体增量解密
+    :return: 与 tasks 一一对应的 decrypt 返回值列表
+    """
+    results = [None] * len(tasks)
+
+    def finish(index, result, start, end):
+        results[index] = result
+        if callback:
+            size = os.path.getsize(tasks[index][1]) if result[0] else 0
+            callback(index, result, size / 1024 / 1024 / max(end - start, 1e-6))
+
+    if processes == 1:
+        for index, task in enumerate(tasks):
+            finish(index, *_timed_decrypt(*task, incremental))
+        return results
+
+    with ProcessPoolExecutor(max_workers=processes, initializer=set_key_cache_path,
+                             initargs=(key_cache_path,)) as executor:
+        futures = {}
+        ranges = {}  # 拆分文件的 index -> [剩余任务数, 最早开始时间, 最晚结束时间, 错误信息, 解密密钥]
+        for index, (key, db_path, out_path) in enumerate(tasks):
+            if not os.path.isfile(db_path) or os.path.getsize(db_path) < SPLIT_FILE_SIZE:
+                futures[executor.submit(_timed_decrypt, key, db_path, out_path, incremental)] = index
+                continue
+            code, byteKey = _check_key(key, db_path, out_path)
+            if not code:
+                finish(index, (False, byteKey), 0, 0)
+                continue
+            if incremental and _load_manifest(byteKey, out_path) is not None:
+                futures[executor.submit(_timed_decrypt, key, db_path, out_path, incremental)] = index
+                continue
+            pages = os.path.getsize(db_path) // DEFAULT_PAGESIZE
+            with open(db_path, "rb") as file:
+                file.seek(pages * DEFAULT_PAGESIZE)
+                tail = _decrypt_tail(byteKey, file.read(), db_path)
+            with open(out_path, "wb") as deFile:
+                deFile.truncate(pages * DEFAULT_PAGESIZE)
+                deFile.seek(pages * DEFAULT_PAGESIZE)
+                deFile.write(tail)
+            starts = range(0, pages, SPLIT_PAGES)
+            ranges[index] = [len(starts), float("inf"), 0, None, byteKey]
+            for start_page in starts:
+                stop_page = min(start_page + SPLIT_PAGES, pages)
+                futures[executor.submit(_decrypt_range, byteKey, db_path, out_path, start_page, stop_page)] = index
+
+        for future in as_completed(futures):
+            index = futures[future]
+            key, db_path, out_path = tasks[index]
+            try:
+                result, start, end = future.result()
+            except Exception as e:
+                result, start, end = (False, f"[-] db_path:'{db_path}' Decrypt Error! {e}"), 0, 0
+            if index not in ranges:
+                finish(index, result, start, end)
+                continue
+            state = ranges[index]
+            state[0] -= 1
+            state[1] = min(state[1], start)
+            state[2] = max(state[2], end)
+            if result is not True:
+                state[3] = result
+            if state[0] == 0:
+                if incremental and state[3] is None:
+                    _write_manifest(state[4], db_path, out_path)
+                finish(index, state[3] or (True, [db_path, out_path, key]), state[1], state[2])
+    return results
+
+
+def _verify_range(mac_key: bytes, db_path, start_page: int, stop_page: int):
+    """
+    子进程任务：校验 [start_page, stop_page) 范围内每一页的消息认证码
+    :return: (校验失败的页号列表, 开始时间, 结束时间)
+    """
+    start = time.time()
+    bad_pages = []
+    with open(db_path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+        try:
+            for page_no in range(start_page, stop_page):
+                page = _page_view(view, page_no)
+                if _page_hmac(mac_key, page, page_no) != page[-32:-12]:
+                    bad_pages.append(page_no)
+                page.release()
+        finally:
+            view.release()
+    return bad_pages, start, time.time()
+
+
+def verify_files(key: str, db_paths: List[str], processes: int = None):
+    """
+    只校验不解密：计算每一页的HMAC-SHA1并与页末保存的消息认证码比对，不写任何文件
+    所有文件按页拆分成若干范围交给同一个进程池，小文件多时也能用满所有CPU核
+    首页校验失败(密钥错误或文件头损坏)与其他页一样记为损坏页，不再单独报密钥错误
+    :param key: 密钥 64位16进制字符串
+    :param db_paths: 待校验的数据库路径列表
+    :param processes: 进程数，默认为CPU核数；为1时在当前进程中校验
+    :return: 与 db_paths 一一对应的列表，每项为
+             (是否全部通过, {'db_path', 'pages': 总页数, 'bad_pages': 损坏的页号,
+                            'speed': MB/s，按这个文件各范围在工作进程中的耗时之和计算，不受其他文件同时校验的影响})，
+             参数错误时为 (False, 错误信息)
+    """
+    processes = processes or os.cpu_count() or 1
+    results = [None] * len(db_paths)
+    indexes = []
+    for index, db_path in enumerate(db_paths):
+        error = _check_args(key, db_path)
+        if error:
+            results[index] = (False, error)
+        else:
+            indexes.append(index)
+    if not indexes:
+        return results
+
+    password = bytes.fromhex(key.strip())
+    salts = []
+    for index in indexes:
+        with open(db_paths[index], "rb") as file:
+            salts.append(file.read(SALT_SIZE))
+    sizes = {index: os.path.getsize(db_paths[index]) for index in indexes}
+    total_pages = sum(size // DEFAULT_PAGESIZE for size in sizes.values())
+    # 每个范围不超过 SPLIT_PAGES 页，总页数较少时切得更细，让每个进程分到若干个范围
+    step = max(OUT_BUFFER_PAGES, min(SPLIT_PAGES, -(-total_pages // (processes * 4))))
+    bad_pages = {index: [] for index in indexes}
+    times = {index: 0 for index in indexes}  # 每个文件各范围的校验耗时之和
+
+    def finish(index, result):
+        pages, start, end = result
+        bad_pages[index].extend(pages)
+        times[index] += end - start
+
+    if processes == 1:
+        for index, salt in zip(indexes, salts):
+            mac_key = derive_keys(password, salt)[1]
+            finish(index, _verify_range(mac_key, db_paths[index], 0, sizes[index] // DEFAULT_PAGESIZE))
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            mac_keys = [keys[1] for keys in executor.map(derive_keys, [password] * len(salts), salts)]
+            futures = {}
+            for index, mac_key in zip(indexes, mac_keys):
+                pages = sizes[index] // DEFAULT_PAGESIZE
+                for start_page in range(0, pages, step):
+                    future = executor.submit(_verify_range, mac_key, db_paths[index], start_page,
+                                             min(start_page + step, pages))
+                    futures[future] = index
+            for future in as_completed(futures):
+                finish(futures[future], future.result())
+
+    for index in indexes:
+        size = sizes[index]
+        pages = size // DEFAULT_PAGESIZE
+        bad_pages[index].sort()
+        if size % DEFAULT_PAGESIZE:
+            bad_pages[index].append(pages)  # 文件被截断，最后一页不完整
+        info = {
+            'db_path': db_paths[index],
+            'pages': pages + (1 if size % DEFAULT_PAGESIZE else 0),
+            'bad_pages': bad_pages[index],
+            'speed': size / 1024 / 1024 / max(times[index], 1e-6),
+        }
+        results[index] = (not bad_pages[index], info)
+    return results
+
+
+def verify(key: str, db_path, processes: int = None):
+    """
+    校验单个数据库，见 verify_files
+    可在解密、合并之前检查数据库是否被截断或损坏
+    :return: (是否全部通过, {'db_path', 'pages': 总页数, 'bad_pages': 损坏的页号, 'speed': MB/s})
+             参数错误时返回 (False, 错误信息)
+    """
+    return verify_files(key, [db_path], processes)[0]
 
 
-def batch_decrypt(key: str, db_path: Union[str, List[str]], out_path: str, is_logging: bool = False):
+def batch_decrypt(key: str, db_path: Union[str, List[str]], out_path: str, is_logging: bool = False,
+                  processes: int = 1, callback=None, incremental: bool = False):
+    """
+    批量解密数据库
+    :param processes: 并行解密的进程数，默认1即串行解密；None表示使用全部CPU核
+    :param callback: callback(index, result, speed) 每个文件解密完成后调用，见 decrypt_tasks
+    :param incremental: 增量解密，只重写上次解密后变化的页，见 decrypt
+    """
     if not isinstance(key, str) or not isinstance(out_path, str) or not os.path.exists(out_path) or len(key) != 64:
         error = f"[-] (key:'{key}' or out_path:'{out_path}') Error!"
         if is_logging: print(error)
@@ -136,9 +802,7 @@ def batch_decrypt(key: str, db_path: Union[str, List[str]], out_path: str, is_lo
         if is_logging: print(error)
         return False, error
 
-    result = []
-    for i in process_list:
-        result.append(decrypt(*i))  # 解密
+    result = decrypt_tasks(process_list, processes, callback, incremental)  # 解密
 
     # 删除空文件夹
     for root, dirs, files in os.walk(out_path, topdown=False):
@@ -204,4 +868,32 @@ def encrypt(key: str, db_path, out_path):
             encrypted = t.encrypt(i)  # 加密数据块
             enFile.write(encrypted)
 
-    return True, [db_path, out_path, key]
\ No newline at end of file
+    return True, [db_path, out_path, key]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="解密微信数据库")
+    parser.add_argument("-k", "--key", required=True, help="密钥 64位16进制字符串")
+    parser.add_argument("-i", "--db_path", required=True, help="待解密的数据库文件或文件夹")
+    parser.add_argument("-o", "--out_path", help="解密后的输出文件夹")
+    parser.add_argument("-p", "--processes", type=int, default=1, help="并行解密的进程数，0表示使用全部CPU核")
+    parser.add_argument("--incremental", action="store_true", help="增量解密，只重写上次解密后变化的页")
+    parser.add_argument("--verify", action="store_true", help="只校验每一页的消息认证码，不解密")
+    args = parser.parse_args()
+    if args.verify:
+        if os.path.isdir(args.db_path):
+            db_paths = [os.path.join(root, file) for root, dirs, files in os.walk(args.db_path) for file in files]
+        else:
+            db_paths = [args.db_path]
+        for path, (code, ret) in zip(db_paths, verify_files(args.key, db_paths, args.processes or None)):
+            if isinstance(ret, str):
+                print(ret)
+            else:
+                print(f'[{"+" if code else "-"}] "{path}" 共 {ret["pages"]} 页, 损坏 {len(ret["bad_pages"])} 页'
+                      f'{ret["bad_pages"][:20] if ret["bad_pages"] else ""}, {ret["speed"]:.1f}MB/s'
+                      f'{" (首页校验失败，密钥错误或文件头损坏)" if 0 in ret["bad_pages"] else ""}')
+        sys.exit(0)
+    if not args.out_path:
+        parser.error("the following arguments are required: -o/--out_path")
+    batch_decrypt(args.key, args.db_path, args.out_path, is_logging=True, processes=args.processes or None,
+                  incremental=args.incremental)
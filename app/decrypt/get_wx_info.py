@@ -5,8 +5,6 @@
 # Author:       xaoyaoo
 # Date:         2023/08/21
 # -------------------------------------------------------------------------------
-import hmac
-import hashlib
 import ctypes
 import winreg
 import pymem
@@ -21,6 +19,8 @@ import pymem.process
 from pymem import Pymem
 from win32api import GetFileVersionInfo, HIWORD, LOWORD
 
+from app.decrypt.decrypt import verify_first_page
+
 """
 class Wechat来源：https://github.com/SnowMeteors/GetWeChatKey
 """
@@ -302,23 +302,12 @@ def get_key(db_path, addr_len):
     def verify_key(key, wx_db_path):
         if not wx_db_path or wx_db_path.lower() == "none":
             return True
-        KEY_SIZE = 32
         DEFAULT_PAGESIZE = 4096
-        DEFAULT_ITER = 64000
         with open(wx_db_path, "rb") as file:
             blist = file.read(5000)
         salt = blist[:16]
-        byteKey = hashlib.pbkdf2_hmac("sha1", key, salt, DEFAULT_ITER, KEY_SIZE)
         first = blist[16:DEFAULT_PAGESIZE]
-
-        mac_salt = bytes([(salt[i] ^ 58) for i in range(16)])
-        mac_key = hashlib.pbkdf2_hmac("sha1", byteKey, mac_salt, 2, KEY_SIZE)
-        hash_mac = hmac.new(mac_key, first[:-32], hashlib.sha1)
-        hash_mac.update(b'\x01\x00\x00\x00')
-
-        if hash_mac.digest() != first[-32:-12]:
-            return False
-        return True
+        return verify_first_page(key, salt, first) is not None
 
     phone_type1 = "iphone\x00"
     phone_type2 = "android\x00"
@@ -83,13 +83,13 @@ class ChatInfo(QWidget):
 
     def get_avatar_path(self, is_send, message, is_absolute_path=False) -> str:
         if self.contact.is_chatroom:
-            avatar = message[13].smallHeadImgUrl
+            avatar = message.sender.smallHeadImgUrl
         else:
             avatar = Me().smallHeadImgUrl if is_send else self.contact.smallHeadImgUrl
         if is_absolute_path:
             if self.contact.is_chatroom:
-                # message[13].save_avatar()
-                avatar = message[13].avatar
+                # message.sender.save_avatar()
+                avatar = message.sender.avatar
             else:
                 avatar = Me().avatar if is_send else self.contact.avatar
         return avatar
@@ -99,7 +99,7 @@ class ChatInfo(QWidget):
             if is_send:
                 display_name = Me().name
             else:
-                display_name = message[13].remark
+                display_name = message.sender.remark
         else:
             display_name = None
         return display_name
@@ -168,7 +168,7 @@ class ChatInfo(QWidget):
 
 
 class ShowChatThread(QThread):
-    showSingal = pyqtSignal(tuple)
+    showSingal = pyqtSignal(object)
     finishSingal = pyqtSignal(int)
     msg_id = 0
 
@@ -1,5 +1,6 @@
 import json
 import os.path
+import re
 import sys
 import traceback
 from urllib.parse import urljoin
@@ -10,9 +11,9 @@ from PyQt5.QtGui import QDesktopServices
 from PyQt5.QtWidgets import QWidget, QMessageBox, QFileDialog
 
 from app.DataBase import msg_db, misc_db, close_db
-from app.DataBase.merge import merge_databases, merge_MediaMSG_databases
+from app.DataBase.merge import decrypt_merge
 from app.components.QCursorGif import QCursorGif
-from app.config import INFO_FILE_PATH, DB_DIR, SERVER_API_URL
+from app.config import INFO_FILE_PATH, DB_DIR, SERVER_API_URL, KEY_CACHE_PATH, MERGE_MSG_SHARDS
 from app.decrypt import get_wx_info, decrypt
 from app.log import logger
 from app.util import path
@@ -48,6 +49,7 @@ class DecryptControl(QWidget, decryptUi.Ui_Dialog, QCursorGif):
         self.lineEdit.setFocus()
         self.ready = False
         self.wx_dir = None
+        decrypt.set_key_cache_path(KEY_CACHE_PATH)
 
     def show_help(self):
         # 定义网页链接
@@ -208,10 +210,19 @@ class DecryptThread(QThread):
         self.db_path = db_path
         self.key = key
         self.textBrowser = None
+        self.finished_num = 0
 
     def __del__(self):
         pass
 
+    def decrypt_callback(self, index, result, speed):
+        if result[0]:
+            logger.info(f'{result[1][0]} 解密完成 {speed:.1f}MB/s')
+        else:
+            logger.warning(result[1])
+        self.signal.emit(str(self.finished_num))
+        self.finished_num += 1
+
     def run(self):
         close_db()
         output_dir = DB_DIR
@@ -237,48 +248,32 @@ class DecryptThread(QThread):
                                 tasks.append([self.key, inpath, output_path])
                         except:
                             continue
+        # MSG*.db 和 MediaMSG*.db 分片解密后直接合并，分片的明文不落盘
+        # 不合并 MSG 分片时各分片单独解密保存，由 Msg 联合查询
+        shards = {'MSG': [], 'MediaMSG': []}
+        other_tasks = []
+        for task in tasks:
+            match = re.match(r'^(MSG|MediaMSG)(\d+)\.db$', os.path.basename(task[2]))
+            if match and (MERGE_MSG_SHARDS or match.group(1) == 'MediaMSG'):
+                shards[match.group(1)].append((int(match.group(2)), task[1]))
+            else:
+                other_tasks.append(task)
+        if not MERGE_MSG_SHARDS:
+            shards.pop('MSG')
+            # 之前合并的 MSG.db 会优先于分片被读取，需要删除
+            if os.path.exists(os.path.join(output_dir, 'MSG.db')):
+                os.remove(os.path.join(output_dir, 'MSG.db'))
         self.maxNumSignal.emit(len(tasks))
-        for i, task in enumerate(tasks):
-            if decrypt.decrypt(*task) == -1:
+        self.finished_num = 0
+        decrypt.decrypt_tasks(other_tasks, processes=None, callback=self.decrypt_callback, incremental=True)
+        for name, source_databases in shards.items():
+            # 目标数据库文件，以第一个分片为模板合并其余分片
+            target_database = os.path.join(DB_DIR, f'{name}.db')
+            source_databases = [inpath for _, inpath in sorted(source_databases)]
+            if not decrypt_merge(self.key, source_databases, target_database, callback=self.decrypt_callback,
+                                 incremental=True):
+                logger.error(f'{name}数据库不存在\n请检查微信版本是否为最新')
                 self.errorSignal.emit(True)
-            self.signal.emit(str(i))
-        # print(self.db_path)
-        # 目标数据库文件
-        target_database = os.path.join(DB_DIR, 'MSG.db')
-        # 源数据库文件列表
-        source_databases = [os.path.join(DB_DIR, f"MSG{i}.db") for i in range(1, 50)]
-        import shutil
-        if os.path.exists(target_database):
-            os.remove(target_database)
-        try:
-            shutil.copy2(os.path.join(DB_DIR, 'MSG0.db'), target_database)  # 使用一个数据库文件作为模板
-        except FileNotFoundError:
-            logger.error(traceback.format_exc())
-            self.errorSignal.emit(True)
-        # 合并数据库
-        try:
-            merge_databases(source_databases, target_database)
-        except FileNotFoundError:
-            logger.error(traceback.format_exc())
-            QMessageBox.critical("错误", "数据库不存在\n请检查微信版本是否为最新")
-
-        # 音频数据库文件
-        target_database = os.path.join(DB_DIR, 'MediaMSG.db')
-        # 源数据库文件列表
-        if os.path.exists(target_database):
-            os.remove(target_database)
-        source_databases = [os.path.join(DB_DIR, f"MediaMSG{i}.db") for i in range(1, 50)]
-        try:
-            shutil.copy2(os.path.join(DB_DIR, 'MediaMSG0.db'), target_database)  # 使用一个数据库文件作为模板
-        except FileNotFoundError:
-            logger.error(traceback.format_exc())
-            self.errorSignal.emit(True)
-        # 合并数据库
-        try:
-            merge_MediaMSG_databases(source_databases, target_database)
-        except FileNotFoundError:
-            logger.error(traceback.format_exc())
-            QMessageBox.critical("错误", "数据库不存在\n请检查微信版本是否为最新")
         self.okSignal.emit('ok')
         # self.signal.emit('100')
 
@@ -8,7 +8,7 @@ import re
 from urllib.parse import urlparse
 from bs4 import BeautifulSoup
 
-from app.util.protocbuf.msg_pb2 import MessageBytesExtra
+from app.util.protocbuf.bytes_extra import get_message2, get_message2_fields, file_storage_path
 from ..util.file import get_file
 
 
@@ -145,17 +145,8 @@ def share_card(bytesExtra, compress_content_):
         else:
             if appinfo is not None:
                 show_display_name = appinfo.find("appname").text
-        msg_bytes = MessageBytesExtra()
-        msg_bytes.ParseFromString(bytesExtra)
         app_logo = ""
-        thumbnail = ""
-        for tmp in msg_bytes.message2:
-            if tmp.field1 == 3:
-                thumbnail = tmp.field2
-                thumbnail = "\\".join(thumbnail.split("\\")[1:])
-            if tmp.field2 == 4:
-                app_logo = tmp.field2
-                app_logo = "\\".join(app_logo.split("\\")[1:])
+        thumbnail = file_storage_path(get_message2(bytesExtra, 3))
         if sourceusername is not None:
             from app.DataBase import micro_msg_db  # 放上面会导致循环依赖
 
@@ -208,14 +199,12 @@ def call_decompress(is_send, bytes_extra, display_content, str_content):  # 音
     """
     call_type = 2
     call_length = 0
-    msg_bytes = MessageBytesExtra()
-    msg_bytes.ParseFromString(bytes_extra)
     # message2 字段 1: 发送人wxid; 字段 3: "1"是语音，"0"是视频; 字段 4: 通话时长
-    for i in msg_bytes.message2:
-        if i.field1 == 3:
-            call_type = int(i.field2)
-        elif i.field1 == 4:
-            call_length = int(i.field2)
+    fields = get_message2_fields(bytes_extra, (3, 4))
+    if 3 in fields:
+        call_type = int(fields[3])
+    if 4 in fields:
+        call_length = int(fields[4])
 
     try:
         if display_content == "":
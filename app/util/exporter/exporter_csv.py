@@ -1,5 +1,6 @@
 import csv
 import os
+from itertools import chain
 
 from app.DataBase import msg_db
 from app.util.exporter.exporter import ExporterBase
@@ -15,7 +16,7 @@ class CSVExporter(ExporterBase):
         columns = ['localId', 'TalkerId', 'Type', 'SubType',
                    'IsSender', 'CreateTime', 'Status', 'StrContent',
                    'StrTime', 'Remark', 'NickName', 'Sender']
-        messages = msg_db.get_messages(self.contact.wxid, time_range=self.time_range)
+        messages = chain.from_iterable(msg_db.iter_messages(self.contact.wxid, time_range=self.time_range))
         # 写入CSV文件
         with open(filename, mode='w', newline='', encoding='utf-8-sig') as file:
             writer = csv.writer(file)
@@ -23,7 +24,7 @@ class CSVExporter(ExporterBase):
             # 写入数据
             # writer.writerows(messages)
             for msg in messages:
-                other_data = [msg[13].remark, msg[13].nickName, msg[13].wxid] if self.contact.is_chatroom else []
+                other_data = [msg.sender.remark, msg.sender.nickName, msg.sender.wxid] if self.contact.is_chatroom else []
                 writer.writerow([*msg[:9], *other_data])
         print(f"【完成导出 CSV {self.contact.remark}】")
         self.okSignal.emit(1)
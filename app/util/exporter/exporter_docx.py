@@ -1,6 +1,7 @@
 import os
 import shutil
 import time
+from itertools import chain
 from re import findall
 
 import docx
@@ -306,21 +307,13 @@ class DocxExporter(ExporterBase):
     def export(self):
         print(f"【开始导出 DOCX {self.contact.remark}】")
         origin_path = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', self.contact.remark)
-        messages = msg_db.get_messages(self.contact.wxid, time_range=self.time_range)
+        total_num = msg_db.count_messages(self.contact.wxid, time_range=self.time_range)
         Me().save_avatar(os.path.join(origin_path, 'avatar', f'{Me().wxid}.png'))
-        if self.contact.is_chatroom:
-            for message in messages:
-                if message[4]:  # is_send
-                    continue
-                try:
-                    chatroom_avatar_path =os.path.join(origin_path, 'avatar', f'{message[13].wxid}.png')
-                    message[13].save_avatar(chatroom_avatar_path)
-                except:
-                    print(message)
-                    pass
-        else:
+        if not self.contact.is_chatroom:
             self.contact.save_avatar(os.path.join(origin_path, 'avatar', f'{self.contact.wxid}.png'))
-        self.rangeSignal.emit(len(messages))
+        saved_avatars = set()  # 已保存头像的群成员，群成员的头像在导出时遇到他发的第一条消息才保存
+        self.rangeSignal.emit(total_num)
+        messages = chain.from_iterable(msg_db.iter_messages(self.contact.wxid, time_range=self.time_range))
 
         def newdoc():
             nonlocal n, doc
@@ -344,6 +337,14 @@ class DocxExporter(ExporterBase):
             sub_type = message[3]
             timestamp = message[5]
             self.progressSignal.emit(1)
+            if self.contact.is_chatroom and not message[4]:
+                try:
+                    if message.sender.wxid not in saved_avatars:
+                        saved_avatars.add(message.sender.wxid)
+                        chatroom_avatar_path = os.path.join(origin_path, 'avatar', f'{message.sender.wxid}.png')
+                        message.sender.save_avatar(chatroom_avatar_path)
+                except:
+                    print(message)
             if self.is_5_min(timestamp):
                 str_time = message[8]
                 doc.add_paragraph(str_time).alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
@@ -364,9 +365,9 @@ class DocxExporter(ExporterBase):
             elif type_ == 49 and sub_type == 6 and self.message_types.get(4906):
                 self.file(doc, message)
             if index % 25 == 0:
-                print(f"【导出 DOCX {self.contact.remark}】{index}/{len(messages)}")
+                print(f"【导出 DOCX {self.contact.remark}】{index}/{total_num}")
         if index % 25:
-            print(f"【导出 DOCX {self.contact.remark}】{index + 1}/{len(messages)}")
+            print(f"【导出 DOCX {self.contact.remark}】{index + 1}/{total_num}")
         filename = os.path.join(origin_path, f"{self.contact.remark}_{n}.docx")
         try:
             # document.save(filename)
@@ -2,6 +2,7 @@ import os
 import shutil
 import sys
 import traceback
+from itertools import chain
 from re import findall
 
 from PyQt5.QtCore import pyqtSignal, QThread
@@ -298,7 +299,8 @@ class HtmlExporter(ExporterBase):
 
     def export(self):
         print(f"【开始导出 HTML {self.contact.remark}】")
-        messages = msg_db.get_messages(self.contact.wxid, time_range=self.time_range)
+        messages = chain.from_iterable(msg_db.iter_messages(self.contact.wxid, time_range=self.time_range))
+        total_num = msg_db.count_messages(self.contact.wxid, time_range=self.time_range)
         filename = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', self.contact.remark,
                                 f'{self.contact.remark}.html')
         file_path = './app/resources/data/template.html'
@@ -313,7 +315,7 @@ class HtmlExporter(ExporterBase):
         html_head = html_head.replace("<title>出错了</title>", f"<title>{self.contact.remark}</title>")
         html_head = html_head.replace("<p id=\"title\">出错了</p>", f"<p id=\"title\">{self.contact.remark}</p>")
         f.write(html_head)
-        self.rangeSignal.emit(len(messages))
+        self.rangeSignal.emit(total_num)
         for index, message in enumerate(messages):
             type_ = message[2]
             sub_type = message[3]
@@ -349,10 +351,10 @@ class HtmlExporter(ExporterBase):
             elif type_ == 50 and self.message_types.get(50):
                 self.call(f, message)
             if index % 2000 == 0:
-                print(f"【导出 HTML {self.contact.remark}】{index}/{len(messages)}")
+                print(f"【导出 HTML {self.contact.remark}】{index}/{total_num}")
         f.write(html_end)
         f.close()
-        print(f"【完成导出 HTML {self.contact.remark}】{len(messages)}")
+        print(f"【完成导出 HTML {self.contact.remark}】{total_num}")
         self.count_finish_num(1)
 
     def count_finish_num(self, num):
@@ -1,4 +1,5 @@
 import os
+from itertools import chain
 
 from app.DataBase import msg_db
 from app.util.exporter.exporter import ExporterBase
@@ -115,8 +116,8 @@ class TxtExporter(ExporterBase):
         origin_path = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', self.contact.remark)
         os.makedirs(origin_path, exist_ok=True)
         filename = os.path.join(origin_path, self.contact.remark+'.txt')
-        messages = msg_db.get_messages(self.contact.wxid, time_range=self.time_range)
-        total_steps = len(messages)
+        messages = chain.from_iterable(msg_db.iter_messages(self.contact.wxid, time_range=self.time_range))
+        total_steps = msg_db.count_messages(self.contact.wxid, time_range=self.time_range)
         with open(filename, mode='w', newline='', encoding='utf-8') as f:
             for index, message in enumerate(messages):
                 type_ = message[2]
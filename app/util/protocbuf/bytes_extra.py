@@ -0,0 +1,273 @@
+"""
+直接扫描 protobuf 编码的字段，只取需要的字段，不用 msg_pb2.MessageBytesExtra 解析出整个消息对象
+MessageBytesExtra 的结构见 msg.proto
+"""
+
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_LENGTH_DELIMITED = 2
+WIRE_FIXED32 = 5
+
+# MessageBytesExtra.message2 的字段号
+MESSAGE2_FIELD = 3
+# message2.field1 的取值
+MESSAGE2_SENDER = 1  # 群聊消息的发送人
+
+
+def _read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+        if shift >= 64:
+            raise ValueError('varint too long')
+
+
+def iter_fields(buf, start=0, end=None):
+    """
+    依次读取 buf[start:end] 中的字段，长度分隔字段只返回位置，不复制也不解码
+    @param buf: bytes 或 memoryview
+    @return: 生成器 (字段号, wire type, 值)，varint 和定长字段的值为整数，长度分隔字段的值为 (起始, 结束) 偏移
+    """
+    end = len(buf) if end is None else end
+    pos = start
+    while pos < end:
+        key, pos = _read_varint(buf, pos)
+        wire_type = key & 7
+        if wire_type == WIRE_VARINT:
+            value, pos = _read_varint(buf, pos)
+        elif wire_type == WIRE_LENGTH_DELIMITED:
+            length, pos = _read_varint(buf, pos)
+            value = (pos, pos + length)
+            pos += length
+        elif wire_type == WIRE_FIXED64:
+            value = int.from_bytes(buf[pos:pos + 8], 'little')
+            pos += 8
+        elif wire_type == WIRE_FIXED32:
+            value = int.from_bytes(buf[pos:pos + 4], 'little')
+            pos += 4
+        else:
+            raise ValueError(f'unsupported wire type {wire_type}')
+        if pos > end:
+            raise ValueError('truncated message')
+        yield key >> 3, wire_type, value
+
+
+def _skip_field(buf, pos, wire_type):
+    if wire_type == WIRE_VARINT:
+        return _read_varint(buf, pos)[1]
+    if wire_type == WIRE_LENGTH_DELIMITED:
+        length, pos = _read_varint(buf, pos)
+        return pos + length
+    if wire_type == WIRE_FIXED64:
+        return pos + 8
+    if wire_type == WIRE_FIXED32:
+        return pos + 4
+    raise ValueError(f'unsupported wire type {wire_type}')
+
+
+def _parse_message2(buf, start, end):
+    """
+    逐个字段读取一个 message2
+    @return: (field1, field2 的 (起始, 结束) 或 None)
+    """
+    field1 = 0
+    field2 = None
+    for number, wire_type, value in iter_fields(buf, start, end):
+        if number == 1 and wire_type == WIRE_VARINT:
+            field1 = value
+        elif number == 2 and wire_type == WIRE_LENGTH_DELIMITED:
+            field2 = value
+    return field1, field2
+
+
+def _scan_message2(buf, wanted, first=False):
+    """
+    扫描 message2，记录 field1 在 wanted 中的 field2 的位置
+    @param buf: BytesExtra，bytes 或 memoryview
+    @param wanted: 需要的 field1 集合
+    @param first: True 时每个 field1 只取第一个，全部找到后立即返回；否则取最后一个，和 ParseFromString 之后遍历覆盖的结果一致
+    @return: {field1: (起始, 结束)}；数据损坏时返回损坏之前找到的部分
+    """
+    found = {}
+    end = len(buf)
+    pos = 0
+    # 这是读每条消息都要走的热路径，函数调用的开销比解析本身还大，所以都写在一个循环里：
+    # 单字节的 tag、长度占绝大多数，直接读，多字节的才调用 _read_varint；
+    # 微信写出的 message2 都是 field1、field2 依次各出现一次，直接按这个顺序读，不是这样的再用 _parse_message2 逐个字段读
+    try:
+        while pos < end:
+            key = buf[pos]
+            if key < 0x80:
+                pos += 1
+            else:
+                key, pos = _read_varint(buf, pos)
+            if key != (MESSAGE2_FIELD << 3 | WIRE_LENGTH_DELIMITED):
+                pos = _skip_field(buf, pos, key & 7)
+                continue
+            length = buf[pos]
+            if length < 0x80:
+                pos += 1
+            else:
+                length, pos = _read_varint(buf, pos)
+            sub_start = pos
+            sub_end = pos = sub_start + length
+            if sub_end > end:
+                break
+            field1 = None
+            field2 = None
+            if length >= 2 and buf[sub_start] == 0x08:
+                field1 = buf[sub_start + 1]
+                if field1 < 0x80:
+                    field_pos = sub_start + 2
+                else:
+                    field1, field_pos = _read_varint(buf, sub_start + 1)
+                if field_pos == sub_end:
+                    pass
+                elif buf[field_pos] == 0x12:
+                    field_length = buf[field_pos + 1]
+                    if field_length < 0x80:
+                        field_pos += 2
+                    else:
+                        field_length, field_pos = _read_varint(buf, field_pos + 1)
+                    if field_pos + field_length == sub_end:
+                        field2 = (field_pos, sub_end)
+                    else:
+                        field1 = None
+                else:
+                    field1 = None
+            if field1 is None:
+                field1, field2 = _parse_message2(buf, sub_start, sub_end)
+            if field1 not in wanted or (first and field1 in found):
+                continue
+            # 没有 field2 的 message2 解析后 field2 为空串
+            found[field1] = field2 or (0, 0)
+            if first and len(found) == len(wanted):
+                break
+    except (IndexError, ValueError):
+        pass
+    return found
+
+
+def get_message2(bytes_extra, field1, first=False, default=''):
+    """
+    相当于 MessageBytesExtra.ParseFromString 之后，取 field1 等于给定值的 message2 的 field2，只解码这一个字段
+    @param bytes_extra: MSG.BytesExtra
+    @param field1: message2.field1，如 MESSAGE2_SENDER
+    @param first: True 取第一个，False 取最后一个
+    @param default: 没有这个字段时的返回值
+    @return: str，没有时为 default；数据损坏时返回损坏之前找到的值
+    """
+    if not bytes_extra:
+        return default
+    view = memoryview(bytes_extra)
+    position = _scan_message2(bytes_extra, (field1,), first).get(field1)
+    if position is None:
+        return default
+    return str(view[position[0]:position[1]], 'utf-8', 'ignore')
+
+
+def get_message2_fields(bytes_extra, fields, first=False):
+    """
+    一次扫描取多个 field1 的 field2
+    @param bytes_extra: MSG.BytesExtra
+    @param fields: 需要的 field1，如 (3, 4)
+    @param first: True 取第一个，False 取最后一个
+    @return: {field1: str}，只包含找到的字段
+    """
+    if not bytes_extra:
+        return {}
+    view = memoryview(bytes_extra)
+    return {
+        field1: str(view[position[0]:position[1]], 'utf-8', 'ignore')
+        for field1, position in _scan_message2(bytes_extra, frozenset(fields), first).items()
+    }
+
+
+def get_message2_batch(bytes_extras, field1, first=False):
+    """
+    批量取多条消息的 field2
+    @param bytes_extras: 多条消息的 BytesExtra
+    @param field1: message2.field1
+    @param first: True 取第一个，False 取最后一个
+    @return: list，和 bytes_extras 一一对应，BytesExtra 为 None 时为 None
+    """
+    return [None if bytes_extra is None else get_message2(bytes_extra, field1, first) for bytes_extra in bytes_extras]
+
+
+def _strip_sender(wxid):
+    # todo 解析还是有问题，会出现这种带:的东西
+    if ':' in wxid:  # wxid_ewi8gfgpp0eu22:25319:1
+        wxid = wxid.split(':')[0]
+    return wxid
+
+
+def get_sender(bytes_extra):
+    """
+    群聊消息发送人的 wxid
+    @param bytes_extra: MSG.BytesExtra
+    @return: wxid，系统消息等没有发送人时为空串
+    """
+    return _strip_sender(get_message2(bytes_extra, MESSAGE2_SENDER))
+
+
+def get_sender_batch(bytes_extras):
+    """
+    批量解析群聊消息发送人
+    @param bytes_extras: 多条消息的 BytesExtra
+    @return: list，和 bytes_extras 一一对应，BytesExtra 为 None 时为 None
+    """
+    return [None if wxid is None else _strip_sender(wxid)
+            for wxid in get_message2_batch(bytes_extras, MESSAGE2_SENDER)]
+
+
+def file_storage_path(path):
+    """
+    message2 中的文件路径以 wxid 开头，去掉第一级目录
+    @param path: wxid\\FileStorage\\...
+    @return: FileStorage\\...
+    """
+    return "\\".join(path.split("\\")[1:])
+
+
+def benchmark(bytes_extras, field1=MESSAGE2_SENDER, repeat=5):
+    """
+    和 MessageBytesExtra.ParseFromString 比较，取同一个字段的耗时
+    @param bytes_extras: 多条消息的 BytesExtra
+    @return: (ParseFromString 秒数, 扫描秒数)，各取 repeat 次中最快的一次
+    """
+    import timeit
+    from app.util.protocbuf.msg_pb2 import MessageBytesExtra
+
+    def parse():
+        for bytes_extra in bytes_extras:
+            msg_bytes = MessageBytesExtra()
+            msg_bytes.ParseFromString(bytes_extra)
+            for tmp in msg_bytes.message2:
+                if tmp.field1 == field1:
+                    value = tmp.field2
+
+    def scan():
+        get_message2_batch(bytes_extras, field1)
+
+    return (min(timeit.repeat(parse, number=1, repeat=repeat)),
+            min(timeit.repeat(scan, number=1, repeat=repeat)))
+
+
+if __name__ == '__main__':
+    import sqlite3
+    import sys
+
+    # python -m app.util.protocbuf.bytes_extra MSG.db
+    conn = sqlite3.connect(sys.argv[1])
+    rows = [row[0] for row in
+            conn.execute("SELECT BytesExtra FROM MSG WHERE BytesExtra IS NOT NULL LIMIT 100000;").fetchall()]
+    conn.close()
+    parse_time, scan_time = benchmark(rows)
+    print(f'{len(rows)} 条 BytesExtra，ParseFromString: {parse_time:.3f}s，扫描: {scan_time:.3f}s，'
+          f'{parse_time / max(scan_time, 1e-9):.1f}x')
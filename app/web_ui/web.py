@@ -55,8 +55,8 @@ def get_contact(wxid) -> ContactDefault | Contact:
 
 @app.route("/")
 def index():
+    statistics = msg_db.get_statistics(time_range=time_range)
     contact_topN_num = msg_db.get_chatted_top_contacts(time_range=time_range, top_n=9999999, contain_chatroom=True)
-    total_msg_num = sum(list(map(lambda x: x[1], contact_topN_num)))
     contact_topN = []
     for wxid, num in contact_topN_num:
         contact = get_contact(wxid)
@@ -64,21 +64,21 @@ def index():
         contact_topN.append([contact, num, text_length])
     contacts_data = analysis.contacts_analysis(contact_topN)
     contact_topN = []
-    send_msg_num = msg_db.get_send_messages_number_sum(time_range)
-    contact_topN_num = msg_db.get_chatted_top_contacts(time_range=time_range, top_n=9999999, contain_chatroom=False)
+    contact_topN_num = [(wxid, num) for wxid, num in contact_topN_num if not wxid.endswith('@chatroom')]
 
+    summaries = msg_db.get_talker_summaries([wxid for wxid, num in contact_topN_num[:6]], time_range)
     for wxid, num in contact_topN_num[:6]:
         contact = get_contact(wxid)
-        text_length = msg_db.get_message_length(wxid, time_range)
+        text_length = summaries.get(wxid, (0, 0))[1]
         contact_topN.append([contact, num, text_length])
 
-    my_message_counter_data = analysis.my_message_counter(time_range=time_range)
+    my_message_counter_data = analysis.my_message_counter(statistics, time_range=time_range)
     data = {
         'avatar': Me().smallHeadImgUrl,
         'contact_topN': contact_topN,
         'contact_num': len(contact_topN_num),
-        'send_msg_num': send_msg_num,
-        'receive_msg_num': total_msg_num - send_msg_num,
+        'send_msg_num': statistics['send_num'],
+        'receive_msg_num': statistics['receive_num'],
     }
     return render_template('index.html', **data,**contacts_data, **my_message_counter_data)
 
@@ -99,7 +99,8 @@ def christmas(wxid):
         'first_time': first_time,
     }
     wordcloud_cloud_data = analysis.wordcloud_christmas(contact.wxid,time_range=time_range)
-    msg_data = msg_db.get_messages_by_hour(contact.wxid, time_range=time_range)
+    statistics = msg_db.get_statistics(contact.wxid, time_range=time_range)
+    msg_data = statistics['number_by_hour']
     msg_data.sort(key=lambda x: x[1], reverse=True)
     desc = {
         '夜猫子': {'22:00', '23:00', '00:00', '01:00', '02:00', '03:00', '04:00', '05:00'},
@@ -112,7 +113,7 @@ def christmas(wxid):
     for key, item in desc.items():
         if time_ in item:
             label = key
-    latest_dialog = msg_db.get_latest_time_of_message(contact.wxid, time_range=time_range)
+    latest_dialog = statistics['latest_time']
     latest_time = latest_dialog[0][2] if latest_dialog else ''
     time_data = {
         'latest_time': latest_time,
@@ -135,7 +136,7 @@ def christmas(wxid):
 
     month_data = {
         'year': '2023',
-        'total_msg_num': msg_db.get_messages_number(contact.wxid, time_range=time_range),
+        'total_msg_num': statistics['message_num'],
         'max_month': max_month,
         'min_month': min_month,
         'max_month_num': max_num,
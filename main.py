@@ -1,4 +1,5 @@
 import ctypes
+import multiprocessing
 import sys
 import time
 import traceback
@@ -103,6 +104,7 @@ class ViewController(QWidget):
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()  # 打包后解密进程池需要
     app = QApplication(sys.argv)
     font = QFont('微软雅黑', 12)  # 使用 Times New Roman 字体，字体大小为 14
     app.setFont(font)